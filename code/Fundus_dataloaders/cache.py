@@ -0,0 +1,114 @@
+""" Read-only cache of decoded dataset images, shared by every process through one memory-mapped file """
+
+import json
+import os
+import shutil
+from glob import glob
+
+import numpy as np
+from PIL import Image
+
+CACHE_INDEX = 'index.json'
+CACHE_DATA = 'pixels.bin'
+
+_cache = None
+
+
+def _key(path):
+    return os.path.abspath(path)
+
+
+def build_cache(root, cache_dir):
+    """Decode every png under root into cache_dir, unless it already holds a cache.
+
+    The index keeps the glob listing of every directory (file names, in glob
+    order) and the offset, dtype, shape, mode and palette of every image in
+    the pixel file. The cache is written to a temporary directory and renamed,
+    so concurrent readers never see a partial cache.
+    """
+    if os.path.exists(os.path.join(cache_dir, CACHE_INDEX)):
+        return cache_dir
+    dirs, files, offset = {}, {}, 0
+    for dirpath, _, names in sorted(os.walk(root)):
+        if not any(n.endswith('.png') for n in names):
+            continue
+        # the same call as the datasets, whose order depends on it
+        listing = glob(os.path.join(dirpath, '') + '*.png')
+        dirs[_key(dirpath)] = [os.path.basename(path) for path in listing]
+        for path in listing:
+            # headers only, decoding happens in the second pass
+            with Image.open(path) as img:
+                mode, size = img.mode, img.size
+                palette = img.getpalette() if mode == 'P' else None
+            # dtype and channels of the mode
+            arr = np.asarray(Image.new(mode, (1, 1)))
+            shape = (size[1], size[0]) + arr.shape[2:]
+            nbytes = int(np.prod(shape)) * arr.dtype.itemsize
+            files[_key(path)] = dict(offset=offset, dtype=arr.dtype.str, shape=shape, mode=mode, palette=palette)
+            offset += nbytes
+    tmp_dir = cache_dir.rstrip('/') + '.tmp{}'.format(os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    data = np.memmap(os.path.join(tmp_dir, CACHE_DATA), dtype=np.uint8, mode='w+', shape=(max(offset, 1),))
+    for path, entry in files.items():
+        with Image.open(path) as img:
+            arr = np.ascontiguousarray(np.asarray(img))
+        data[entry['offset']:entry['offset'] + arr.nbytes] = arr.reshape(-1).view(np.uint8)
+    data.flush()
+    del data
+    with open(os.path.join(tmp_dir, CACHE_INDEX), 'w') as f:
+        json.dump({'dirs': dirs, 'files': files}, f)
+    try:
+        os.rename(tmp_dir, cache_dir)
+    except OSError:
+        # another process finished the same cache first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return cache_dir
+
+
+class DecodedCache(object):
+    """Images of a cache built by build_cache, read from a read-only memory map.
+
+    The pages of the map are shared by all processes and data loader workers
+    reading the same cache, so every image is decoded once per machine.
+    """
+
+    def __init__(self, cache_dir):
+        with open(os.path.join(cache_dir, CACHE_INDEX)) as f:
+            index = json.load(f)
+        self.dirs, self.files = index['dirs'], index['files']
+        self.data = np.memmap(os.path.join(cache_dir, CACHE_DATA), dtype=np.uint8, mode='r')
+
+    def open(self, path):
+        """PIL image of path, or None if it is not cached."""
+        entry = self.files.get(_key(path))
+        if entry is None:
+            return None
+        dtype = np.dtype(entry['dtype'])
+        nbytes = int(np.prod(entry['shape'])) * dtype.itemsize
+        # a private copy: the map is read-only and PIL may keep the buffer
+        arr = np.array(self.data[entry['offset']:entry['offset'] + nbytes]).view(dtype).reshape(entry['shape'])
+        img = Image.fromarray(arr, entry['mode'])
+        if entry['palette'] is not None:
+            img.putpalette(entry['palette'])
+        return img
+
+    def glob(self, image_dir):
+        """glob(image_dir + '*.png') as listed when the cache was built, or None if the directory is not cached."""
+        names = self.dirs.get(_key(image_dir))
+        return None if names is None else [image_dir + name for name in names]
+
+
+def use_cache(cache_dir):
+    """Serve open_image / glob_images of this process from the cache in cache_dir (None to disable)."""
+    global _cache
+    _cache = DecodedCache(cache_dir) if cache_dir else None
+
+
+def open_image(path):
+    img = _cache.open(path) if _cache is not None else None
+    return Image.open(path) if img is None else img
+
+
+def glob_images(image_dir):
+    listing = _cache.glob(image_dir) if _cache is not None else None
+    return glob(image_dir + '*.png') if listing is None else listing
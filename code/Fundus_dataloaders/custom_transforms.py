@@ -146,6 +146,40 @@ class eraser():
         sample['image'] = image
         return sample
 
+def _map_geometry(sample, fn):
+    # apply a geometric op of the image to the coordinate fields of TrackGeometry too
+    if 'geometry' in sample:
+        sample['geometry'] = [fn(g) for g in sample['geometry']]
+
+
+def _map_pseudo(sample, fn):
+    # stored pseudo-labels (trainer.pseudo_store) follow the label, 0 (not confident) where it is filled
+    if 'pseudo' in sample:
+        sample['pseudo'] = fn(sample['pseudo'])
+
+
+class TrackGeometry(object):
+    """Record where every pixel of the augmented image comes from.
+
+    Keeps the un-augmented image as sample['orig'] and adds two float ('F')
+    images holding the x and y pixel coordinates of the un-augmented image;
+    the geometric transforms below warp them like the image, so after the
+    pipeline they map every output pixel to its source position (used to warp
+    predictions on the un-augmented image onto the augmented view, see
+    trainer.strategies.TeacherCache). Put it first in the weak transform.
+    """
+
+    def __call__(self, sample):
+        img = sample['image']
+        w, h = img.size
+        # pixel centres, in the continuous coordinates PIL and grid_sample(align_corners=False) use
+        x, y = np.meshgrid(np.arange(w, dtype=np.float32) + 0.5, np.arange(h, dtype=np.float32) + 0.5)
+        sample['orig'] = img.copy()
+        sample['geometry'] = [Image.fromarray(x, 'F'), Image.fromarray(y, 'F')]
+        sample['geometry_size'] = (w, h)
+        return sample
+
+
 class elastic_transform():
     """Elastic deformation of images as described in [Simard2003]_.
         .. [Simard2003] Simard, Steinkraus and Platt, "Best Practices for
@@ -200,6 +234,10 @@ class elastic_transform():
             else:
                 transformed_label = None
             transformed_image = transformed_image.astype(np.uint8)
+            _map_geometry(sample, lambda g: Image.fromarray(
+                map_coordinates(np.array(g, dtype=np.float32), indices, order=1, mode='nearest').reshape(shape).astype(np.float32), 'F'))
+            _map_pseudo(sample, lambda p: Image.fromarray(
+                map_coordinates(np.array(p), indices, order=0, mode='nearest', prefilter=False).reshape(shape).astype(np.uint8)))
 
             if label is not None:
                 transformed_label = transformed_label.astype(np.uint8)
@@ -276,20 +314,28 @@ class RandomCrop(object):
             padding = np.maximum(self.padding,np.maximum((self.size[0]-w)//2+5,(self.size[1]-h)//2+5))
             img = ImageOps.expand(img, border=padding, fill=0)
             mask = ImageOps.expand(mask, border=padding, fill=255)
+            _map_geometry(sample, lambda g: ImageOps.expand(g, border=padding, fill=-1.0))
+            _map_pseudo(sample, lambda p: ImageOps.expand(p, border=padding, fill=0))
 
         assert img.width == mask.width
         assert img.height == mask.height
         w, h = img.size
         th, tw = self.size # target size
         if w == tw and h == th:
-            return {'image': img,
-                    'label': mask,
-                    'img_name': sample['img_name'],
-                    'dc': sample['dc']}
+            out = {'image': img,
+                   'label': mask,
+                   'img_name': sample['img_name'],
+                   'dc': sample['dc']}
+            for key in ['orig', 'geometry', 'geometry_size', 'pseudo', 'hardness']:
+                if key in sample:
+                    out[key] = sample[key]
+            return out
         x1 = random.randint(0, w - tw)
         y1 = random.randint(0, h - th)
         img = img.crop((x1, y1, x1 + tw, y1 + th))
         mask = mask.crop((x1, y1, x1 + tw, y1 + th))
+        _map_geometry(sample, lambda g: g.crop((x1, y1, x1 + tw, y1 + th)))
+        _map_pseudo(sample, lambda p: p.crop((x1, y1, x1 + tw, y1 + th)))
         # print(img.size)
         sample['image'] = img
         sample['label'] = mask
@@ -328,6 +374,8 @@ class RandomFlip(object):
         if random.random() < 0.5:
             img = img.transpose(Image.FLIP_LEFT_RIGHT)
             mask = mask.transpose(Image.FLIP_LEFT_RIGHT)
+            _map_geometry(sample, lambda g: g.transpose(Image.FLIP_LEFT_RIGHT))
+            _map_pseudo(sample, lambda p: p.transpose(Image.FLIP_LEFT_RIGHT))
         if random.random() < 0.5:
             img = img.transpose(Image.FLIP_TOP_BOTTOM)
             mask = mask.transpose(Image.FLIP_TOP_BOTTOM)
@@ -343,6 +391,8 @@ class RandomHorizontalFlip(object):
         if random.random() < 0.5:
             img = img.transpose(Image.FLIP_LEFT_RIGHT)
             mask = mask.transpose(Image.FLIP_LEFT_RIGHT)
+            _map_geometry(sample, lambda g: g.transpose(Image.FLIP_LEFT_RIGHT))
+            _map_pseudo(sample, lambda p: p.transpose(Image.FLIP_LEFT_RIGHT))
 
         sample['image'] = img
         sample['label'] = mask
@@ -472,6 +522,9 @@ class RandomScaleRotate(object):
             rotate_degree = random.randint(self.left, self.right)
             img = img.rotate(rotate_degree, Image.BILINEAR)
             mask = mask.rotate(rotate_degree, Image.NEAREST, fillcolor=self.fillcolor)
+            # filled corners map outside the source image
+            _map_geometry(sample, lambda g: g.rotate(rotate_degree, Image.BILINEAR, fillcolor=-1.0))
+            _map_pseudo(sample, lambda p: p.rotate(rotate_degree, Image.NEAREST, fillcolor=0))
 
             sample['image'] = img
             sample['label'] = mask
@@ -497,6 +550,8 @@ class RandomScaleCrop(object):
             h = int(random.uniform(1, 1.5) * img.size[1])
 
             img, mask = img.resize((w, h), Image.BILINEAR), mask.resize((w, h), Image.NEAREST)
+            _map_geometry(sample, lambda g: g.resize((w, h), Image.BILINEAR))
+            _map_pseudo(sample, lambda p: p.resize((w, h), Image.NEAREST))
             sample['image'] = img
             sample['label'] = mask
         return self.crop(sample)
@@ -620,6 +675,8 @@ class Normalize_tf(object):
             strong /= 127.5
             strong -= 1.0
             sample['strong_aug'] = strong
+        if 'orig' in sample.keys():
+            sample['orig'] = np.array(sample['orig']).astype(np.float32) / 127.5 - 1.0
         # _mask = np.zeros([__mask.shape[0], __mask.shape[1]])
         # _mask[__mask > 200] = 255
         # # index = np.where(__mask > 50 and __mask < 201)
@@ -696,6 +753,18 @@ class ToTensor(object):
             strong = np.array(sample['strong_aug']).astype(np.float32).transpose((2, 0, 1))
             strong = torch.from_numpy(strong).float()
             sample['strong_aug'] = strong
+        if 'orig' in sample.keys():
+            orig = np.array(sample['orig']).astype(np.float32)
+            if orig.ndim == 2:
+                orig = np.expand_dims(orig, 2)
+            sample['orig'] = torch.from_numpy(orig.transpose((2, 0, 1))).float()
+        if 'geometry' in sample.keys():
+            # (H, W, 2) sampling grid in [-1, 1] of the un-augmented image, as grid_sample takes it
+            w, h = sample.pop('geometry_size')
+            gx, gy = [np.array(g, dtype=np.float32) for g in sample['geometry']]
+            sample['geometry'] = torch.from_numpy(np.stack([gx / w * 2 - 1, gy / h * 2 - 1], axis=-1))
+        if 'pseudo' in sample.keys():
+            sample['pseudo'] = torch.from_numpy(np.array(sample['pseudo'], dtype=np.uint8))
         img = torch.from_numpy(img).float()
         map = torch.from_numpy(map).float()
         sample['image']=img
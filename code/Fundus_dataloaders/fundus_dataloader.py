@@ -7,6 +7,7 @@ from glob import glob
 import random
 import copy
 import matplotlib.pyplot as plt
+from .cache import open_image, glob_images
 
 class FundusSegmentation(Dataset):
     """
@@ -53,7 +54,7 @@ class FundusSegmentation(Dataset):
             self._image_dir = os.path.join(self._base_dir, 'Domain'+str(i), phase, 'ROIs/image/')
             print('==> Loading {} data from: {}'.format(phase, self._image_dir))
 
-            imagelist = glob(self._image_dir + '*.png')
+            imagelist = glob_images(self._image_dir)
 
             if self.splitid == i and selected_idxs is not None:
                 total = list(range(len(imagelist)))
@@ -94,9 +95,9 @@ class FundusSegmentation(Dataset):
         if self.phase != 'test':
             # index = np.random.choice(len(self.image_pool), 1)[0]
             # _img = self.image_pool[index]
-            _img = Image.open(self.image_pool[index]).convert('RGB').resize((256, 256), Image.LANCZOS)
+            _img = open_image(self.image_pool[index]).convert('RGB').resize((256, 256), Image.LANCZOS)
             # _target = self.label_pool[index]
-            _target = Image.open(self.label_pool[index])
+            _target = open_image(self.label_pool[index])
             if _target.mode is 'RGB':
                 _target = _target.convert('L')
             _target = _target.resize((256, 256), Image.NEAREST)
@@ -125,8 +126,8 @@ class FundusSegmentation(Dataset):
             #     plt.savefig('./img/'+self.img_name_pool[index]+'strongimg.png')
             #     plt.cla()
         else:
-            _img = Image.open(self.image_pool[index]).convert('RGB').resize((256, 256), Image.LANCZOS)
-            _target = Image.open(self.label_pool[index])
+            _img = open_image(self.image_pool[index]).convert('RGB').resize((256, 256), Image.LANCZOS)
+            _target = open_image(self.label_pool[index])
             if _target.mode is 'RGB':
                 _target = _target.convert('L')
             _target = _target.resize((256, 256), Image.NEAREST)
@@ -214,7 +215,7 @@ class ProstateSegmentation(Dataset):
             self._image_dir = os.path.join(self._base_dir, self.domain_name[i], phase,'image/')
             print('==> Loading {} data from: {}'.format(phase, self._image_dir))
 
-            imagelist = glob(self._image_dir + '*.png')
+            imagelist = glob_images(self._image_dir)
             imagelist.sort()
             if self.splitid == i and selected_idxs is not None:
                 total = list(range(len(imagelist)))
@@ -246,8 +247,8 @@ class ProstateSegmentation(Dataset):
         
     def __getitem__(self, index):
         if self.phase != 'test':
-            _img = Image.open(self.image_pool[index])
-            _target = Image.open(self.label_pool[index])
+            _img = open_image(self.image_pool[index])
+            _target = open_image(self.label_pool[index])
             if _img.mode is 'RGB':
                 print('img rgb')
                 _img = _img.convert('L')
@@ -280,8 +281,8 @@ class ProstateSegmentation(Dataset):
                 # print(np.bincount(x1.reshape(-1)))
                 # print(np.bincount(x2.reshape(-1)))
         else:
-            _img = Image.open(self.image_pool[index])
-            _target = Image.open(self.label_pool[index])
+            _img = open_image(self.image_pool[index])
+            _target = open_image(self.label_pool[index])
             if _img.mode is 'RGB':
                 _img = _img.convert('L')
             if _target.mode is 'RGB':
@@ -337,7 +338,7 @@ class MNMSSegmentation(Dataset):
             self._image_dir = os.path.join(self._base_dir, self.domain_name[i], phase,'image/')
             print('==> Loading {} data from: {}'.format(phase, self._image_dir))
 
-            imagelist = glob(self._image_dir + '*.png')
+            imagelist = glob_images(self._image_dir)
             imagelist.sort()
             if self.splitid == i and selected_idxs is not None:
                 total = list(range(len(imagelist)))
@@ -369,8 +370,8 @@ class MNMSSegmentation(Dataset):
         
     def __getitem__(self, index):
         if self.phase != 'test':
-            _img = Image.open(self.image_pool[index]).resize((224, 224), Image.BILINEAR)
-            _target = Image.open(self.label_pool[index]).resize((224, 224), Image.NEAREST)
+            _img = open_image(self.image_pool[index]).resize((224, 224), Image.BILINEAR)
+            _target = open_image(self.label_pool[index]).resize((224, 224), Image.NEAREST)
             if _img.mode is 'RGB':
                 print('img rgb')
                 _img = _img.convert('L')
@@ -403,8 +404,8 @@ class MNMSSegmentation(Dataset):
                 # print(np.bincount(x1.reshape(-1)))
                 # print(np.bincount(x2.reshape(-1)))
         else:
-            _img = Image.open(self.image_pool[index]).resize((224, 224), Image.BILINEAR)
-            _target = Image.open(self.label_pool[index]).resize((224,224), Image.NEAREST)
+            _img = open_image(self.image_pool[index]).resize((224, 224), Image.BILINEAR)
+            _target = open_image(self.label_pool[index]).resize((224,224), Image.NEAREST)
             if _img.mode is 'RGB':
                 _img = _img.convert('L')
             # if _target.mode is 'RGB':
@@ -132,7 +132,7 @@ def cross_entropy2d(logit, target, ignore_index=255, weight=None, size_average=T
     if weight is None:
         criterion = nn.CrossEntropyLoss(weight=weight, ignore_index=ignore_index, size_average=False)
     else:
-        criterion = nn.CrossEntropyLoss(weight=torch.from_numpy(np.array(weight)).float().cuda(), ignore_index=ignore_index, size_average=False)
+        criterion = nn.CrossEntropyLoss(weight=torch.from_numpy(np.array(weight)).float().to(logit.device), ignore_index=ignore_index, size_average=False)
     loss = criterion(logit, target.long())
 
     if size_average:
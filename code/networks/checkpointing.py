@@ -0,0 +1,129 @@
+""" Activation checkpointing of U-Net blocks """
+
+import contextlib
+import time
+
+import torch
+from torch import nn
+from torch.utils.checkpoint import checkpoint
+
+
+@contextlib.contextmanager
+def _recompute_bn(bns, forwards):
+    """BatchNorm state for the recomputation in backward: the forward overrides
+    active in the first pass (e.g. split_batchnorm) are reinstalled, and the
+    running statistics are not updated a second time."""
+    saved = [(bn.momentum, None if bn.num_batches_tracked is None else bn.num_batches_tracked.clone()) for bn in bns]
+    installed = [bn for bn in forwards if 'forward' not in bn.__dict__]
+    for bn in bns:
+        bn.momentum = 0.0
+    for bn in installed:
+        bn.forward = forwards[bn]
+    try:
+        yield
+    finally:
+        for bn, (momentum, tracked) in zip(bns, saved):
+            bn.momentum = momentum
+            if tracked is not None:
+                bn.num_batches_tracked.copy_(tracked)
+        for bn in installed:
+            del bn.forward
+
+
+class Checkpointable(object):
+    """Mixin for nn.Module blocks: with use_checkpoint set, forward keeps only the
+    block inputs and recomputes its activations in backward (only while grad is
+    enabled; eval and no_grad forwards are unchanged)."""
+
+    use_checkpoint = False
+
+    def checkpointed(self, fn, *inputs):
+        if not (self.use_checkpoint and self.training and torch.is_grad_enabled()):
+            return fn(*inputs)
+        bns = [m for m in self.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+        forwards = {}
+        first = [True]
+
+        def run(*args):
+            if first[0]:
+                first[0] = False
+                forwards.update((bn, bn.__dict__['forward']) for bn in bns if 'forward' in bn.__dict__)
+                return fn(*args)
+            with _recompute_bn(bns, forwards):
+                return fn(*args)
+
+        return checkpoint(run, *inputs, use_reentrant=False)
+
+
+def set_checkpointing(model, blocks='none'):
+    """Checkpoint the blocks of model: 'none', 'all', a group of
+    model.checkpoint_groups (e.g. 'encoder', 'decoder') or a list of block names."""
+    groups = model.checkpoint_groups
+    every = [name for names in groups.values() for name in names]
+    if blocks == 'none':
+        blocks = []
+    elif blocks == 'all':
+        blocks = every
+    elif isinstance(blocks, str):
+        blocks = groups[blocks]
+    for name in every:
+        getattr(model, name).use_checkpoint = name in blocks
+    return model
+
+
+def _memory_in_use(device):
+    """Bytes allocated by torch on cuda, or by the C heap (glibc mallinfo2) on cpu."""
+    if device == 'cuda':
+        return torch.cuda.memory_allocated()
+    import ctypes
+
+    class MallInfo2(ctypes.Structure):
+        _fields_ = [(name, ctypes.c_size_t) for name in
+                    ['arena', 'ordblks', 'smblks', 'hblks', 'hblkhd', 'usmblks', 'fsmblks', 'uordblks', 'fordblks', 'keepcost']]
+
+    mallinfo2 = ctypes.CDLL(None).mallinfo2
+    mallinfo2.restype = MallInfo2
+    info = mallinfo2()
+    return info.uordblks + info.hblkhd
+
+
+def benchmark(net, x, steps=3):
+    """ms per forward + backward step and MB of activations kept from forward for backward."""
+    device = x.device.type
+    cuda = device == 'cuda'
+    held = 0
+    for i in range(steps + 1):
+        if i == 1:
+            if cuda:
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+        net.zero_grad(set_to_none=True)
+        before = _memory_in_use(device)
+        out = net(x)
+        if i > 0:
+            held = max(held, _memory_in_use(device) - before)
+        out.float().mean().backward()
+        del out
+    if cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / steps * 1000, held / 2 ** 20
+
+
+if __name__ == '__main__':
+    # memory / throughput report, run from code/: python -m networks.checkpointing [size ...]
+    import sys
+    from networks.unet_model import UNet
+    from networks.unet import Unet2D
+
+    sizes = [int(s) for s in sys.argv[1:]] or [256, 384]
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    batch = 2
+    print('device: {}, batch {}'.format(device, batch))
+    for arch in ['UNet', 'Unet2D']:
+        net = UNet(n_channels=3, n_classes=2) if arch == 'UNet' else Unet2D(c=3, n=16, num_classes=2)
+        net = net.to(device).train()
+        for size in sizes:
+            x = torch.randn(batch, 3, size, size, device=device)
+            for blocks in ['none', 'decoder', 'encoder', 'all']:
+                ms, mb = benchmark(set_checkpointing(net, blocks), x)
+                print('{} {}x{} checkpoint={}: {:.1f} ms/step, {:.0f} MB activations'.format(arch, size, size, blocks, ms, mb), flush=True)
@@ -0,0 +1,78 @@
+""" channels_last and torch.compile execution modes of the U-Nets """
+
+import time
+
+import torch
+
+COMPILE_MODES = ['none', 'default', 'reduce-overhead', 'max-autotune']
+
+
+def memory_format(channels_last=False):
+    """Format the inputs of a model set up with set_execution_mode should be in."""
+    return torch.channels_last if channels_last else torch.preserve_format
+
+
+def set_execution_mode(model, channels_last=False, compile='none'):
+    """Store the weights of model in NHWC order and/or compile its forward in place.
+
+    The module itself is compiled (nn.Module.compile), so state_dict keys, EMA
+    updates and parameter broadcasts see the same module as in eager mode.
+    Shapes are static: every new batch shape compiles once, up to the dynamo
+    recompile limit, beyond which the forward falls back to eager.
+    """
+    if channels_last:
+        model.to(memory_format=torch.channels_last)
+    if compile != 'none':
+        model.compile(mode=compile, dynamic=False)
+    return model
+
+
+def benchmark(net, x, train=True, steps=3):
+    """ms per step (forward + backward if train, no_grad forward otherwise) and the output of the last step."""
+    cuda = x.device.type == 'cuda'
+    net.train(train)
+    for i in range(steps + 1):
+        if i == 1:
+            if cuda:
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+        if train:
+            net.zero_grad(set_to_none=True)
+            out = net(x)
+            out.float().mean().backward()
+        else:
+            with torch.no_grad():
+                out = net(x)
+    if cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / steps * 1000, out.detach()
+
+
+if __name__ == '__main__':
+    # eager / channels_last / compiled throughput report, run from code/:
+    # python -m networks.execution [size ...]
+    import copy
+    import sys
+    from networks.unet_model import UNet
+
+    sizes = [int(s) for s in sys.argv[1:]] or [256, 384]
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    batch = 2
+    modes = [('eager', False, 'none'), ('channels_last', True, 'none'),
+             ('compile', False, 'default'), ('channels_last+compile', True, 'default')]
+    print('device: {}, batch {}'.format(device, batch))
+    torch.manual_seed(0)
+    reference = UNet(n_channels=3, n_classes=2).to(device)
+    for train in [False, True]:
+        for size in sizes:
+            x = torch.randn(batch, 3, size, size, device=device)
+            eager_ms, eager_out = None, None
+            for name, channels_last, compile in modes:
+                net = set_execution_mode(copy.deepcopy(reference), channels_last, compile)
+                ms, out = benchmark(net, x.contiguous(memory_format=memory_format(channels_last)), train)
+                if eager_out is None:
+                    eager_ms, eager_out = ms, out
+                print('{} {}x{} {}: {:.1f} ms/step, {:.2f}x, max |diff| to eager {:.2e}'.format(
+                    'train' if train else 'infer', size, size, name, ms, eager_ms / ms,
+                    (out.float() - eager_out.float()).abs().max().item()), flush=True)
+                del net
@@ -0,0 +1,47 @@
+""" Batched forward over several views with per-view BatchNorm statistics """
+
+import contextlib
+import functools
+
+import torch
+from torch import nn
+
+
+def _split_bn_forward(bn, sizes, x):
+    return torch.cat([type(bn).forward(bn, chunk) for chunk in torch.split(x, sizes, dim=0)], dim=0)
+
+
+@contextlib.contextmanager
+def split_batchnorm(model, sizes):
+    """Make every BatchNorm layer of model normalize each chunk of the batch on its own.
+
+    Chunks are given by sizes along dim 0. Each chunk sees its own batch statistics and
+    updates the running statistics in order, so the result (outputs, gradients and BN
+    buffers) matches running the model once per chunk, while all convolutions still
+    run as a single batched kernel.
+    """
+    bns = [m for m in model.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    for bn in bns:
+        bn.forward = functools.partial(_split_bn_forward, bn, list(sizes))
+    try:
+        yield model
+    finally:
+        for bn in bns:
+            del bn.forward
+
+
+def fused_forward(model, views, split_bn=True):
+    """Run model once over the concatenation of views and return one output per view.
+
+    split_bn=True keeps per-view BatchNorm statistics (same result as separate forwards).
+    split_bn=False normalizes the joint batch, which is cheaper but changes the statistics
+    every view is normalized with, and the running statistics are updated once per call.
+    """
+    sizes = [len(v) for v in views]
+    x = torch.cat(views, dim=0)
+    if split_bn and model.training:
+        with split_batchnorm(model, sizes):
+            out = model(x)
+    else:
+        out = model(x)
+    return torch.split(out, sizes, dim=0)
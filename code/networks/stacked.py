@@ -0,0 +1,87 @@
+""" K replicas of a network trained side by side as one module with stacked parameters """
+
+import torch
+from torch import nn
+from torch.func import functional_call, vmap
+
+
+class Stacked(nn.Module):
+    """Replicas of a network (same architecture, own weights) run as one vmapped forward.
+
+    Every parameter and buffer of net is replaced by the stack of the
+    replicas' tensors, (K, ...) with the replica first, under the same name,
+    so an optimizer or ModelEMA over the parameters of this module updates
+    all replicas with the same foreach kernels, and state_dict keys are those
+    of net. forward takes the replica batches concatenated along dim 0,
+    (K * B, ...) with replica k at [k * B, (k + 1) * B), and returns the
+    outputs in the same layout; BatchNorm statistics and running buffers stay
+    per replica.
+
+    Args:
+        nets (list of nn.Module): the replicas, nets[0] is reused as the container
+    """
+
+    stacked_dims = 1
+
+    def __init__(self, nets):
+        super().__init__()
+        self.k = len(nets)
+        self.net = nets[0]
+        for name, _ in list(self.net.named_parameters()):
+            stack = torch.stack([net.get_parameter(name).detach() for net in nets])
+            self._set(name, nn.Parameter(stack))
+        for name, _ in list(self.net.named_buffers()):
+            self._set(name, torch.stack([net.get_buffer(name) for net in nets]))
+
+    def _set(self, name, tensor):
+        module_name, _, attr = name.rpartition('.')
+        module = self.net.get_submodule(module_name)
+        if isinstance(tensor, nn.Parameter):
+            module.register_parameter(attr, tensor)
+        else:
+            module.register_buffer(attr, tensor)
+
+    def _tensors(self):
+        return dict(self.net.named_parameters()), dict(self.net.named_buffers())
+
+    def forward(self, x):
+        params, buffers = self._tensors()
+        x = x.view(self.k, -1, *x.shape[1:])
+
+        def run(p, b, xk):
+            return functional_call(self.net, (p, b), (xk,))
+
+        # each replica draws its own dropout masks
+        out = vmap(run, randomness='different')(params, buffers, x)
+        return out.flatten(0, 1)
+
+    def replica(self, k):
+        """Module running replica k alone on a (B, ...) batch, on views of the stacked tensors."""
+        return Replica(self, k)
+
+    def replica_state_dict(self, k):
+        """state_dict of replica k, loadable into a plain net."""
+        return {name: t[k] for name, t in self.net.state_dict().items()}
+
+
+class Replica(nn.Module):
+    """Replica k of a Stacked module; train() / eval() switch the whole stack."""
+
+    def __init__(self, stacked, k):
+        super().__init__()
+        # not a submodule: the replica owns no parameters of its own
+        self.__dict__['stacked'] = stacked
+        self.k = k
+
+    def train(self, mode=True):
+        self.stacked.train(mode)
+        self.training = mode
+        return self
+
+    def forward(self, x):
+        params, buffers = self.stacked._tensors()
+        k = self.k
+        return functional_call(self.stacked.net, ({n: p[k] for n, p in params.items()}, {n: b[k] for n, b in buffers.items()}), (x,))
+
+    def state_dict(self, *args, **kwargs):
+        return self.stacked.replica_state_dict(self.k)
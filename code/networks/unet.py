@@ -7,7 +7,11 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from networks.dsbn import DomainSpecificBatchNorm2d
+from networks.checkpointing import Checkpointable
 
+# blocks of the Unet2D family that can be checkpointed, see networks.checkpointing
+CHECKPOINT_GROUPS = {'encoder': ['convd1', 'convd2', 'convd3', 'convd4', 'convd5'],
+                     'decoder': ['convu4', 'convu3', 'convu2', 'convu1']}
 
 
 def count_params(model):
@@ -29,7 +33,7 @@ def normalization(planes, norm='gn', num_domains=None):
 
 
 #### Note: All are functional units except the norms, which are sequential
-class ConvD(nn.Module):
+class ConvD(Checkpointable, nn.Module):
     def __init__(self, inplanes, planes, norm='bn', first=False, activation='relu'):
         super(ConvD, self).__init__()
 
@@ -50,8 +54,9 @@ class ConvD(nn.Module):
             self.activation = nn.LeakyReLU(0.01, inplace=True)
 
     def forward(self, x):
+        return self.checkpointed(self._forward, x)
 
-
+    def _forward(self, x):
         if not self.first:
             x = self.maxpool2D(x)
 
@@ -72,7 +77,7 @@ class ConvD(nn.Module):
         return z
 
 
-class ConvU(nn.Module):
+class ConvU(Checkpointable, nn.Module):
     def __init__(self, planes, norm='bn', first=False, activation='relu'):
         super(ConvU, self).__init__()
 
@@ -94,6 +99,9 @@ class ConvU(nn.Module):
             self.activation = nn.LeakyReLU(0.01, inplace=True)
 
     def forward(self, x, prev):
+        return self.checkpointed(self._forward, x, prev)
+
+    def _forward(self, x, prev):
         #layer 1 conv, bn, relu
         if not self.first:
             x = self.conv1(x)
@@ -117,7 +125,7 @@ class ConvU(nn.Module):
         return y
 
 
-class ConvU_Rec(nn.Module):
+class ConvU_Rec(Checkpointable, nn.Module):
     def __init__(self, planes, norm='bn', activation='relu', num_domains=None):
         super(ConvU_Rec, self).__init__()
 
@@ -137,6 +145,9 @@ class ConvU_Rec(nn.Module):
             self.activation = nn.LeakyReLU(0.01, inplace=True)
 
     def forward(self, x, domain_label=None):
+        return self.checkpointed(self._forward, x, domain_label)
+
+    def _forward(self, x, domain_label=None):
         #layer 1 conv, bn, relu
         x = self.conv1(x)
         if domain_label is not None:
@@ -166,6 +177,8 @@ class ConvU_Rec(nn.Module):
 
 
 class Unet2D(nn.Module):
+    checkpoint_groups = CHECKPOINT_GROUPS
+
     def __init__(self, c=3, n=16, norm='bn', num_classes=2, activation='relu'):
         super(Unet2D, self).__init__()
         self.convd1 = ConvD(c,     n, norm, first=True, activation=activation)
@@ -204,6 +217,8 @@ class Unet2D(nn.Module):
 
 
 class Unet2D_MT(nn.Module):
+    checkpoint_groups = CHECKPOINT_GROUPS
+
     def __init__(self, c=3, n=16, norm='bn', num_classes=2, activation='relu'):
         super(Unet2D_MT, self).__init__()
         self.convd1 = ConvD(c,     n, norm, first=True, activation=activation)
@@ -246,6 +261,8 @@ class Unet2D_MT(nn.Module):
 
 
 class Encoder(nn.Module):
+    checkpoint_groups = {'encoder': CHECKPOINT_GROUPS['encoder']}
+
     def __init__(self, c=3, n=16, norm='bn', activation='relu'):
         super(Encoder, self).__init__()
         self.convd1 = ConvD(c,     n, norm, first=True, activation=activation)
@@ -271,6 +288,8 @@ class Encoder(nn.Module):
         return [x1, x2, x3, x4, x5]
 
 class Decoder(nn.Module):
+    checkpoint_groups = {'decoder': CHECKPOINT_GROUPS['decoder']}
+
     def __init__(self, n=16, num_classes=2, norm='bn', activation='relu'):
         super(Decoder, self).__init__()
         self.convu4 = ConvU(16*n, norm, first=True, activation=activation)
@@ -296,6 +315,8 @@ class Decoder(nn.Module):
         return y1_pred
 
 class UNet(nn.Module):
+    checkpoint_groups = CHECKPOINT_GROUPS
+
     def __init__(self, n_channels=3, n_classes=2, n=16, norm='bn', activation='relu'):
         super(UNet, self).__init__()
         self.convd1 = ConvD(n_channels,     n, norm, first=True, activation=activation)
@@ -337,6 +358,8 @@ class UNet(nn.Module):
 
 
 class Rec_Decoder(nn.Module):
+    checkpoint_groups = {'decoder': CHECKPOINT_GROUPS['decoder']}
+
     def __init__(self, n=16, num_classes=2, norm='bn', activation='relu', num_domains=None):
         super(Rec_Decoder, self).__init__()
         self.convu4 = ConvU_Rec(16*n, norm, activation=activation, num_domains=num_domains)
@@ -363,6 +386,8 @@ class Rec_Decoder(nn.Module):
 
 
 class Unet2D_DS(nn.Module):
+    checkpoint_groups = CHECKPOINT_GROUPS
+
     def __init__(self, c=3, n=16, norm='bn', num_classes=2, activation='relu'):
         super(Unet2D_DS, self).__init__()
         self.convd1 = ConvD(c,     n, norm, first=True, activation=activation)
@@ -419,6 +444,8 @@ class Unet2D_DS(nn.Module):
 
 
 class Unet2D_MS(nn.Module):
+    checkpoint_groups = CHECKPOINT_GROUPS
+
     def __init__(self, c=3, n=16, norm='bn', num_classes=2, activation='relu'):
         super(Unet2D_MS, self).__init__()
         self.convd1 = ConvD(c,     n, norm, first=True, activation=activation)
@@ -1,10 +1,15 @@
 """ Full assembly of the parts to form the complete network """
 
 from .unet_parts import *
+from .checkpointing import set_checkpointing
 
 
 class UNet(nn.Module):
-    def __init__(self, n_channels, n_classes, bilinear=False):
+    # blocks that can be checkpointed, see networks.checkpointing
+    checkpoint_groups = {'encoder': ['inc', 'down1', 'down2', 'down3', 'down4'],
+                         'decoder': ['up1', 'up2', 'up3', 'up4']}
+
+    def __init__(self, n_channels, n_classes, bilinear=False, checkpoint='none'):
         super(UNet, self).__init__()
         self.n_channels = n_channels
         self.n_classes = n_classes
@@ -21,6 +26,7 @@ class UNet(nn.Module):
         self.up3 = Up(256, 128 // factor, bilinear)
         self.up4 = Up(128, 64, bilinear)
         self.outc = OutConv(64, n_classes)
+        set_checkpointing(self, checkpoint)
 
     def forward(self, x, feature = False):
         x1 = self.inc(x)
@@ -4,8 +4,10 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from .checkpointing import Checkpointable
 
-class DoubleConv(nn.Module):
+
+class DoubleConv(Checkpointable, nn.Module):
     """(convolution => [BN] => ReLU) * 2"""
 
     def __init__(self, in_channels, out_channels, mid_channels=None):
@@ -22,10 +24,10 @@ class DoubleConv(nn.Module):
         )
 
     def forward(self, x):
-        return self.double_conv(x)
+        return self.checkpointed(self.double_conv, x)
 
 
-class Down(nn.Module):
+class Down(Checkpointable, nn.Module):
     """Downscaling with maxpool then double conv"""
 
     def __init__(self, in_channels, out_channels):
@@ -36,10 +38,10 @@ class Down(nn.Module):
         )
 
     def forward(self, x):
-        return self.maxpool_conv(x)
+        return self.checkpointed(self.maxpool_conv, x)
 
 
-class Up(nn.Module):
+class Up(Checkpointable, nn.Module):
     """Upscaling then double conv"""
 
     def __init__(self, in_channels, out_channels, bilinear=True):
@@ -54,13 +56,19 @@ class Up(nn.Module):
             self.conv = DoubleConv(in_channels, out_channels)
 
     def forward(self, x1, x2):
+        return self.checkpointed(self._forward, x1, x2)
+
+    def _forward(self, x1, x2):
         x1 = self.up(x1)
         # input is CHW
         diffY = x2.size()[2] - x1.size()[2]
         diffX = x2.size()[3] - x1.size()[3]
 
-        x1 = F.pad(x1, [diffX // 2, diffX - diffX // 2,
-                        diffY // 2, diffY - diffY // 2])
+        # sizes divisible by 16 need no padding; skipping the no-op pad keeps
+        # the traced graph free of it (shapes are static under torch.compile)
+        if diffX or diffY:
+            x1 = F.pad(x1, [diffX // 2, diffX - diffX // 2,
+                            diffY // 2, diffY - diffY // 2])
         # if you have padding issues, see
         # https://github.com/HaiyongJiang/U-Net-Pytorch-Unstructured-Buggy/commit/0e854509c2cea854e247a9c615f175f76fbb2e3a
         # https://github.com/xiaopeng-liao/Pytorch-UNet/commit/8ebac70e633bac59fc22bb5195e513d5832fb3bd
@@ -0,0 +1,34 @@
+# python sweep.py <grid.json> [--procs N]: run a grid of train.py flags on a pool of local processes; see trainer/sweep.py
+import argparse
+import json
+import logging
+import os
+import sys
+
+from trainer.sweep import ASHA, Sweep, format_table, to_argv
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('spec', type=str, help='json with grid, args and save_name')
+    parser.add_argument('--procs', type=int, default=1, help='runs at a time, each pinned to its share of the cores')
+    parser.add_argument('--gpus', type=str, default='', help='comma-separated gpus handed out to the process slots')
+    parser.add_argument('--out', type=str, default=None, help='sweep directory, ../model/sweep/<spec name> by default')
+    parser.add_argument('--rerun', action='store_true', help='also rerun cells that have a result')
+    parser.add_argument('--dry_run', action='store_true', help='only list the runs')
+    parser.add_argument('--asha', type=int, default=0, help='stop runs in the bottom of successive-halving rungs')
+    parser.add_argument('--asha_min_iter', type=int, default=3000, help='iterations of the first rung')
+    parser.add_argument('--asha_eta', type=int, default=3, help='rung growth factor, the top 1/eta of a rung continues')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(message)s', datefmt='%H:%M:%S', stream=sys.stdout)
+    with open(args.spec) as f:
+        spec = json.load(f)
+    out = args.out or os.path.join('..', 'model', 'sweep', os.path.splitext(os.path.basename(args.spec))[0])
+    asha = ASHA(args.asha_min_iter, args.asha_eta, path=os.path.join(out, 'asha.json')) if args.asha else None
+    sweep = Sweep(spec, out, procs=args.procs, gpus=[g for g in args.gpus.split(',') if g], rerun=args.rerun, asha=asha)
+    if args.dry_run:
+        for run in sweep.runs:
+            print(run.snapshot_path, ' '.join(to_argv(run.flags)))
+        sys.exit(0)
+    columns, rows = sweep.run()
+    print(format_table(columns, rows))
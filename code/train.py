@@ -0,0 +1,5 @@
+# python train.py --method <name> [flags]; see trainer/config.py for the presets
+from trainer import main
+
+if __name__ == '__main__':
+    main()
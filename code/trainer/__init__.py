@@ -0,0 +1,2 @@
+from .config import METHODS, get_parser, parse_args
+from .engine import Trainer, main
@@ -0,0 +1,134 @@
+""" Evaluation in a separate process, so that training keeps stepping while the test sets are evaluated """
+
+import queue
+import re
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader
+
+from networks.unet_model import UNet
+from .data import DATASETS, to_mask, probs_of, hard_label_of, seg_loss_of, build_datasets
+
+# evaluations in flight; submitting more waits for the oldest result
+MAX_PENDING = 2
+# seconds between liveness checks of the worker while waiting for a result
+POLL_INTERVAL = 5.0
+
+
+def snapshot(model):
+    """CPU copy of the weights of model, which goes on training, under the keys of a plain UNet."""
+    # torch.compile prefixes the keys of the module it wraps
+    return {re.sub(r'^_orig_mod\.', '', k): v.detach().to('cpu', memory_format=torch.contiguous_format, copy=True)
+            for k, v in model.state_dict().items()}
+
+
+def cache_test_sets(test_dataset, batch_size):
+    """Every test set as a list of (images, labels, dc) batches, loaded and augmented once.
+
+    Images are kept as the uint8 pixels Normalize_tf maps to [-1, 1], labels
+    as their uint8 values; both convert back exactly.
+    """
+    test_sets = []
+    for dataset in test_dataset:
+        batches = []
+        for sample in DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=0):
+            image = ((sample['image'] + 1) * 127.5).round().to(torch.uint8)
+            batches.append((image, sample['label'].to(torch.uint8), sample['dc'][0].item()))
+        test_sets.append(batches)
+    return test_sets
+
+
+@torch.no_grad()
+def evaluate_sets(model, test_sets, dataset, spec):
+    """(dc, loss, {'dice': per structure}) of every test set, averaged over its batches as Trainer.test does."""
+    task, n_part = spec['task'], len(spec['part'])
+    domains = []
+    for batches in test_sets:
+        dc, loss, dice_sum = -1, 0.0, [0.0] * n_part
+        for image, label, dc in batches:
+            data = image.float() / 127.5 - 1.0
+            mask = to_mask(dataset, label.float())
+            output = model(data)
+            loss += seg_loss_of(task, output, mask).mean().item()
+            pred = hard_label_of(task, probs_of(task, output))
+            dice = spec['dice'](np.asarray(pred), mask)
+            for i in range(n_part):
+                dice_sum[i] += dice[i]
+        domains.append((dc, loss / len(batches), {'dice': [d / len(batches) for d in dice_sum]}))
+    return domains
+
+
+def eval_worker(args, jobs, results):
+    """Process loop: evaluate the weight snapshots of every job on the cached test sets, on the cpu."""
+    torch.set_num_threads(max(1, args.eval_threads))
+    spec = DATASETS[args.dataset]
+    _, _, test_dataset = build_datasets(args, spec, train=False)
+    test_sets = cache_test_sets(test_dataset, args.test_bs)
+    model = UNet(n_channels=spec['num_channels'], n_classes=spec['num_classes'])
+    model.eval()
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        job_id, states = job
+        result = {}
+        for name, state in states.items():
+            model.load_state_dict(state)
+            result[name] = evaluate_sets(model, test_sets, args.dataset, spec)
+        del states, job
+        results.put((job_id, result))
+
+
+class AsyncEvaluator(object):
+    """Evaluates weight snapshots in a worker process while the trainer keeps stepping.
+
+    submit() takes CPU copies of the models, which a torch multiprocessing
+    queue hands to the worker through shared memory; the worker evaluates
+    them on its own cached copy of the test sets with --eval_threads threads
+    and sends back the per-domain results. Snapshots stay with their job until
+    its result is collected, so that a best model can still be saved.
+    """
+
+    def __init__(self, args):
+        ctx = mp.get_context('spawn')
+        self.jobs, self.results = ctx.Queue(), ctx.Queue()
+        self.process = ctx.Process(target=eval_worker, args=(args, self.jobs, self.results), daemon=True)
+        self.process.start()
+        self.pending = {}
+        self.next_id = 0
+
+    def submit(self, info, models):
+        """Evaluate snapshots of models (dict name -> module); info is returned with the results."""
+        states = {name: snapshot(model) for name, model in models.items()}
+        self.pending[self.next_id] = (info, states)
+        self.jobs.put((self.next_id, states))
+        self.next_id += 1
+
+    def poll(self, max_pending=None):
+        """Finished jobs as (info, states, results), oldest first.
+
+        Waits until at most max_pending jobs are left unfinished; None returns
+        what has finished already.
+        """
+        done = []
+        while self.pending:
+            block = max_pending is not None and len(self.pending) > max_pending
+            try:
+                job_id, result = self.results.get(timeout=POLL_INTERVAL) if block else self.results.get_nowait()
+            except queue.Empty:
+                if not block:
+                    break
+                if not self.process.is_alive():
+                    raise RuntimeError('the evaluation process exited with code {}'.format(self.process.exitcode))
+                continue
+            info, states = self.pending.pop(job_id)
+            done.append((info, states, result))
+        return done
+
+    def close(self):
+        self.jobs.put(None)
+        self.process.join(timeout=60)
+        if self.process.is_alive():
+            self.process.terminate()
@@ -0,0 +1,310 @@
+""" Pre-flight tuning of the batch sizes and the data loader worker count """
+
+import copy
+import ctypes
+import json
+import logging
+import math
+import os
+import time
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import DataLoader
+from torch.utils.data.dataloader import default_collate
+
+from utils.checkpoint import rng_state, set_rng_state
+
+AUTOTUNE_FILE = 'autotune.json'
+# share of the device memory (cuda) or of the available RAM (cpu) used when no budget is given
+AUTO_BUDGET = 0.85
+
+
+def _meminfo(key):
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith(key + ':'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def _proc_status(key):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(key + ':'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def _trim():
+    # hand freed heap pages back to the OS, so that an earlier larger trial does not inflate the RSS of the next one
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+class MemoryMeter(object):
+    """Peak memory of a block of work: allocator peak on cuda, peak RSS of the process on cpu."""
+
+    def __init__(self, device):
+        self.device = device
+        self.cuda = device.type == 'cuda'
+
+    def budget(self, world_size=1):
+        """Default budget of one process, a share of what is free on the device."""
+        if self.cuda:
+            return AUTO_BUDGET * torch.cuda.get_device_properties(self.device).total_memory
+        # the processes of one machine share its memory
+        return AUTO_BUDGET * (_proc_status('VmRSS') + _meminfo('MemAvailable') / world_size)
+
+    def reset(self):
+        if self.cuda:
+            torch.cuda.synchronize(self.device)
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats(self.device)
+            return
+        _trim()
+        try:
+            # '5' resets VmHWM, the peak RSS, to the current RSS (Linux >= 4.0)
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+        except OSError:
+            pass
+
+    def current(self):
+        if self.cuda:
+            return torch.cuda.memory_reserved(self.device)
+        return _proc_status('VmRSS')
+
+    def peak(self):
+        if self.cuda:
+            torch.cuda.synchronize(self.device)
+            return torch.cuda.max_memory_reserved(self.device)
+        return _proc_status('VmHWM')
+
+
+def _agree(values, op):
+    """The same decision on every rank: element-wise min or max of values over the process group."""
+    if not (dist.is_available() and dist.is_initialized()):
+        return values
+    t = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(t, op=dist.ReduceOp.MIN if op == 'min' else dist.ReduceOp.MAX)
+    return t.tolist()
+
+
+class SamplePool(object):
+    """Augmented samples of a dataset, drawn in order and reused to build batches of any size."""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.samples = []
+        self.load_time = 0.0
+
+    def batch(self, n):
+        while len(self.samples) < min(n, len(self.dataset)):
+            start = time.perf_counter()
+            self.samples.append(self.dataset[len(self.samples)])
+            self.load_time += time.perf_counter() - start
+        return default_collate([self.samples[i % len(self.samples)] for i in range(n)])
+
+    @property
+    def sample_time(self):
+        """Seconds to load and augment one sample in one process."""
+        return self.load_time / max(1, len(self.samples))
+
+
+class AutoTuner(object):
+    """Chooses --label_bs / --unlabel_bs and --num_workers for a Trainer before it trains.
+
+    Batch size: the labeled batch is doubled and then binary-searched, the
+    unlabeled batch follows at the ratio of the configured sizes. Every
+    candidate runs a few real train_steps (same model, execution mode, micro
+    batches, strategies and augmentations) and fits if its peak memory stays
+    within the budget. Sizes whose linear extrapolation from the largest
+    fitting one is well over budget are rejected without running, so a CPU
+    run never allocates far past the budget. Model, teacher, optimizer,
+    scaler, strategy and RNG states are restored afterwards.
+
+    Workers: one worker loads a batch in (batch size x per-sample time); the
+    count is the smallest that loads both batches of a step within the
+    measured step time, then raised while a loader with a consumer stepping at
+    that pace still has to wait on an empty prefetch queue.
+    """
+
+    def __init__(self, trainer, lb_dataset, ulb_dataset, budget=0, steps=2, max_workers=None):
+        self.trainer = trainer
+        self.args = trainer.args
+        self.meter = MemoryMeter(trainer.device)
+        world_size = trainer.world_size
+        self.budget = _agree([budget or self.meter.budget(world_size)], 'min')[0]
+        self.steps = max(1, steps)
+        if max_workers is None:
+            max_workers = max(1, (os.cpu_count() or 1) // world_size)
+        self.max_workers = max_workers
+        self.lb_pool, self.ulb_pool = SamplePool(lb_dataset), SamplePool(ulb_dataset)
+        # memory held before any step: model, optimizer, datasets
+        self.meter.reset()
+        self.base = _agree([self.meter.current()], 'max')[0]
+        # a loader never yields more than the shard of one rank
+        self.lb_cap = -(-len(lb_dataset) // world_size)
+        self.ulb_cap = -(-len(ulb_dataset) // world_size)
+        self.ratio = self.args.unlabel_bs / self.args.label_bs
+        # --replicas stacks this many batches of the tuned sizes
+        self.stack = trainer.replicas
+        self.results = {}
+
+    def sizes(self, n):
+        return min(n, self.lb_cap), max(1, min(round(n * self.ratio), self.ulb_cap))
+
+    def trial(self, n):
+        """Whether a labeled batch of n fits; (fits, peak bytes, seconds per step) go to self.results."""
+        trainer = self.trainer
+        lb_bs, ulb_bs = self.sizes(n)
+        lb_sample, ulb_sample = self.lb_pool.batch(lb_bs * self.stack), self.ulb_pool.batch(ulb_bs * self.stack)
+        self.meter.reset()
+        peak, step_time, oom = 0, 0.0, False
+        try:
+            for i in range(self.steps):
+                start = time.perf_counter()
+                trainer.train_step(lb_sample, ulb_sample, 0)
+                if self.meter.cuda:
+                    torch.cuda.synchronize(trainer.device)
+                step_time = time.perf_counter() - start
+            peak = self.meter.peak()
+        except torch.cuda.OutOfMemoryError:
+            oom = True
+        del lb_sample, ulb_sample
+        trainer.optimizer.zero_grad(set_to_none=True)
+        fits = 0.0 if oom or peak > self.budget else 1.0
+        # a size fits only if it fits on every rank, and the slowest rank sets the pace
+        not_fits, peak, step_time = _agree([-fits, peak, step_time], 'max')
+        fits = not_fits < 0
+        self.results[n] = (fits, peak, step_time)
+        logging.info('autotune: label_bs {} unlabel_bs {}: peak {:.2f} GB of {:.2f} GB, {:.3f} s/step{}'.format(
+            lb_bs, ulb_bs, peak / 2 ** 30, self.budget / 2 ** 30, step_time, ', out of memory' if oom else ''))
+        return fits
+
+    def too_big(self, n, best):
+        """Whether n is predicted to exceed the budget by a wide margin, from the peak of best."""
+        if best is None:
+            return False
+        peak = self.results[best][1]
+        return self.base + (peak - self.base) * n / best > 1.25 * self.budget
+
+    def search_batch(self):
+        best, fail = None, None
+        n = 1
+        while fail is None and (best is None or best < self.lb_cap):
+            if self.too_big(n, best) or not self.trial(n):
+                fail = n
+            else:
+                best = n
+                n = min(2 * n, self.lb_cap)
+        if best is None:
+            raise RuntimeError('a labeled batch of 1 does not fit in the memory budget of {:.2f} GB'.format(self.budget / 2 ** 30))
+        while fail is not None and fail - best > 1:
+            n = (best + fail) // 2
+            if self.too_big(n, best) or not self.trial(n):
+                fail = n
+            else:
+                best = n
+        return best
+
+    def consumer_wait(self, num_workers, step_time, lb_bs, ulb_bs, steps=8):
+        """Mean seconds a consumer stepping every step_time waits for the next pair of batches."""
+        loaders = [DataLoader(self.lb_pool.dataset, batch_size=lb_bs, shuffle=True, num_workers=num_workers, drop_last=False),
+                   DataLoader(self.ulb_pool.dataset, batch_size=ulb_bs, shuffle=True, num_workers=num_workers, drop_last=False)]
+        iters = [iter(loader) for loader in loaders]
+        # the first batches measure worker start-up and filling the queue, not the steady state
+        warmup = 2 * num_workers
+        waited = 0.0
+        try:
+            for i in range(warmup + steps):
+                start = time.perf_counter()
+                for k, it in enumerate(iters):
+                    try:
+                        next(it)
+                    except StopIteration:
+                        iters[k] = iter(loaders[k])
+                        next(iters[k])
+                if i >= warmup:
+                    waited += time.perf_counter() - start
+                time.sleep(step_time)
+        finally:
+            del iters
+        return waited / steps
+
+    def search_workers(self, n):
+        lb_bs, ulb_bs = self.sizes(n)
+        step_time = self.results[n][2]
+        load_time = max(lb_bs * self.lb_pool.sample_time, ulb_bs * self.ulb_pool.sample_time)
+        load_time *= self.stack
+        num_workers = min(self.max_workers, max(1, math.ceil(load_time / max(step_time, 1e-6))))
+        while True:
+            wait = _agree([self.consumer_wait(num_workers, step_time, lb_bs * self.stack, ulb_bs * self.stack)], 'max')[0]
+            logging.info('autotune: {} workers, {:.3f} s to load a batch pair in one process, {:.3f} s/step, {:.3f} s waiting per step'.format(
+                num_workers, load_time, step_time, wait))
+            if wait <= 0.1 * step_time or num_workers >= self.max_workers:
+                return num_workers
+            num_workers += 1
+
+    def run(self):
+        """Tune, restore the trainer and return dict(label_bs, unlabel_bs, num_workers)."""
+        trainer = self.trainer
+        saved = copy.deepcopy({
+            'model': trainer.model.state_dict(),
+            'ema_model': trainer.ema_model.state_dict(),
+            'optimizer': trainer.optimizer.state_dict(),
+            'scaler': trainer.scaler.state_dict(),
+            'da': trainer.da.state_dict() if trainer.da is not None else None,
+            'queue': trainer.queue.state_dict() if trainer.queue is not None else None,
+        })
+        iter_num, rng = trainer.iter_num, rng_state()
+        trainer.model.train()
+        trainer.ema_model.train()
+        try:
+            n = self.search_batch()
+            lb_bs, ulb_bs = self.sizes(n)
+            num_workers = self.search_workers(n)
+        finally:
+            trainer.model.load_state_dict(saved['model'])
+            trainer.ema_model.load_state_dict(saved['ema_model'])
+            trainer.optimizer.load_state_dict(saved['optimizer'])
+            trainer.scaler.load_state_dict(saved['scaler'])
+            if trainer.da is not None:
+                trainer.da.load_state_dict(saved['da'])
+            if trainer.queue is not None:
+                trainer.queue.load_state_dict(saved['queue'])
+            trainer.iter_num = iter_num
+            set_rng_state(rng)
+            if self.args.compile != 'none':
+                # every tried shape compiled a graph, training starts from a clean cache and recompile budget
+                torch.compiler.reset()
+            self.meter.reset()
+        return dict(label_bs=lb_bs, unlabel_bs=ulb_bs, num_workers=num_workers)
+
+
+def autotune(trainer, lb_dataset, ulb_dataset):
+    """Set args.label_bs / unlabel_bs / num_workers of trainer, tuned or read back from the snapshot path.
+
+    The chosen values are stored in <snapshot_path>/autotune.json; a --load run
+    reuses them, so that the data order of the checkpoint stays resumable.
+    """
+    args = trainer.args
+    path = os.path.join(trainer.snapshot_path, AUTOTUNE_FILE)
+    if args.load and os.path.exists(path):
+        with open(path) as f:
+            tuned = json.load(f)
+        logging.info('autotune: reusing {}'.format(path))
+    else:
+        tuned = AutoTuner(trainer, lb_dataset, ulb_dataset, budget=args.mem_budget * 2 ** 30,
+                          steps=args.autotune_steps).run()
+        if trainer.is_main:
+            with open(path, 'w') as f:
+                json.dump(tuned, f, indent=2)
+    for k, v in tuned.items():
+        setattr(args, k, v)
+    logging.info('autotune: label_bs {label_bs}, unlabel_bs {unlabel_bs}, num_workers {num_workers}'.format(**tuned))
+    logging.info(str(args))
+    return tuned
@@ -0,0 +1,166 @@
+import argparse
+
+from networks.execution import COMPILE_MODES
+
+# Each training script is a preset of strategy flags (argparse defaults);
+# any flag can still be overridden on the command line.
+BASE = dict(da=0, queue=0, cutmix='none', queue_loss=0, fda=0, data_root='../../data')
+METHODS = {
+    # simple-sample queue mixed into CutMix, with distribution alignment
+    'work': dict(da=1, queue=1, cutmix='mix', data_root='/data/qinghe/data',
+                 load_path='../model/prostate/pu_0.9probfda_lb{lb_domain}_r0.2_th0.9_v2/unet_dice_best_model.pth'),
+    # without distribution alignment
+    'work-DA': dict(queue=1, cutmix='mix'),
+    # without the simple-sample queue, CutMix from labeled images only
+    'work-queue': dict(da=1, cutmix='labeled'),
+    # queue samples trained directly instead of mixed into CutMix
+    'work-cutmix': dict(da=1, queue=1, queue_loss=1, data_root='/data/qinghe/data'),
+    # FixMatch on Fourier-domain-adapted labeled images
+    'work-FDA': dict(fda=1),
+    # FixMatch with CutMix from labeled images
+    'work-strongbaseline': dict(cutmix='labeled'),
+    # FixMatch
+    'work-weakbaseline': dict(),
+    # FixMatch / FixMatch + CutMix with a labeled ratio of the source domain
+    'upper_fixmatch': dict(lb_ratio=1.0),
+    'upper_fixmatch_cutmix': dict(cutmix='labeled', lb_ratio=1.0),
+    # evaluation of a trained model with surface distances and contour images
+    'work-eval': dict(eval=True, eval_surface=1, img_dir='./img/1',
+                      load_path='../model/{dataset}/work_lb4_qlen20_v2/unet_cup_dice_best_model.pth'),
+}
+
+
+def get_parser(method='work'):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--method', type=str, default=method, choices=list(METHODS),
+                        help='preset of the strategy flags below')
+    parser.add_argument('--dataset', type=str, default='prostate', choices=['fundus', 'prostate', 'MNMS'])
+    parser.add_argument('--data_root', type=str, help='directory holding Fundus / ProstateSlice / MNMS')
+    parser.add_argument('--data_cache', type=str, default=None, help='read decoded images from this cache (Fundus_dataloaders.cache.build_cache)')
+    parser.add_argument("--save_name", type=str, default="debug", help="experiment_name")
+    parser.add_argument("--overwrite", action='store_true')
+    parser.add_argument('--copy_code', type=int, default=1, help='copy the code tree into the snapshot path')
+    parser.add_argument("--model", type=str, default="unet", help="model_name")
+    parser.add_argument("--max_iterations", type=int, default=60000, help="maximum epoch number to train")
+    parser.add_argument('--num_eval_iter', type=int, default=500)
+    parser.add_argument('--log_interval', type=int, default=20,
+                        help='reduce train/ scalars, and refresh the progress bar text, over this many iterations')
+    parser.add_argument('--log_reduce', type=str, default='mean', choices=['mean', 'last'], help='average or subsample train/ scalars')
+    parser.add_argument("--deterministic", type=int, default=1, help="whether use deterministic training")
+    parser.add_argument("--base_lr", type=float, default=0.03, help="segmentation network learning rate")
+    parser.add_argument("--lr_schedule", type=str, default='poly', choices=['poly', 'cosine'], help="precomputed learning rate schedule")
+    parser.add_argument("--optim_impl", type=str, default='foreach', choices=['for', 'foreach', 'fused'], help="SGD kernel implementation")
+    parser.add_argument("--wd_skip_bn", type=int, default=0, help="no weight decay on normalization parameters and biases")
+    parser.add_argument("--seed", type=int, default=1337, help="random seed")
+    parser.add_argument("--gpu", type=str, default='0')
+    parser.add_argument('--device', type=str, default='auto', choices=['auto', 'cuda', 'cpu'], help='auto: cuda if available, else cpu')
+    parser.add_argument('--threads', type=int, default=0, help='intra-op threads per process on cpu, 0 to share the cores between processes')
+    parser.add_argument('--world_size', type=int, default=1, help='number of local data-parallel processes')
+    parser.add_argument('--dist_backend', type=str, default='gloo', choices=['gloo', 'nccl'], help='gloo for CPU, nccl for GPU processes')
+    parser.add_argument('--dist_port', type=int, default=12355)
+    parser.add_argument('--load', action='store_true', help='resume from the latest train_state checkpoint in the snapshot path')
+    parser.add_argument('--ckpt_every', type=int, default=1, help='save the full training state every n epochs, 0 to disable')
+    parser.add_argument('--ckpt_keep_last', type=int, default=1, help='number of newest training-state checkpoints to keep')
+    parser.add_argument('--ckpt_keep_best', type=int, default=0, help='also keep the n best checkpoints of every structure as *_iter_<n>.pth')
+    parser.add_argument('--eval', action='store_true', help='only evaluate the model at --load_path')
+    parser.add_argument('--load_path', type=str, default='../model/lb1_ratio0.2/iter_6000.pth',
+                        help='model evaluated by --eval, may contain {dataset} and {lb_domain}')
+    parser.add_argument('--eval_surface', type=int, default=0, help='also report hd95 and asd in evaluation')
+    parser.add_argument('--img_dir', type=str, default=None, help='save contour images of every test sample here in --eval')
+    parser.add_argument("--threshold", type=float, default=0.9, help="confidence threshold for using pseudo-labels",)
+    parser.add_argument('--conf_floor', type=float, default=0.0,
+                        help='skip the student pass on the strong view of unlabeled samples with a smaller share of confident pixels '
+                             '(syncs with the device every step; BN statistics come from the kept samples)')
+
+    parser.add_argument('--amp', type=int, default=1, help='use mixed precision training or not')
+    parser.add_argument('--amp_dtype', type=str, default='auto', choices=['auto', 'fp16', 'bf16'],
+                        help='auto: fp16 with loss scaling on cuda, bf16 on cpus with native bf16 support (else fp32)')
+    parser.add_argument('--fused_forward', type=int, default=0, help='run the student once over the labeled and strong unlabeled views')
+    parser.add_argument('--dice_loss', type=float, default=0.0,
+                        help='weight of a soft Dice loss added to the supervised loss (sigmoid or softmax, as the dataset)')
+    parser.add_argument('--fused_loss', type=int, default=0,
+                        help='masked consistency losses of sigmoid tasks without full-size temporaries (utils.losses.masked_bce)')
+    parser.add_argument('--act_checkpoint', type=str, default='none', choices=['none', 'encoder', 'decoder', 'all'],
+                        help='recompute the activations of these student UNet blocks in backward to save memory')
+    parser.add_argument('--channels_last', type=int, default=0, help='keep weights and input images of the models in NHWC memory format')
+    parser.add_argument('--compile', type=str, default='none', choices=COMPILE_MODES,
+                        help='torch.compile mode of the student and teacher forwards (static shapes)')
+    parser.add_argument('--fused_bn', type=str, default='split', choices=['split', 'joint'],
+                        help='split: per-view BN statistics as in separate forwards; joint: BN statistics over the packed batch')
+
+    parser.add_argument("--label_bs", type=int, default=None, help="labeled_batch_size per gpu, default per dataset")
+    parser.add_argument("--unlabel_bs", type=int, default=None, help="unlabeled_batch_size per gpu, default per dataset")
+    parser.add_argument("--micro_batches", type=int, default=1, help="split every batch into chunks and accumulate their gradients")
+    parser.add_argument('--replicas', type=int, default=1,
+                        help='train this many UNets (seeds seed + k, own data orders) in one process with stacked weights')
+    parser.add_argument("--test_bs", type=int, default=4)
+    parser.add_argument('--test_workers', type=int, default=2, help='data loader workers of each test domain, kept alive between evaluations')
+    parser.add_argument('--eval_subset', type=int, default=0,
+                        help='samples per test domain in intermediate evaluations, 0 to always evaluate on the full test sets')
+    parser.add_argument('--eval_margin', type=float, default=0.0,
+                        help='fully evaluate when the subset dice of a structure is within this of its best subset dice')
+    parser.add_argument('--eval_adaptive', type=int, default=0, help='evaluate more often while the dice changes fast, less often on a plateau')
+    parser.add_argument('--eval_max_interval', type=int, default=8, help='longest interval between evaluations with --eval_adaptive, in epochs')
+    parser.add_argument('--eval_plateau', type=float, default=0.002, help='mean dice change per epoch below which the interval doubles')
+    parser.add_argument('--eval_fast', type=float, default=0.01, help='mean dice change per epoch above which the interval halves')
+    parser.add_argument('--async_eval', type=int, default=0,
+                        help='evaluate weight snapshots in a separate cpu process while training goes on (evaluations in flight are lost on a restart)')
+    parser.add_argument('--eval_threads', type=int, default=2, help='threads of the --async_eval process')
+    parser.add_argument('--num_workers', type=int, default=2, help='data loader workers of each training stream')
+    parser.add_argument('--autotune', type=int, default=0,
+                        help='choose label_bs / unlabel_bs (same ratio) and num_workers with a few trial steps before training')
+    parser.add_argument('--mem_budget', type=float, default=0,
+                        help='GB of memory per process --autotune may use, 0 for a share of the device memory / available RAM')
+    parser.add_argument('--autotune_steps', type=int, default=2, help='train steps per batch size tried by --autotune')
+    parser.add_argument('--domain_num', type=int, default=6)
+    parser.add_argument('--lb_domain', type=int, default=1)
+    parser.add_argument('--lb_num', type=int, default=40)
+    parser.add_argument('--lb_ratio', type=float, default=None, help='label this ratio of the source domain instead of --lb_num')
+    # costs
+    parser.add_argument("--ema_decay", type=float, default=0.99, help="ema_decay")
+    parser.add_argument("--ema_interval", type=int, default=1, help="update the ema teacher every n iterations")
+    parser.add_argument("--ema_buffers", type=str, default='none', choices=['none', 'copy', 'ema'], help="how the ema teacher tracks student BN buffers")
+    parser.add_argument("--ema_dtype", type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'], help="precision of the ema teacher weights")
+    parser.add_argument('--teacher_cache', type=int, default=0,
+                        help='cache teacher predictions of the un-augmented unlabeled images and warp them to each augmented view')
+    parser.add_argument('--teacher_cache_age', type=int, default=200,
+                        help='iterations after which a cached teacher prediction is stale and recomputed')
+    parser.add_argument('--teacher_cache_warmup', type=int, default=1000,
+                        help='iterations during which the teacher always runs, while it still changes fast')
+    parser.add_argument('--pseudo_store', type=int, default=0,
+                        help='label the whole unlabeled pool with the teacher once per epoch and train on the stored pseudo-labels')
+    parser.add_argument('--pseudo_store_bs', type=int, default=32, help='inference batch size of --pseudo_store')
+    parser.add_argument("--consistency_type", type=str, default="mse", help="consistency_type")
+    parser.add_argument("--consistency", type=float, default=1.0, help="consistency")
+    parser.add_argument("--consistency_rampup", type=float, default=200.0, help="consistency_rampup")
+
+    parser.add_argument('--depth', type=int, default=28)
+    parser.add_argument('--widen_factor', type=int, default=2)
+    parser.add_argument('--leaky_slope', type=float, default=0.1)
+    parser.add_argument('--bn_momentum', type=float, default=0.1)
+    parser.add_argument('--dropout', type=float, default=0.0)
+
+    parser.add_argument("--beta", default=1.0, type=float)
+    parser.add_argument("--cutmix_prob", default=1.0, type=float)
+    parser.add_argument("--test_stu", default=True, action='store_true')
+
+    parser.add_argument("--increase", default=1.0005, type=float)
+    parser.add_argument("--queue_len", default=10, type=int)
+    parser.add_argument("--save_image", action='store_true')
+    # strategies
+    parser.add_argument('--da', type=int, help='distribution alignment of the teacher predictions')
+    parser.add_argument('--queue', type=int, help='keep a queue of simple (teacher-student agreeing) unlabeled samples')
+    parser.add_argument('--cutmix', type=str, choices=['none', 'labeled', 'mix'],
+                        help='CutMix source: labeled images, or labeled images and the simple-sample queue')
+    parser.add_argument('--queue_loss', type=int, help='train on queue samples with their pseudo-labels directly')
+    parser.add_argument('--fda', type=int, help='Fourier domain adaptation of labeled images to unlabeled styles')
+    parser.add_argument("--LB", type=float, default=0.01, help="beta for FDA")
+    parser.set_defaults(**BASE)
+    parser.set_defaults(**METHODS[method])
+    return parser
+
+
+def parse_args(method='work', argv=None):
+    """Parse argv with the defaults of method; --method switches to another preset."""
+    args, _ = get_parser(method).parse_known_args(argv)
+    return get_parser(args.method).parse_args(argv)
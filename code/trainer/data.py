@@ -0,0 +1,174 @@
+import copy
+import os
+
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, Subset
+from torchvision import transforms
+
+from Fundus_dataloaders.fundus_dataloader import FundusSegmentation, ProstateSegmentation, MNMSSegmentation
+import Fundus_dataloaders.custom_transforms as tr
+from Fundus_dataloaders.cache import use_cache
+from utils import metrics, util
+
+# task 'binary': one sigmoid channel per structure; 'softmax': structures + background
+DATASETS = {
+    'fundus': dict(dataset=FundusSegmentation, folder='Fundus', part=['cup', 'disc'], task='binary',
+                   num_channels=3, patch_size=256, num_classes=2, label_bs=2, unlabel_bs=8,
+                   min_v=0.5, max_v=1.5, fillcolor=255, domain_num=4, domain_len=[50, 99, 320, 320],
+                   dice=metrics.dice_coeff_2label, colors=[(255, 0, 0), (0, 255, 0)]),
+    'prostate': dict(dataset=ProstateSegmentation, folder='ProstateSlice', part=['base'], task='binary',
+                     num_channels=1, patch_size=384, num_classes=1, label_bs=2, unlabel_bs=4,
+                     min_v=0.1, max_v=2, fillcolor=255, domain_num=6, domain_len=[225, 305, 136, 373, 338, 133],
+                     dice=metrics.dice_coeff, colors=[(0, 255, 0)]),
+    'MNMS': dict(dataset=MNMSSegmentation, folder='MNMS/mnms_split_2D_ROI', part=['lv', 'myo', 'rv'], task='softmax',
+                 num_channels=1, patch_size=224, num_classes=4, label_bs=2, unlabel_bs=8,
+                 min_v=0.1, max_v=2, fillcolor=0, domain_num=4, domain_len=[976, 1261, 505, 523],
+                 dice=metrics.dice_coeff_3label, colors=[(255, 0, 0), (0, 255, 0), (255, 255, 0)]),
+}
+
+
+def to_mask(dataset, label):
+    """Raw label batch -> float target of shape (B, C, H, W)."""
+    if dataset == 'fundus':
+        return torch.cat((label.eq(0).float(), label.le(128).float()), dim=1)
+    elif dataset == 'prostate':
+        return label.eq(0).float()
+    elif dataset == 'MNMS':
+        lv = label[:, 0, ...].eq(255).float()
+        myo = label[:, 1, ...].eq(255).float()
+        rv = label[:, 2, ...].eq(255).float()
+        return torch.stack((lv, myo, rv, 1 - (lv + myo + rv)), dim=1)
+
+
+# task-specific pieces: sigmoid per structure or softmax over structures + background
+def probs_of(task, logits):
+    return logits.sigmoid() if task == 'binary' else F.softmax(logits, dim=1)
+
+
+def hard_label_of(task, prob):
+    if task == 'binary':
+        return prob.ge(0.5).float()
+    max_prob, _ = torch.max(prob, dim=1, keepdim=True)
+    return (prob == max_prob).float()
+
+
+def seg_loss_of(task, logits, target):
+    """Unreduced loss, (B, C, H, W) for sigmoid and (B, 1, H, W) for softmax outputs."""
+    logits = logits.float()
+    if task == 'binary':
+        return F.binary_cross_entropy_with_logits(logits, target, reduction='none')
+    return F.cross_entropy(logits, torch.argmax(target, dim=1), reduction='none').unsqueeze(1)
+
+
+def build_transforms(spec, track_geometry=False):
+    patch_size = spec['patch_size']
+    # with track_geometry every sample also carries its un-augmented image and the pixel mapping of the weak view
+    weak = [
+        tr.RandomScaleCrop(patch_size),
+        tr.RandomScaleRotate(fillcolor=spec['fillcolor']),
+        tr.RandomHorizontalFlip(),
+        tr.elastic_transform(),
+    ]
+    if track_geometry:
+        weak = [tr.TrackGeometry()] + weak
+    weak = transforms.Compose(weak)
+    strong = transforms.Compose([
+        tr.Brightness(spec['min_v'], spec['max_v']),
+        tr.Contrast(spec['min_v'], spec['max_v']),
+        tr.GaussianBlur(kernel_size=int(0.1 * patch_size), num_channels=spec['num_channels']),
+    ])
+    normal_toTensor = transforms.Compose([
+        tr.Normalize_tf(),
+        tr.ToTensor()
+    ])
+    return weak, strong, normal_toTensor
+
+
+def build_datasets(args, spec, train=True, ulb_field=None):
+    """Labeled and unlabeled training sets (None if not train) and one test set per domain.
+
+    ulb_field, a transform adding fields to the un-augmented unlabeled
+    samples (trainer.pseudo_store), runs before their weak transform.
+    """
+    dataset = spec['dataset']
+    base_dir = os.path.join(args.data_root, spec['folder'])
+    # loader workers fork after this and share the mapped cache
+    use_cache(args.data_cache)
+    weak, strong, normal_toTensor = build_transforms(spec)
+    ulb_weak = build_transforms(spec, track_geometry=True)[0] if args.teacher_cache else weak
+    if ulb_field is not None:
+        ulb_weak = transforms.Compose([ulb_field, ulb_weak])
+    domain = list(range(1, args.domain_num + 1))
+    lb_domain = args.lb_domain
+    data_num = spec['domain_len'][lb_domain - 1]
+    if args.lb_ratio is not None:
+        lb_num = round(data_num * args.lb_ratio)
+    else:
+        lb_num = args.lb_num
+    lb_idxs = list(range(lb_num))
+    unlabeled_idxs = list(range(lb_num, data_num))
+    lb_dataset, ulb_dataset = None, None
+    if train:
+        lb_dataset = dataset(base_dir=base_dir, phase='train', splitid=lb_domain, domain=[lb_domain],
+                             selected_idxs=lb_idxs, weak_transform=weak, normal_toTensor=normal_toTensor)
+        ulb_dataset = dataset(base_dir=base_dir, phase='train', splitid=lb_domain, domain=domain,
+                              selected_idxs=unlabeled_idxs, weak_transform=ulb_weak, strong_tranform=strong, normal_toTensor=normal_toTensor)
+    test_dataset = [dataset(base_dir=base_dir, phase='test', splitid=-1, domain=[i], normal_toTensor=normal_toTensor)
+                    for i in domain]
+    return lb_dataset, ulb_dataset, test_dataset
+
+
+def build_loaders(args, lb_dataset, ulb_dataset, test_dataset):
+    """Endless, resumable training iterators and the per-domain test loaders."""
+    # page-locked batches only help host-to-GPU copies
+    pin = args.device == 'cuda'
+    lb_dataloader, ulb_dataloader = None, None
+    if lb_dataset is not None and args.replicas > 1:
+        # one loader feeds all replicas, each with its own data order
+        lb_dataloader = util.ResumableCycle(DataLoader(lb_dataset, batch_size=args.label_bs * args.replicas,
+                                                       sampler=util.StackedSampler(lb_dataset, args.label_bs, args.replicas, seed=args.seed, num_replicas=args.world_size, rank=args.rank),
+                                                       num_workers=args.num_workers, pin_memory=pin, drop_last=False))
+        ulb_dataloader = util.ResumableCycle(DataLoader(ulb_dataset, batch_size=args.unlabel_bs * args.replicas,
+                                                        sampler=util.StackedSampler(ulb_dataset, args.unlabel_bs, args.replicas, seed=args.seed, num_replicas=args.world_size, rank=args.rank),
+                                                        num_workers=args.num_workers, pin_memory=pin, drop_last=False))
+    elif lb_dataset is not None:
+        # sample order is a function of (seed, pass, position) so that --load resumes it exactly;
+        # every rank takes its own shard of both streams
+        lb_dataloader = util.ResumableCycle(DataLoader(lb_dataset, batch_size=args.label_bs, sampler=util.ResumableSampler(lb_dataset, seed=args.seed, num_replicas=args.world_size, rank=args.rank),
+                                                       num_workers=args.num_workers, pin_memory=pin, drop_last=False))
+        ulb_dataloader = util.ResumableCycle(DataLoader(ulb_dataset, batch_size=args.unlabel_bs, sampler=util.ResumableSampler(ulb_dataset, seed=args.seed, num_replicas=args.world_size, rank=args.rank),
+                                                        num_workers=args.num_workers, pin_memory=pin, drop_last=False))
+    test_dataloader = [test_loader(args, d) for d in test_dataset]
+    return lb_dataloader, ulb_dataloader, test_dataloader
+
+
+def test_loader(args, dataset):
+    # workers are kept alive between evaluations instead of being forked for each one
+    return DataLoader(dataset, batch_size=args.test_bs, shuffle=False, num_workers=args.test_workers,
+                      pin_memory=args.device == 'cuda', persistent_workers=args.test_workers > 0)
+
+
+def build_pool_loader(args, ulb_dataset, batch_size):
+    """Loader over the un-augmented images of ulb_dataset, in order, this rank's share of them."""
+    pool = copy.copy(ulb_dataset)
+    pool.weak_transform, pool.strong_transform = None, None
+    if args.world_size > 1:
+        pool = Subset(pool, list(range(args.rank, len(pool), args.world_size)))
+    return DataLoader(pool, batch_size=batch_size, shuffle=False, num_workers=args.test_workers,
+                      pin_memory=args.device == 'cuda', persistent_workers=args.test_workers > 0)
+
+
+def build_subset_loaders(args, test_dataset, size):
+    """Test loaders over a fixed random subset of size samples of every domain (all of a smaller domain).
+
+    The subset is drawn once from args.seed, so that intermediate evaluations
+    stay comparable with each other.
+    """
+    g = torch.Generator()
+    g.manual_seed(args.seed)
+    loaders = []
+    for d in test_dataset:
+        idxs = sorted(torch.randperm(len(d), generator=g)[:size].tolist())
+        loaders.append(test_loader(args, Subset(d, idxs)))
+    return loaders
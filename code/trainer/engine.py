@@ -0,0 +1,1018 @@
+import contextlib
+import functools
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+
+import numpy as np
+import torch
+import torch.backends.cudnn as cudnn
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn.functional as F
+from tqdm import tqdm
+
+from networks.unet_model import UNet
+from networks.split_bn import fused_forward
+from networks.stacked import Stacked
+from networks.execution import memory_format, set_execution_mode
+from utils import ramps, util
+from utils.ema import ModelEMA
+from utils.losses import DiceLoss, masked_bce
+from utils.optimizer import get_SGD, get_lr_table, set_lr
+from utils.writer import AsyncSummaryWriter, NullWriter
+from utils.vis import Visualizer, image_u8, mask_u8
+from utils.checkpoint import rng_state, set_rng_state, latest_train_state, load_train_state, CheckpointManager
+from .config import parse_args
+from .data import DATASETS, to_mask, probs_of, hard_label_of, seg_loss_of, build_datasets, build_loaders, build_subset_loaders, build_pool_loader
+from .autotune import autotune
+from .async_eval import MAX_PENDING, AsyncEvaluator
+from .schedule import EvalSchedule
+from .pseudo_store import STORE_DIR, PseudoLabelStore, pack, unpack
+from .strategies import DistAlign, SimpleSampleQueue, CutMix, FDA, TeacherCache
+
+
+RESULT_FILE = 'result.json'
+# one line per validation, read by trainer.sweep to stop losing runs early
+PROGRESS_FILE = 'progress.jsonl'
+# written by trainer.sweep to change the thread count of a running process
+CONTROL_FILE = 'control.json'
+
+
+def autocast_dtype(args, device):
+    """Mixed-precision dtype for device, or None to run in fp32."""
+    if not args.amp:
+        return None
+    if args.amp_dtype != 'auto':
+        return {'fp16': torch.float16, 'bf16': torch.bfloat16}[args.amp_dtype]
+    if device.type == 'cuda':
+        return torch.float16
+    # bf16 only pays off on CPUs with native support (AVX512-BF16 / AMX), otherwise it is emulated
+    if torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported():
+        return torch.bfloat16
+    return None
+
+
+def sample_panels(image, label, pred):
+    # input image, then ground truth and prediction of every structure
+    panels = [('image', image_u8(image))]
+    for c in range(len(label) if pred is None else min(len(label), len(pred))):
+        panels += [('mask', mask_u8(label[c])), ('mask', mask_u8(pred[c]))]
+    return panels
+
+
+def surface_distance(pred, mask, n_part):
+    """Batch mean of hd95 and asd per structure, 100 for an empty prediction."""
+    from medpy.metric import binary
+
+    hd, asd = [0.0] * n_part, [0.0] * n_part
+    for j in range(len(pred)):
+        for i in range(n_part):
+            if pred[j, i].sum() < 1e-4:
+                hd[i] += 100
+                asd[i] += 100
+            else:
+                hd[i] += binary.hd95(pred[j, i].astype(bool), mask[j, i].astype(bool))
+                asd[i] += binary.asd(pred[j, i].astype(bool), mask[j, i].astype(bool))
+    return [h / len(pred) for h in hd], [a / len(pred) for a in asd]
+
+
+class Trainer(object):
+    """Mean-teacher FixMatch training shared by all methods.
+
+    The step loop is the same for every method; what differs is chosen by the
+    strategy flags of trainer.config (distribution alignment, simple-sample
+    queue, CutMix source, queue loss, FDA), so optimizations of the loop apply
+    to every method at once.
+
+    With world_size > 1 every process trains on its own shard of both streams
+    and gradients are averaged with one all_reduce after backward (not DDP: the
+    student runs several forwards per backward). Students, and therefore the
+    EMA teachers, stay identical on all ranks; the queue, distribution
+    alignment and BN statistics are per rank. Logging, validation and
+    checkpoints happen on rank 0, whose BN buffers are broadcast every epoch.
+    """
+
+    def __init__(self, args, snapshot_path):
+        self.args = args
+        self.snapshot_path = snapshot_path
+        self.rank, self.world_size = args.rank, args.world_size
+        self.is_main = self.rank == 0
+        if args.device == 'cuda':
+            self.device = torch.device('cuda', self.rank if self.world_size > 1 else 0)
+        else:
+            self.device = torch.device(args.device)
+        spec = self.spec = DATASETS[args.dataset]
+        self.part = spec['part']
+        self.n_part = len(self.part)
+        self.num_classes = spec['num_classes']
+        self.patch_size = spec['patch_size']
+        self.task = spec['task']
+        self.dice = spec['dice']
+        if args.label_bs is None:
+            args.label_bs = spec['label_bs']
+        if args.unlabel_bs is None:
+            args.unlabel_bs = spec['unlabel_bs']
+        args.domain_num = min(args.domain_num, spec['domain_num'])
+        if self.task != 'binary' and (args.da or args.queue or args.queue_loss):
+            raise ValueError('distribution alignment and the simple-sample queue need sigmoid outputs, '
+                             'not supported on {}'.format(args.dataset))
+
+        if self.is_main:
+            self.writer = AsyncSummaryWriter(snapshot_path + '/log', interval=args.log_interval, reduce=args.log_reduce)
+            self.vis = Visualizer(self.writer if args.save_image or args.eval else None)
+            self.ckpt = CheckpointManager(snapshot_path, keep_last=args.ckpt_keep_last, keep_best=args.ckpt_keep_best)
+        else:
+            self.writer, self.vis, self.ckpt = NullWriter(), Visualizer(), None
+
+        if args.fused_loss and self.task == 'binary' and args.threshold <= 0.5:
+            # the two sides of the binary confidence mask overlap and weigh a pixel twice, masked_bce takes it as a flag
+            raise ValueError('--fused_loss needs --threshold above 0.5, got {}'.format(args.threshold))
+
+        self.pseudo_store = None
+        if args.pseudo_store and not args.eval:
+            if args.da or args.teacher_cache:
+                raise ValueError('--pseudo_store keeps hard labels only, it does not combine with --da or --teacher_cache')
+            self.pseudo_store = PseudoLabelStore(os.path.join(snapshot_path, STORE_DIR), self.num_classes, self.task)
+        lb_dataset, ulb_dataset, test_dataset = build_datasets(args, spec, train=not args.eval, ulb_field=self.pseudo_store)
+
+        if args.compile != 'none' and args.act_checkpoint != 'none':
+            raise ValueError('--compile does not trace through --act_checkpoint blocks, use one of them')
+        # --eval loads one plain UNet
+        self.replicas = 1 if args.eval else max(1, args.replicas)
+        if self.replicas > 1:
+            unsupported = [flag for flag in ['da', 'queue', 'queue_loss', 'fused_forward', 'channels_last', 'teacher_cache', 'pseudo_store', 'async_eval', 'conf_floor', 'dice_loss'] if getattr(args, flag)]
+            unsupported += [flag for flag in ['act_checkpoint', 'compile'] if getattr(args, flag) != 'none']
+            if unsupported:
+                raise ValueError('--replicas does not support {}'.format(', '.join('--' + f for f in unsupported)))
+        self.memory_format = memory_format(args.channels_last)
+        self.model = self.create_model()
+        self.ema_model = self.create_model(ema=True)
+        if self.world_size > 1:
+            util.broadcast_module(self.model)
+            util.broadcast_module(self.ema_model)
+        self.ema = ModelEMA(self.model, self.ema_model, args.ema_decay, interval=args.ema_interval,
+                            buffers=args.ema_buffers, shadow_dtype=args.ema_dtype)
+        self.optimizer = get_SGD(self.model, lr=args.base_lr, momentum=0.9, weight_decay=0.0001, nesterov=False,
+                                 bn_wd_skip=args.wd_skip_bn, impl=args.optim_impl)
+        self.optimizer_params = [p for group in self.optimizer.param_groups for p in group['params']]
+        self.lr_table = get_lr_table(args.base_lr, args.max_iterations, args.lr_schedule)
+        # bf16 has the fp32 exponent range, only fp16 needs loss scaling
+        self.amp_dtype = autocast_dtype(args, self.device)
+        self.scaler = torch.amp.GradScaler(self.device.type, enabled=self.amp_dtype == torch.float16)
+        if self.amp_dtype is None:
+            self.amp_cm = contextlib.nullcontext
+        else:
+            self.amp_cm = functools.partial(torch.autocast, self.device.type, dtype=self.amp_dtype)
+
+        self.dice_loss = DiceLoss(self.num_classes, sigmoid=self.task == 'binary') if args.dice_loss else None
+        self.da = DistAlign(self.n_part) if args.da else None
+        self.queue = None
+        if args.queue or args.queue_loss:
+            self.queue = SimpleSampleQueue(self.n_part, args.domain_num, self.dice, max_len=args.queue_len, increase=args.increase)
+        self.cutmix = None
+        if args.cutmix != 'none':
+            self.cutmix = CutMix(self.patch_size, args.cutmix_prob, queue=self.queue if args.cutmix == 'mix' else None)
+        self.fda = FDA(args.LB) if args.fda else None
+        # unlabeled samples skipped by --conf_floor and seen, this epoch
+        self.ulb_skipped, self.ulb_seen = 0, 0
+        self.teacher_cache = TeacherCache(args.teacher_cache_age) if args.teacher_cache and not args.eval else None
+
+        self.pseudo_iter = None
+        if self.pseudo_store is not None:
+            self.pool_dataloader = build_pool_loader(args, ulb_dataset, args.pseudo_store_bs)
+            keys = list(zip(ulb_dataset.img_domain_code_pool, ulb_dataset.img_name_pool))
+            # un-augmented, the size every stored map has
+            shape = self.pool_dataloader.dataset[0]['image'].shape[-2:]
+            if self.is_main:
+                self.pseudo_store.allocate(keys, shape)
+            if self.world_size > 1:
+                dist.barrier()
+            if not self.is_main:
+                self.pseudo_store.allocate(keys, shape, create=False)
+            # trial steps of the tuner load stored pseudo-labels too
+            self.refresh_pseudo_labels()
+
+        # the loaders take the batch sizes and worker count, which the tuner may change
+        if args.autotune and not args.eval:
+            autotune(self, lb_dataset, ulb_dataset)
+        self.lb_dataloader, self.ulb_dataloader, self.test_dataloader = build_loaders(args, lb_dataset, ulb_dataset, test_dataset)
+        self.test_subset_dataloader = None
+        if args.eval_subset and not args.eval:
+            self.test_subset_dataloader = build_subset_loaders(args, test_dataset, args.eval_subset)
+
+        self.iter_num = 0
+        self.start_epoch = 0
+        self.max_epoch = args.max_iterations // args.num_eval_iter
+        self.best_dice = [0.0] * self.n_part
+        self.best_dice_iter = [-1] * self.n_part
+        self.stu_best_dice = [0.0] * self.n_part
+        self.stu_best_dice_iter = [-1] * self.n_part
+        # per replica with --replicas; best_dice / stu_best_dice then hold their means
+        self.replica_best = [[0.0] * self.n_part for k in range(self.replicas)]
+        self.replica_best_iter = [[-1] * self.n_part for k in range(self.replicas)]
+        self.replica_stu_best = [[0.0] * self.n_part for k in range(self.replicas)]
+        self.replica_stu_best_iter = [[-1] * self.n_part for k in range(self.replicas)]
+        self.async_eval = None
+        if args.async_eval and not args.eval:
+            if args.eval_subset:
+                raise ValueError('--async_eval evaluates the full test sets, it does not combine with --eval_subset')
+            if self.is_main:
+                self.async_eval = AsyncEvaluator(args)
+        self.eval_schedule = EvalSchedule(self.n_part, self.max_epoch, adaptive=args.eval_adaptive, max_interval=args.eval_max_interval,
+                                          plateau=args.eval_plateau, fast=args.eval_fast, margin=args.eval_margin)
+
+        rng = None
+        if args.load and not args.eval:
+            rng = self.resume()
+        if rng is not None:
+            # last, so that nothing above consumes random numbers after the restore
+            set_rng_state(rng)
+
+    def create_model(self, ema=False):
+        # Network definition
+        if self.args.model == 'unet' and self.replicas > 1:
+            nets = []
+            for k in range(self.replicas):
+                # replica k is initialized from seed + k, without touching the global RNG
+                with torch.random.fork_rng(devices=[]):
+                    torch.manual_seed(self.args.seed + k)
+                    nets.append(UNet(n_channels=self.spec['num_channels'], n_classes=self.num_classes))
+            model = Stacked(nets)
+        elif self.args.model == 'unet':
+            model = UNet(n_channels=self.spec['num_channels'], n_classes=self.num_classes,
+                         checkpoint='none' if ema else self.args.act_checkpoint)
+        if ema:
+            for param in model.parameters():
+                param.detach_()
+        model.to(self.device)
+        return set_execution_mode(model, channels_last=self.args.channels_last, compile=self.args.compile)
+
+    # task-specific pieces: sigmoid per structure or softmax over structures + background
+    def probs(self, logits):
+        return probs_of(self.task, logits)
+
+    def hard_label(self, prob):
+        return hard_label_of(self.task, prob)
+
+    def confidence_mask(self, prob, threshold):
+        if self.task == 'binary':
+            return prob.ge(threshold).float() + prob.le(1 - threshold).float()
+        max_prob, _ = torch.max(prob, dim=1, keepdim=True)
+        return max_prob.ge(threshold).float()
+
+    def seg_loss(self, logits, target):
+        """Unreduced loss, (B, C, H, W) for sigmoid and (B, 1, H, W) for softmax outputs."""
+        return seg_loss_of(self.task, logits, target)
+
+    def masked_loss(self, logits, target, mask):
+        """Mean over all elements of the loss masked by a confidence mask."""
+        if self.task == 'binary' and self.args.fused_loss:
+            return masked_bce(logits, target, mask)
+        return (self.seg_loss(logits, target) * mask).mean()
+
+    def mask_shape(self, batch):
+        return [len(batch), self.num_classes if self.task == 'binary' else 1, self.patch_size, self.patch_size]
+
+    def get_current_consistency_weight(self, epoch):
+        # Consistency ramp-up from https://arxiv.org/abs/1610.02242
+        return self.args.consistency * ramps.sigmoid_rampup(epoch, self.args.consistency_rampup)
+
+    def student_forward(self, lb_x, ulb_x):
+        if self.args.fused_forward and len(lb_x) and len(ulb_x):
+            return fused_forward(self.model, [lb_x, ulb_x], split_bn=self.args.fused_bn == 'split')
+        return [self.model(x) if len(x) else None for x in (lb_x, ulb_x)]
+
+    def train_step(self, lb_sample, ulb_sample, epoch_num):
+        """One optimizer step over a labeled and an unlabeled batch.
+
+        With --micro_batches M the student runs on M chunks of both batches; the
+        chunk losses are weighted by their share of the batch, so their gradients
+        add up to those of the full-batch loss, and only one chunk's graph is
+        alive at a time. Teacher targets, the queue, EMA and LR are computed or
+        updated once per step. BN statistics are those of the chunk, as in any
+        gradient accumulation.
+
+        With --replicas K the batches hold K replica batches one after another
+        (networks.stacked), chunks split every replica batch, and the loss is
+        the sum of the replicas' losses (K times the mean over the stacked
+        batch), so that each replica gets the gradient of its own loss.
+        CutMix and FDA draw their pairs from the whole stacked batch.
+        """
+        args = self.args
+        model, ema_model = self.model, self.ema_model
+        device = self.device
+        fmt = self.memory_format
+        lb_x_w, lb_y = lb_sample['image'].to(device, memory_format=fmt), lb_sample['label'].to(device)
+        ulb_x_w, ulb_x_s, ulb_y = ulb_sample['image'].to(device, memory_format=fmt), ulb_sample['strong_aug'].to(device, memory_format=fmt), ulb_sample['label'].to(device)
+        ulb_dc = ulb_sample['dc'].to(device)
+        lb_mask = to_mask(args.dataset, lb_y)
+        ulb_mask = to_mask(args.dataset, ulb_y)
+        micro_batches = max(1, args.micro_batches)
+
+        replicas = self.replicas
+
+        def split(x):
+            if replicas == 1:
+                return torch.tensor_split(x, micro_batches)
+            chunks = x.view(replicas, -1, *x.shape[1:]).tensor_split(micro_batches, dim=1)
+            return [c.flatten(0, 1) for c in chunks]
+
+        def join(chunks):
+            if replicas == 1:
+                return torch.cat(chunks)
+            return torch.cat([c.view(replicas, -1, *c.shape[1:]) for c in chunks], dim=1).flatten(0, 1)
+
+        with self.amp_cm():
+            if self.fda is not None:
+                lb_x_w = self.fda(lb_x_w, ulb_x_w)
+
+            cut = [(None, None, None, 0)] * micro_batches
+            if args.queue_loss and len(self.queue) > 0:
+                cut_img, cut_label, cut_mask = self.queue.sample(args.label_bs)
+                cut = [(img, label, m, len(cut_img)) for img, label, m in zip(split(cut_img), split(cut_label), split(cut_mask))]
+
+            mix = None
+            if self.cutmix is not None:
+                ulb_x_s, mix = self.cutmix(ulb_x_s, lb_x_w, lb_mask, self.mask_shape(lb_x_w))
+
+            # teacher targets of the whole batch, no graph is kept
+            cache_hit = None
+            if self.pseudo_store is not None:
+                # computed at the start of the epoch and warped with the weak view by the loader
+                pseudo_label, mask = unpack(ulb_sample['pseudo'].to(device), self.num_classes, self.task)
+            elif self.teacher_cache is not None and self.iter_num >= args.teacher_cache_warmup:
+                keys = list(zip(ulb_sample['dc'].tolist(), ulb_sample['img_name']))
+                prob_ulb_x_w = self.teacher_cache(lambda x: self.probs(torch.cat([ema_model(c) for c in torch.tensor_split(x, micro_batches)])),
+                                                  keys, ulb_sample['orig'].to(device, memory_format=fmt), ulb_sample['geometry'].to(device), self.iter_num)
+                cache_hit = self.teacher_cache.hit_rate
+            else:
+                logits_ulb_x_w = join([ema_model(x) for x in split(ulb_x_w)])
+                prob_ulb_x_w = self.probs(logits_ulb_x_w)
+            if self.pseudo_store is None:
+                pseudo_label = self.hard_label(prob_ulb_x_w).detach()
+                if self.da is not None:
+                    prob_ulb_x_w, pseudo_label = self.da(lb_mask, prob_ulb_x_w, pseudo_label)
+                threshold = args.threshold
+                mask = self.confidence_mask(prob_ulb_x_w, threshold)
+
+        consistency_weight = self.get_current_consistency_weight(
+            self.iter_num // (args.max_iterations/args.consistency_rampup))
+
+        target_label, target_mask = pseudo_label, mask
+        if mix is not None:
+            target_label, target_mask = CutMix.paste(mix, pseudo_label, mask)
+
+        # the unsupervised loss is normalized by the whole unlabeled batch, whichever samples the student sees
+        n_ulb = len(ulb_x_s)
+        train_x_s, train_label, train_mask = ulb_x_s, target_label, target_mask
+        skipped = 0
+        if args.conf_floor > 0:
+            # samples with few confident pixels add next to nothing to the loss, their forward and backward are skipped;
+            # the host reads the number kept every step (a device sync), and the student's BN batch statistics
+            # are taken over the kept samples only
+            keep = target_mask.flatten(1).mean(1).ge(args.conf_floor).nonzero().squeeze(1)
+            skipped = n_ulb - len(keep)
+            if skipped:
+                train_x_s, train_label, train_mask = ulb_x_s[keep], target_label[keep], target_mask[keep]
+
+        self.optimizer.zero_grad(set_to_none=True)
+
+        loss, sup_loss, unsup_loss = 0.0, 0.0, 0.0
+        logits_lb_x_w = None
+        chunks = zip(split(lb_x_w), split(lb_mask), split(train_x_s), split(train_label), split(train_mask), cut)
+        for lb_x, lb_m, ulb_x, ulb_pl, ulb_m, (cut_img, cut_label, cut_mask, n_cut) in chunks:
+            with self.amp_cm():
+                loss_c = 0
+                if cut_img is not None and len(cut_img):
+                    loss_c = self.masked_loss(model(cut_img), cut_label, cut_mask) * (len(cut_img) / n_cut)
+
+                # outputs for model
+                logits_lb, logits_ulb = self.student_forward(lb_x, ulb_x)
+                chunk_sup = chunk_unsup = 0
+                if logits_lb is not None:
+                    chunk_sup = self.seg_loss(logits_lb, lb_m).mean() * (len(lb_x) / len(lb_x_w))
+                    if self.dice_loss is not None:
+                        # over the chunk: Dice is not a mean over samples, micro batches weight it by their share
+                        chunk_sup = chunk_sup + args.dice_loss * self.dice_loss(logits_lb, lb_m, softmax=self.task != 'binary') * (len(lb_x) / len(lb_x_w))
+                    if logits_lb_x_w is None:
+                        logits_lb_x_w = logits_lb.detach()
+                if logits_ulb is not None:
+                    chunk_unsup = self.masked_loss(logits_ulb, ulb_pl, ulb_m) * (len(ulb_x) / n_ulb)
+
+                chunk_loss = chunk_sup + consistency_weight * (loss_c + chunk_unsup)
+
+            if torch.is_tensor(chunk_loss):
+                self.scaler.scale(chunk_loss * replicas).backward()
+                loss = loss + chunk_loss.detach()
+            if torch.is_tensor(chunk_sup):
+                sup_loss = sup_loss + chunk_sup.detach()
+            if torch.is_tensor(chunk_unsup):
+                unsup_loss = unsup_loss + chunk_unsup.detach()
+
+        with self.amp_cm():
+            # a host copy of the pseudo-labels; only taken when the queue or the step log reads it
+            ulb_dice = None
+            if self.queue is not None or self.logs_dice(self.iter_num + 1):
+                ulb_dice = self.dice(np.asarray(pseudo_label.cpu()), ulb_mask)
+            if self.queue is not None:
+                if self.pseudo_store is not None:
+                    # stored with the pseudo-labels
+                    hardness = ulb_sample['hardness'].numpy().copy()
+                    if epoch_num == 0:
+                        hardness[:] = 1
+                else:
+                    # hardness probe only, no graph needed; the student is not stepped yet
+                    with torch.inference_mode():
+                        stu_pseudo_label = self.hard_label(self.probs(join([model(x) for x in split(ulb_x_w)])))
+                    hardness = self.queue.hardness_of(stu_pseudo_label, pseudo_label, epoch_num == 0)
+                simple_ulb_idx = self.queue.update(hardness, ulb_x_w, pseudo_label, ulb_mask, ulb_dc, mask)
+                self.queue.track(simple_ulb_idx, hardness, pseudo_label, ulb_mask, ulb_dc, ulb_sample['img_name'], ulb_dice)
+
+        util.all_reduce_grads(self.optimizer_params, self.world_size)
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+
+        # update ema model
+        self.ema.update(self.iter_num)
+
+        # update learning rate
+        lr_ = self.lr_table[self.iter_num]
+        set_lr(self.optimizer, lr_)
+
+        self.iter_num = self.iter_num + 1
+        return dict(loss=loss, sup_loss=sup_loss, unsup_loss=unsup_loss, consistency_weight=consistency_weight,
+                    mask=target_mask, lr=lr_, ulb_dice=ulb_dice, cache_hit=cache_hit, skipped=skipped, n_ulb=n_ulb,
+                    lb_x_w=lb_x_w, lb_mask=lb_mask, logits_lb_x_w=logits_lb_x_w,
+                    ulb_x_w=ulb_x_w, ulb_x_s=ulb_x_s, ulb_mask=ulb_mask, pseudo_label=target_label)
+
+    def logs_dice(self, iter_num):
+        """Whether log_step reports the pseudo-label Dice at iter_num: every --log_interval and every 200 steps."""
+        return iter_num % max(1, self.args.log_interval) == 0 or iter_num % 200 == 0
+
+    def log_step(self, out, p_bar):
+        iter_num, writer, part = self.iter_num, self.writer, self.part
+        if out['ulb_dice'] is not None:
+            for n, p in enumerate(part):
+                writer.add_scalar('train/ulb_{}_dice'.format(p), out['ulb_dice'][n], iter_num)
+        writer.add_scalar('train/mask', out['mask'].mean(), iter_num)
+        writer.add_scalar('train/lr', out['lr'], iter_num)
+        writer.add_scalar('train/loss', out['loss'].detach(), iter_num)
+        writer.add_scalar('train/sup_loss', out['sup_loss'].detach(), iter_num)
+        writer.add_scalar('train/unsup_loss', out['unsup_loss'].detach(), iter_num)
+        writer.add_scalar('train/consistency_weight', out['consistency_weight'], iter_num)
+        if out['cache_hit'] is not None:
+            writer.add_scalar('train/teacher_cache_hit', out['cache_hit'], iter_num)
+        if self.args.conf_floor > 0:
+            self.ulb_skipped += out['skipped']
+            self.ulb_seen += out['n_ulb']
+            writer.add_scalar('train/ulb_skipped', out['skipped'] / out['n_ulb'], iter_num)
+
+        p_bar.update()
+        if iter_num % max(1, self.args.log_interval) == 0:
+            # reading the losses waits for the step, so the bar text is only built every --log_interval steps
+            text = 'iteration %d: loss:%.4f,sup_loss:%.4f,unsup_loss:%.4f,cons_w:%.4f,mask_ratio:%.4f' % (
+                iter_num, out['loss'].item(), out['sup_loss'].item(), out['unsup_loss'].item(), out['consistency_weight'], out['mask'].mean())
+            for n, p in enumerate(part):
+                text += ',ulb_%s:%.4f' % (p, out['ulb_dice'][n])
+            if self.da is not None:
+                for n, p in enumerate(part):
+                    text += ',ref_%s:%.4f,disu_%s:%.4f' % (p, self.da.ref.avg[n], p, self.da.disulb.avg[n])
+            p_bar.set_description(text)
+
+        if iter_num % 200 == 0:
+            if self.vis.enabled:
+                lb_pred = self.hard_label(self.probs(out['logits_lb_x_w'][:1]))[0]
+                self.vis.add_grid("train/lb_sample", sample_panels(out['lb_x_w'][0], out['lb_mask'][0], lb_pred), 1 + 2 * self.n_part, iter_num)
+                ulb_panels = [('image', image_u8(out['ulb_x_w'][0]))] + [('mask', mask_u8(out['ulb_mask'][0, c])) for c in range(self.n_part)]
+                ulb_panels += [('image', image_u8(out['ulb_x_s'][0]))] + [('mask', mask_u8(out['pseudo_label'][0, c])) for c in range(self.n_part)]
+                self.vis.add_grid("train/ulb_sample", ulb_panels, 3 if self.args.dataset == 'fundus' else 4, iter_num)
+            logging.info('iteration %d : loss : %f, sup_loss : %f, unsup_loss : %f, cons_w : %f, mask_ratio : %f'
+                         % (iter_num, out['loss'].item(), out['sup_loss'].item(), out['unsup_loss'].item(), out['consistency_weight'], out['mask'].mean()))
+            text = ', '.join(['ulb_%s_dice:%f' % (p, out['ulb_dice'][n]) for n, p in enumerate(part)])
+            if self.da is not None:
+                text += ', ' + ', '.join(['ref_%s:%f, disulb_%s:%f' % (p, self.da.ref.avg[n], p, self.da.disulb.avg[n]) for n, p in enumerate(part)])
+            logging.info(text)
+            if self.queue is not None:
+                self.log_queue('tmp')
+
+    def log_queue(self, prefix):
+        queue = self.queue
+        if prefix == 'tmp':
+            for n, p in enumerate(self.part):
+                logging.info('cur simple dice avg %s:%f' % (p, queue.queue_dice()[n]))
+        for n, p in enumerate(self.part):
+            logging.info('%s simple dice avg %s:%f' % (prefix, p, queue.avg_dice[n].avg))
+        for n, p in enumerate(self.part):
+            logging.info('%s other ulb dice avg %s:%f' % (prefix, p, queue.other_ulb_avg_dice[n].avg))
+        for n, p in enumerate(self.part):
+            logging.info('%s all ulb dice avg %s:%f' % (prefix, p, queue.all_ulb_avg_dice[n].avg))
+        logging.info('%s simple hardness avg:%f' % (prefix, queue.avg_hardness.avg))
+        logging.info('choice threshold:%f' % queue.choice_th)
+        if prefix == 'epoch':
+            logging.info(' '.join(['{} {}'.format(name, cnt) for name, cnt in queue.simple_ulb_name.items()]))
+        for i in range(len(queue.dc_record)):
+            logging.info('%s simple domain %d cnt: %d' % (prefix, i + 1, queue.dc_record[i]))
+
+    @torch.no_grad()
+    def refresh_pseudo_labels(self):
+        """Label the unlabeled pool with the teacher, in batches of --pseudo_store_bs, into the pseudo-label store.
+
+        Models run in train mode, as in train_step: the teacher on the batch
+        statistics of the pool, the student (for the hardness, 1 - mean Dice
+        between their labels) with its BN buffers restored afterwards.
+        """
+        model, ema_model = self.model, self.ema_model
+        model.train()
+        ema_model.train()
+        buffers = {name: b.clone() for name, b in model.named_buffers()}
+        for sample in self.pool_dataloader:
+            x = sample['image'].to(self.device, memory_format=self.memory_format)
+            with self.amp_cm():
+                prob = self.probs(ema_model(x))
+                pseudo_label = self.hard_label(prob)
+                mask = self.confidence_mask(prob, self.args.threshold)
+                stu_pseudo_label = self.hard_label(self.probs(model(x)))
+            stu_tea_dice = self.dice(np.asarray(stu_pseudo_label.cpu()), pseudo_label, ret_arr=True)
+            hardness = 1 - sum(stu_tea_dice[:self.n_part]) / self.n_part
+            keys = list(zip(sample['dc'].tolist(), sample['img_name']))
+            self.pseudo_store.write(keys, pack(pseudo_label, mask, self.task).cpu().numpy(), hardness)
+        for name, b in model.named_buffers():
+            b.copy_(buffers[name])
+        self.pseudo_store.publish(self.is_main)
+        self.pseudo_iter = self.iter_num
+
+    def train_epoch(self, epoch_num):
+        if self.pseudo_store is not None and self.pseudo_iter != self.iter_num:
+            self.refresh_pseudo_labels()
+        self.model.train()
+        self.ema_model.train()
+        if self.queue is not None:
+            self.queue.reset_stats()
+        if self.teacher_cache is not None:
+            self.teacher_cache.reset_stats()
+        self.ulb_skipped, self.ulb_seen = 0, 0
+        p_bar = tqdm(range(self.args.num_eval_iter), disable=not self.is_main)
+        p_bar.set_description(f'No. {epoch_num+1}')
+        for i_batch in range(1, self.args.num_eval_iter + 1):
+            out = self.train_step(next(self.lb_dataloader), next(self.ulb_dataloader), epoch_num)
+            self.log_step(out, p_bar)
+        p_bar.close()
+        if self.queue is not None:
+            self.log_queue('epoch')
+        if self.ulb_seen:
+            # student passes run on the labeled batch and the kept strong views
+            passes = self.args.num_eval_iter * self.args.label_bs + self.ulb_seen
+            logging.info('conf_floor: skipped {} of {} unlabeled samples, {:.1%} of the student forward/backward samples'.format(
+                self.ulb_skipped, self.ulb_seen, self.ulb_skipped / passes))
+        cache = self.teacher_cache
+        if cache is not None and cache.hits + cache.misses:
+            logging.info('teacher cache: {} hits, {} misses, hit rate {:.3f}, {} images cached'.format(
+                cache.hits, cache.misses, cache.hit_rate, len(cache.entries)))
+
+    @torch.no_grad()
+    def test(self, model, epoch, ema=True, subset=False, replica=None):
+        """Mean dice of model per structure over the test domains, or over their eval subsets."""
+        args, part, n_part, vis = self.args, self.part, self.n_part, self.vis
+        model.eval()
+        # subset results are logged apart, they are not comparable with full evaluations
+        model_name = ('ema' if ema else 'stu') + ('_sub' if subset else '') + ('' if replica is None else '_r{}'.format(replica))
+        names = ['dice'] + (['hd', 'asd'] if args.eval and args.eval_surface else [])
+        overlay = Visualizer(save_dir=args.img_dir) if args.eval and args.img_dir else None
+        domains = []
+        test_dataloader = self.test_subset_dataloader if subset else self.test_dataloader
+        for cur_dataloader in test_dataloader:
+            dc = -1
+            num = 0
+            domain_val_loss = 0.0
+            domain_val = {m: [0.0] * n_part for m in names}
+            for batch_num, sample in enumerate(cur_dataloader):
+                dc = sample['dc'][0].item()
+                data = sample['image'].to(self.device, memory_format=self.memory_format)
+                mask = to_mask(args.dataset, sample['label'].to(self.device))
+                with self.amp_cm():
+                    output = model(data)
+                loss_seg = self.seg_loss(output, mask).mean()
+                pred = self.hard_label(self.probs(output))
+                pred_np = np.asarray(pred.cpu())
+
+                if args.eval:
+                    for j in range(len(data)):
+                        num += 1
+                        if vis.enabled:
+                            eval_dice = self.dice(pred_np[j], mask[j])
+                            if any([eval_dice[k] < 0.8 for k in range(n_part)]):
+                                text = 'lb_domain{}/bad/domain{}/'.format(epoch, dc)
+                            else:
+                                text = 'lb_domain{}/good/domain{}/'.format(epoch, dc)
+                            text += '_'.join([str(round(d, 4)) for d in eval_dice])
+                            vis.add_grid(text, sample_panels(data[j], mask[j], pred[j]), 1 + 2 * n_part, 1)
+                        if overlay is not None:
+                            # BGR, as written by cv2
+                            predictions = []
+                            for c in range(n_part):
+                                predictions += [(mask_u8(pred[j, c]), self.spec['colors'][c]), (mask_u8(mask[j, c]), (0, 0, 255))]
+                            overlay.add_overlay('domain{}_{}'.format(dc, num), image_u8(data[j]).flip(0), predictions)
+
+                dice = self.dice(pred_np, mask)
+                domain_val_loss += loss_seg.item()
+                for i in range(n_part):
+                    domain_val['dice'][i] += dice[i]
+                if 'hd' in names:
+                    hd, asd = surface_distance(pred_np, np.asarray(mask.cpu()), n_part)
+                    for i in range(n_part):
+                        domain_val['hd'][i] += hd[i]
+                        domain_val['asd'][i] += asd[i]
+
+                if epoch % 10 == 0 and vis.enabled:
+                    vis.add_grid('{}_val/domain{}/{}'.format(model_name, dc, batch_num), sample_panels(data[0], mask[0], pred[0]), 1 + 2 * n_part, epoch)
+
+            domain_val_loss /= len(cur_dataloader)
+            for m in names:
+                for i in range(n_part):
+                    domain_val[m][i] /= len(cur_dataloader)
+            domains.append((dc, domain_val_loss, domain_val))
+
+        if overlay is not None:
+            overlay.close()
+        model.train()
+        return self.report_val(model_name, epoch, domains)['dice']
+
+    def report_val(self, model_name, epoch, domains):
+        """Log the (dc, loss, metrics) results of every test domain; returns the metrics averaged over the domains."""
+        part, n_part = self.part, self.n_part
+        names = list(domains[0][2])
+        val_loss = 0.0
+        val = {m: [0.0] * n_part for m in names}
+        for dc, domain_val_loss, domain_val in domains:
+            val_loss += domain_val_loss
+            self.writer.add_scalar('{}_val/domain{}/loss'.format(model_name, dc), domain_val_loss, epoch)
+            for m in names:
+                for i in range(n_part):
+                    val[m][i] += domain_val[m][i]
+                for n, p in enumerate(part):
+                    self.writer.add_scalar('{}_val/domain{}/val_{}_{}'.format(model_name, dc, p, m), domain_val[m][n], epoch)
+            text = 'domain%d epoch %d : loss : %f ' % (dc, epoch, domain_val_loss)
+            text += ', '.join(['val_%s_%s: %f' % (p, m, domain_val[m][n]) for m in names for n, p in enumerate(part)])
+            logging.info(text)
+
+        domain_num = len(domains)
+        val_loss /= domain_num
+        self.writer.add_scalar('{}_val/loss'.format(model_name), val_loss, epoch)
+        for m in names:
+            for i in range(n_part):
+                val[m][i] /= domain_num
+            for n, p in enumerate(part):
+                self.writer.add_scalar('{}_val/val_{}_{}'.format(model_name, p, m), val[m][n], epoch)
+        text = 'epoch %d : loss : %f ' % (epoch, val_loss)
+        text += ', '.join(['val_%s_%s: %f' % (p, m, val[m][n]) for m in names for n, p in enumerate(part)])
+        logging.info(text)
+        return val
+
+    def validate(self, epoch_num):
+        if self.replicas > 1:
+            return self.validate_replicas(epoch_num)
+        args, part, iter_num = self.args, self.part, self.iter_num
+        schedule = self.eval_schedule
+        # the eval subset screens intermediate evaluations, the last one is always full
+        full = self.test_subset_dataloader is None or iter_num == args.max_iterations
+        if not full:
+            logging.info('test ema model on the eval subset')
+            subset_dice = self.test(self.ema_model, epoch_num + 1, subset=True)
+            full = schedule.is_candidate(subset_dice)
+            schedule.update(epoch_num, subset_dice, subset=True)
+        if full:
+            logging.info('test ema model')
+            val_dice = self.test(self.ema_model, epoch_num + 1)
+            if self.test_subset_dataloader is None:
+                schedule.update(epoch_num, val_dice)
+            self.save_best(val_dice)
+        if args.test_stu:
+            logging.info('test stu model')
+            stu_val_dice = self.test(self.model, epoch_num + 1, ema=False, subset=not full)
+            self.update_stu_best(stu_val_dice if full else None, iter_num)
+
+    def update_stu_best(self, stu_val_dice, iter_num):
+        """Track the best student dice of full evaluations (None for a subset one) and log it."""
+        part = self.part
+        if stu_val_dice is not None:
+            for n, p in enumerate(part):
+                if stu_val_dice[n] > self.stu_best_dice[n]:
+                    self.stu_best_dice[n] = stu_val_dice[n]
+                    self.stu_best_dice_iter[n] = iter_num
+        logging.info(', '.join(['stu_val_%s_best_dice: %f at %d iter' % (p, self.stu_best_dice[n], self.stu_best_dice_iter[n])
+                                for n, p in enumerate(part)]))
+
+    def submit_eval(self, epoch_num):
+        """Hand snapshots of the teacher (and student) to the evaluation process."""
+        # at most MAX_PENDING evaluations in flight, a slow evaluator holds training back here
+        for done in self.async_eval.poll(max_pending=MAX_PENDING - 1):
+            self.finish_eval(*done)
+        models = {'ema': self.ema_model}
+        if self.args.test_stu:
+            models['stu'] = self.model
+        self.async_eval.submit((epoch_num, self.iter_num), models)
+        self.eval_schedule.defer(epoch_num)
+
+    def finish_eval(self, info, states, results):
+        """Log, track and save the results of an asynchronous evaluation of the weights states at info."""
+        epoch_num, iter_num = info
+        logging.info('evaluation of iteration {} finished'.format(iter_num))
+        val_dice = self.report_val('ema', epoch_num + 1, results['ema'])['dice']
+        self.eval_schedule.update(epoch_num, val_dice)
+        self.save_best(val_dice, states['ema'], iter_num)
+        if 'stu' in results:
+            self.update_stu_best(self.report_val('stu', epoch_num + 1, results['stu'])['dice'], iter_num)
+        self.report_progress(epoch_num, iter_num)
+
+    def validate_replicas(self, epoch_num):
+        """Evaluate every replica on the full test sets and save the best teacher of each as a plain UNet.
+
+        The best dice of every replica is tracked on its own; best_dice and
+        stu_best_dice are their means, the spread over seeds is logged.
+        """
+        args, part, iter_num = self.args, self.part, self.iter_num
+        mean_val = None
+        for ema in [True, False]:
+            if not ema and not args.test_stu:
+                continue
+            model = self.ema_model if ema else self.model
+            best, best_iter = (self.replica_best, self.replica_best_iter) if ema else (self.replica_stu_best, self.replica_stu_best_iter)
+            vals = []
+            for k in range(self.replicas):
+                logging.info('test {} model, replica {}'.format('ema' if ema else 'stu', k))
+                replica = model.replica(k)
+                val_dice = self.test(replica, epoch_num + 1, ema=ema, replica=k)
+                vals.append(val_dice)
+                if ema and iter_num == args.max_iterations:
+                    text = 'iter_{}_r{}'.format(iter_num, k)
+                    for n, p in enumerate(part):
+                        text += '_{}_dice_{}'.format(p, round(val_dice[n], 4))
+                    self.ckpt.save(replica.state_dict(), os.path.join(self.snapshot_path, text + '.pth'), key=('ema', k, iter_num))
+                for n, p in enumerate(part):
+                    if val_dice[n] > best[k][n]:
+                        best[k][n] = val_dice[n]
+                        best_iter[k][n] = iter_num
+                        if ema:
+                            text = '{}_{}_dice_best_model_r{}.pth'.format(args.model, p, k)
+                            self.ckpt.save_best(replica.state_dict(), text, val_dice[n], iter_num, key=('ema', k, iter_num))
+            mean_best = np.mean(best, axis=0).tolist()
+            mean_best_dice, mean_best_iter = (self.best_dice, self.best_dice_iter) if ema else (self.stu_best_dice, self.stu_best_dice_iter)
+            for n in range(self.n_part):
+                if mean_best[n] > mean_best_dice[n]:
+                    mean_best_dice[n] = mean_best[n]
+                    mean_best_iter[n] = iter_num
+            if ema:
+                mean_val = np.mean(vals, axis=0).tolist()
+            std_best = np.std(best, axis=0).tolist()
+            logging.info(', '.join(['%sval_%s_best_dice: %f +- %f over %d replicas' % ('' if ema else 'stu_', p, mean_best[n], std_best[n], self.replicas)
+                                    for n, p in enumerate(part)]))
+        self.eval_schedule.update(epoch_num, mean_val)
+
+    def save_best(self, val_dice, state=None, iter_num=None):
+        """Save the teacher of a full evaluation if it is the best of some structure (and at the last iteration).
+
+        state and iter_num default to the current teacher and iteration.
+        """
+        args, part = self.args, self.part
+        if iter_num is None:
+            iter_num = self.iter_num
+        if state is None:
+            state = self.ema_model.state_dict()
+        if iter_num == args.max_iterations:
+            text = 'iter_{}'.format(iter_num)
+            for n, p in enumerate(part):
+                text += '_{}_dice_{}'.format(p, round(val_dice[n], 4))
+            text += '.pth'
+            cur_save_path = os.path.join(self.snapshot_path, text)
+            logging.info('save cur model to {}'.format(cur_save_path))
+            self.ckpt.save(state, cur_save_path, key=('ema', iter_num))
+        for n, p in enumerate(part):
+            if val_dice[n] > self.best_dice[n]:
+                self.best_dice[n] = val_dice[n]
+                self.best_dice_iter[n] = iter_num
+                text = "{}_{}_dice_best_model.pth".format(args.model, p)
+                logging.info('save cur best {} model to {}'.format(p, os.path.join(self.snapshot_path, text)))
+                # one host copy and one write per iteration, even if several structures improve
+                self.ckpt.save_best(state, text, val_dice[n], iter_num, key=('ema', iter_num))
+        logging.info(', '.join(['val_%s_best_dice: %f at %d iter' % (p, self.best_dice[n], self.best_dice_iter[n])
+                                for n, p in enumerate(part)]))
+
+    def state_dict(self, epoch):
+        """State shared by all ranks; per-rank state is stored under 'ranks'."""
+        return {
+            'iter_num': self.iter_num,
+            'epoch': epoch,
+            'world_size': self.world_size,
+            'model': self.model.state_dict(),
+            'ema_model': self.ema_model.state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'scaler': self.scaler.state_dict(),
+            'best': (self.best_dice, self.best_dice_iter, self.stu_best_dice, self.stu_best_dice_iter),
+            'eval_schedule': self.eval_schedule.state_dict(),
+            'replica_best': (self.replica_best, self.replica_best_iter, self.replica_stu_best, self.replica_stu_best_iter),
+        }
+
+    def local_state_dict(self):
+        state = {
+            'lb_loader': self.lb_dataloader.state_dict(),
+            'ulb_loader': self.ulb_dataloader.state_dict(),
+            'rng': rng_state(),
+        }
+        if self.da is not None:
+            state['da'] = self.da.state_dict()
+        if self.queue is not None:
+            state['queue'] = self.queue.state_dict()
+        return state
+
+    def save_state(self, epoch):
+        local = self.local_state_dict()
+        if self.world_size > 1:
+            ranks = [None] * self.world_size if self.is_main else None
+            dist.gather_object(local, ranks, dst=0)
+        else:
+            ranks = [local]
+        if self.is_main:
+            logging.info('save training state at iteration {}'.format(self.iter_num))
+            state = self.state_dict(epoch)
+            state['ranks'] = ranks
+            self.ckpt.save_state(state)
+
+    def resume(self):
+        """Restore the latest training state of the snapshot path; returns the RNG state of this rank."""
+        ckpt_path = latest_train_state(self.snapshot_path)
+        if ckpt_path is None:
+            logging.warning('No train_state checkpoint in {}, training from scratch'.format(self.snapshot_path))
+            return None
+        logging.info('Restoring training state from {}'.format(ckpt_path))
+        state = load_train_state(ckpt_path, map_location=self.device)
+        self.model.load_state_dict(state['model'])
+        self.ema_model.load_state_dict(state['ema_model'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.scaler.load_state_dict(state['scaler'])
+        if state['world_size'] != self.world_size:
+            logging.warning('checkpoint of {} processes resumed with {}, data order and queues restart'.format(
+                state['world_size'], self.world_size))
+            local = None
+        else:
+            local = state['ranks'][self.rank]
+            self.lb_dataloader.load_state_dict(local['lb_loader'])
+            self.ulb_dataloader.load_state_dict(local['ulb_loader'])
+            if self.da is not None:
+                self.da.load_state_dict(local['da'])
+            if self.queue is not None:
+                self.queue.load_state_dict(local['queue'])
+        self.best_dice, self.best_dice_iter, self.stu_best_dice, self.stu_best_dice_iter = state['best']
+        if 'eval_schedule' in state:
+            self.eval_schedule.load_state_dict(state['eval_schedule'])
+        if 'replica_best' in state:
+            self.replica_best, self.replica_best_iter, self.replica_stu_best, self.replica_stu_best_iter = state['replica_best']
+        self.iter_num = state['iter_num']
+        self.start_epoch = state['epoch']
+        logging.info('Resuming at epoch {}, iteration {}'.format(self.start_epoch, self.iter_num))
+        return None if local is None else local['rng']
+
+    def fit(self):
+        args = self.args
+        logging.info("{} iterations per epoch".format(args.num_eval_iter))
+        for epoch_num in range(self.start_epoch, self.max_epoch):
+            self.apply_control()
+            self.train_epoch(epoch_num)
+            if self.world_size > 1:
+                # BN statistics are per rank, keep them from drifting apart
+                util.broadcast_module(self.model, buffers_only=True)
+                util.broadcast_module(self.ema_model, buffers_only=True)
+            if self.async_eval is not None:
+                for done in self.async_eval.poll():
+                    self.finish_eval(*done)
+            if self.is_main and self.eval_schedule.due(epoch_num) and self.async_eval is not None:
+                self.submit_eval(epoch_num)
+            elif self.is_main and self.eval_schedule.due(epoch_num):
+                self.validate(epoch_num)
+                self.report_progress(epoch_num)
+            if args.ckpt_every and (epoch_num + 1) % args.ckpt_every == 0:
+                self.save_state(epoch_num + 1)
+            if self.world_size > 1:
+                dist.barrier()
+        if self.async_eval is not None:
+            for done in self.async_eval.poll(max_pending=0):
+                self.finish_eval(*done)
+        if self.is_main:
+            self.save_result()
+        self.close()
+
+    def report_progress(self, epoch_num, iter_num=None):
+        progress = {'epoch': epoch_num + 1, 'iter_num': self.iter_num if iter_num is None else iter_num,
+                    'best_dice': dict(zip(self.part, self.best_dice)), 'stu_best_dice': dict(zip(self.part, self.stu_best_dice))}
+        with open(os.path.join(self.snapshot_path, PROGRESS_FILE), 'a') as f:
+            f.write(json.dumps(progress) + '\n')
+
+    def apply_control(self):
+        """Take over the thread count the sweep runner assigned to this process, if any."""
+        path = os.path.join(self.snapshot_path, CONTROL_FILE)
+        if self.device.type != 'cpu' or not os.path.exists(path):
+            return
+        with open(path) as f:
+            threads = json.load(f).get('threads')
+        if threads and threads != torch.get_num_threads():
+            logging.info('{} threads from {}'.format(threads, path))
+            torch.set_num_threads(threads)
+
+    def save_result(self):
+        """Best dice of teacher and student per structure, in <snapshot_path>/result.json."""
+        result = {
+            'iter_num': self.iter_num,
+            'best_dice': dict(zip(self.part, self.best_dice)),
+            'best_dice_iter': dict(zip(self.part, self.best_dice_iter)),
+            'stu_best_dice': dict(zip(self.part, self.stu_best_dice)),
+            'stu_best_dice_iter': dict(zip(self.part, self.stu_best_dice_iter)),
+        }
+        if self.replicas > 1:
+            result['replica_best_dice'] = [dict(zip(self.part, best)) for best in self.replica_best]
+            result['replica_stu_best_dice'] = [dict(zip(self.part, best)) for best in self.replica_stu_best]
+        with open(os.path.join(self.snapshot_path, RESULT_FILE), 'w') as f:
+            json.dump(result, f, indent=2)
+
+    def evaluate(self):
+        load_path = self.args.load_path.format(dataset=self.args.dataset, lb_domain=self.args.lb_domain)
+        logging.info('evaluate {}'.format(load_path))
+        self.model.load_state_dict(util.load_ddp_to_nddp(torch.load(load_path, map_location=self.device)))
+        val_dice = self.test(self.model, self.args.lb_domain)
+        self.close()
+        return val_dice
+
+    def close(self):
+        if self.async_eval is not None:
+            self.async_eval.close()
+        if self.ckpt is not None:
+            self.ckpt.close()
+        self.vis.close()
+        self.writer.close()
+
+
+def run(rank, args, snapshot_path):
+    """Train (or evaluate) as process rank of args.world_size."""
+    args.rank = rank
+    if args.world_size > 1:
+        util.distributed_setup(rank, args.world_size, backend=args.dist_backend, port=args.dist_port)
+        if args.device == 'cuda':
+            torch.cuda.set_device(rank)
+    if args.device == 'cpu':
+        # share the cores instead of every process starting one thread per core
+        torch.set_num_threads(args.threads or max(1, (os.cpu_count() or 1) // args.world_size))
+
+    if args.deterministic:
+        cudnn.benchmark = False
+        cudnn.deterministic = True
+    # ranks draw different augmentations; the data order is seeded by args.seed alone
+    seed = args.seed + rank
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed(seed)
+
+    if rank == 0:
+        logging.basicConfig(filename=snapshot_path + "/log.txt", level=logging.INFO,
+                            format='[%(asctime)s.%(msecs)03d] %(message)s', datefmt='%H:%M:%S')
+        logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
+    else:
+        logging.basicConfig(level=logging.WARNING, format='[rank{} %(asctime)s] %(message)s'.format(rank), datefmt='%H:%M:%S')
+    cmd = " ".join(["python"] + sys.argv)
+    logging.info(cmd)
+    logging.info(str(args))
+
+    trainer = Trainer(args, snapshot_path)
+    try:
+        if args.eval:
+            return trainer.evaluate()
+        trainer.fit()
+    finally:
+        util.distributed_cleanup()
+
+
+def main(method='work', argv=None):
+    args = parse_args(method, argv)
+    snapshot_path = "../model/" + args.dataset + "/" + args.save_name + "/"
+
+    if args.device != 'cpu':
+        os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+    if args.device == 'auto':
+        args.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    if not os.path.exists(snapshot_path):
+        os.makedirs(snapshot_path)
+    elif not args.overwrite and not args.load and not args.eval:
+        raise Exception('file {} is exist!'.format(snapshot_path))
+    if args.copy_code:
+        if os.path.exists(snapshot_path + '/code'):
+            shutil.rmtree(snapshot_path + '/code')
+        shutil.copytree('.', snapshot_path + '/code', ignore=shutil.ignore_patterns('.git', '__pycache__'))
+
+    if args.world_size > 1 and not args.eval:
+        mp.spawn(run, args=(args, snapshot_path), nprocs=args.world_size)
+        return
+    args.world_size = 1
+    return run(0, args, snapshot_path)
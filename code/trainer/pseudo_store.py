@@ -0,0 +1,128 @@
+""" Pseudo-labels of the whole unlabeled pool, precomputed by the teacher once per epoch """
+
+import os
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+from PIL import Image
+
+STORE_DIR = 'pseudo_labels'
+# one byte per pixel: binary tasks keep the hard label of structure c in bit c and its
+# confidence in bit CONF_SHIFT + c, softmax tasks the class in the low bits and the confidence in bit 7
+CONF_SHIFT = 4
+SOFTMAX_CONF_BIT = 7
+
+
+def pack(pseudo_label, mask, task):
+    """(B, C, H, W) hard labels and confidence masks -> (B, H, W) uint8 codes."""
+    if task == 'binary':
+        c = pseudo_label.shape[1]
+        bits = (2 ** torch.arange(c, device=pseudo_label.device)).view(1, c, 1, 1)
+        code = (pseudo_label.gt(0.5).int() * bits).sum(1) + (mask.gt(0).int() * (bits << CONF_SHIFT)).sum(1)
+    else:
+        code = pseudo_label.argmax(1).int() + (mask[:, 0].gt(0).int() << SOFTMAX_CONF_BIT)
+    return code.to(torch.uint8)
+
+
+def unpack(code, num_classes, task):
+    """(B, H, W) uint8 codes -> float hard labels (B, C, H, W) and confidence masks, as Trainer.confidence_mask shapes them."""
+    code = code.long()
+    if task == 'binary':
+        shift = torch.arange(num_classes, device=code.device).view(1, num_classes, 1, 1)
+        code = code.unsqueeze(1)
+        return ((code >> shift) & 1).float(), ((code >> (shift + CONF_SHIFT)) & 1).float()
+    pseudo_label = F.one_hot(code & ((1 << SOFTMAX_CONF_BIT) - 1), num_classes).permute(0, 3, 1, 2).float()
+    return pseudo_label, ((code >> SOFTMAX_CONF_BIT) & 1).unsqueeze(1).float()
+
+
+class PseudoLabelStore(object):
+    """Hard pseudo-labels, confidence masks and hardness of every unlabeled image, in memory-mapped files.
+
+    Used as the first weak transform of the unlabeled dataset: it adds the
+    stored code map of the sample ('pseudo', a PIL image the geometric
+    transforms warp like the label) and its hardness, so that the loader
+    delivers pseudo-labels aligned with the augmented view. Every file holds
+    two slots; a refresh writes the inactive one and then switches, so data
+    loader workers never read a half-written map. Ranks write disjoint rows
+    of the same files and must share the snapshot directory.
+    """
+
+    def __init__(self, path, num_classes, task):
+        if task == 'binary' and num_classes > CONF_SHIFT:
+            raise ValueError('the pseudo-label store packs at most {} sigmoid structures'.format(CONF_SHIFT))
+        self.path = path
+        self.num_classes = num_classes
+        self.task = task
+        self.rows = None
+        self.shape = None
+        self._maps = None
+
+    def allocate(self, keys, shape, create=True):
+        """Rows for the images keys, (dc, img_name) pairs, of shape (H, W); create makes the files (one rank)."""
+        self.rows = {k: i for i, k in enumerate(keys)}
+        self.shape = tuple(shape)
+        if create:
+            os.makedirs(self.path, exist_ok=True)
+            n = len(keys)
+            np.memmap(self._file('codes'), dtype=np.uint8, mode='w+', shape=(2, n) + self.shape).flush()
+            np.memmap(self._file('hardness'), dtype=np.float32, mode='w+', shape=(2, n)).flush()
+            active = np.memmap(self._file('active'), dtype=np.int64, mode='w+', shape=(1,))
+            active[0] = -1
+            active.flush()
+        self._maps = None
+
+    def _file(self, name):
+        return os.path.join(self.path, name + '.bin')
+
+    def _open(self):
+        if self._maps is None:
+            n = len(self.rows)
+            self._maps = (np.memmap(self._file('codes'), dtype=np.uint8, mode='r+', shape=(2, n) + self.shape),
+                          np.memmap(self._file('hardness'), dtype=np.float32, mode='r+', shape=(2, n)),
+                          np.memmap(self._file('active'), dtype=np.int64, mode='r+', shape=(1,)))
+        return self._maps
+
+    def __getstate__(self):
+        # workers map the files themselves instead of receiving a copy of them
+        state = dict(self.__dict__)
+        state['_maps'] = None
+        return state
+
+    @property
+    def ready(self):
+        return self.rows is not None and int(self._open()[2][0]) >= 0
+
+    def __call__(self, sample):
+        codes, hardness, active = self._open()
+        slot = int(active[0])
+        if slot < 0:
+            raise RuntimeError('no pseudo-labels stored yet, refresh the store before loading unlabeled samples')
+        row = self.rows[(sample['dc'], sample['img_name'])]
+        sample['pseudo'] = Image.fromarray(np.array(codes[slot, row]))
+        sample['hardness'] = float(hardness[slot, row])
+        return sample
+
+    def write(self, keys, code, hardness):
+        """Store code (B, H, W) and hardness (B,) of the images keys into the inactive slot."""
+        codes, hardnesses, active = self._open()
+        if tuple(code.shape[1:]) != self.shape:
+            raise ValueError('the pseudo-label store holds images of one size {}, got {}'.format(self.shape, tuple(code.shape[1:])))
+        slot = 1 - max(0, int(active[0]))
+        rows = np.asarray([self.rows[k] for k in keys])
+        codes[slot, rows] = code
+        hardnesses[slot, rows] = hardness
+
+    def publish(self, is_main=True):
+        """Make the slot written since the last publish the one samples are read from."""
+        codes, hardness, active = self._open()
+        codes.flush()
+        hardness.flush()
+        if dist.is_available() and dist.is_initialized():
+            dist.barrier()
+        if is_main:
+            active[0] = 1 - max(0, int(active[0]))
+            active.flush()
+        if dist.is_available() and dist.is_initialized():
+            dist.barrier()
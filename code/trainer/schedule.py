@@ -0,0 +1,64 @@
+import logging
+
+
+class EvalSchedule(object):
+    """When to validate, and whether on the eval subset or the full test sets.
+
+    Intermediate evaluations may run on a fixed subset of every test domain
+    (trainer.data.build_subset_loaders); a full evaluation, the only one that
+    can save a best model, follows when the subset Dice of some structure is
+    within margin of its best subset Dice so far. With adaptive=True the
+    interval between evaluations (in epochs of --num_eval_iter iterations)
+    is halved when the mean Dice changes by more than fast per epoch and
+    doubled, up to max_interval, when it changes by less than plateau.
+    The last epoch is always evaluated.
+    """
+
+    def __init__(self, n_part, max_epoch, adaptive=False, max_interval=8, plateau=0.002, fast=0.01, margin=0.0):
+        self.max_epoch = max_epoch
+        self.adaptive = adaptive
+        self.max_interval = max(1, max_interval)
+        self.plateau = plateau
+        self.fast = fast
+        self.margin = margin
+        self.interval = 1
+        self.next_epoch = 0
+        self.prev = None
+        self.best_subset = [0.0] * n_part
+
+    def due(self, epoch):
+        """Whether to validate after epoch (0-based)."""
+        return epoch >= self.next_epoch or epoch == self.max_epoch - 1
+
+    def defer(self, epoch):
+        """Schedule the next evaluation while the result of epoch is still pending."""
+        self.next_epoch = epoch + self.interval
+
+    def is_candidate(self, dice):
+        """Whether subset dice may be a new best model, worth a full evaluation."""
+        return any(d >= b - self.margin for d, b in zip(dice, self.best_subset))
+
+    def update(self, epoch, dice, subset=False):
+        """Record the validation dice of epoch and schedule the next evaluation."""
+        mean = sum(dice) / len(dice)
+        if self.adaptive and self.prev is not None:
+            change = abs(mean - self.prev) / self.interval
+            interval = self.interval
+            if change >= self.fast:
+                interval = max(1, interval // 2)
+            elif change <= self.plateau:
+                interval = min(self.max_interval, interval * 2)
+            if interval != self.interval:
+                logging.info('mean dice changes by {:.4f} per epoch, evaluating every {} epochs'.format(change, interval))
+            self.interval = interval
+        self.prev = mean
+        if subset:
+            self.best_subset = [max(d, b) for d, b in zip(dice, self.best_subset)]
+        self.next_epoch = epoch + self.interval
+
+    def state_dict(self):
+        return {'interval': self.interval, 'next_epoch': self.next_epoch, 'prev': self.prev, 'best_subset': self.best_subset}
+
+    def load_state_dict(self, state):
+        self.interval, self.next_epoch = state['interval'], state['next_epoch']
+        self.prev, self.best_subset = state['prev'], state['best_subset']
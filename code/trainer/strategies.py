@@ -0,0 +1,332 @@
+import random
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from utils import util
+
+
+def obtain_cutmix_box(img_size, p=0.5, size_min=0.02, size_max=0.4, ratio_1=0.3, ratio_2=1/0.3):
+    mask = torch.zeros(img_size, img_size)
+    if random.random() > p:
+        return mask
+
+    size = np.random.uniform(size_min, size_max) * img_size * img_size
+    while True:
+        ratio = np.random.uniform(ratio_1, ratio_2)
+        cutmix_w = int(np.sqrt(size / ratio))
+        cutmix_h = int(np.sqrt(size * ratio))
+        x = np.random.randint(0, img_size)
+        y = np.random.randint(0, img_size)
+
+        if x + cutmix_w <= img_size and y + cutmix_h <= img_size:
+            break
+
+    mask[y:y + cutmix_h, x:x + cutmix_w] = 1
+
+    return mask
+
+
+class DisAvg(object):
+    """
+    refer: https://github.com/pytorch/examples/blob/master/imagenet/main.py
+    """
+
+    def __init__(self, dim=1, last=128):
+        self.reset(dim, last)
+
+    def reset(self, dim, last):
+        self.dis = np.zeros((last, dim))
+        self.n = 0
+        self.dim = dim
+        self.last = last
+
+    def update(self, dis):
+        idx = self.n % self.last
+        self.dis[idx] = dis.copy()
+        self.n += 1
+        self.avg = np.mean(self.dis[:min(self.n, self.last)], 0)
+
+    def disprint(self):
+        num = min(self.n, self.last)
+        print(self.dis[:num])
+
+
+class DistAlign(object):
+    """Align the foreground ratio of the teacher predictions on unlabeled data
+    (disulb) with the one of the labeled masks (ref), per structure."""
+
+    def __init__(self, n_part, last=128):
+        self.n_part = n_part
+        self.ref = DisAvg(dim=n_part, last=last)
+        self.disulb = DisAvg(dim=n_part, last=last)
+
+    def __call__(self, lb_mask, prob_ulb_x_w, pseudo_label):
+        # one device -> host copy per tensor instead of one per structure
+        self.ref.update(lb_mask[:, :self.n_part].float().mean((0, 2, 3)).cpu().numpy().astype(np.float64))
+        self.disulb.update(pseudo_label[:, :self.n_part].float().mean((0, 2, 3)).cpu().numpy().astype(np.float64))
+
+        if all([self.disulb.avg[i] != 0 and self.disulb.avg[i] != 1 for i in range(self.n_part)]):
+            for i in range(self.n_part):
+                rect_fore = (prob_ulb_x_w[:, i] / self.disulb.avg[i]) * self.ref.avg[i]
+                rect_back = ((1 - prob_ulb_x_w[:, i]) / (1 - self.disulb.avg[i])) * (1 - self.ref.avg[i])
+                prob_ulb_x_w[:, i] = rect_fore / (rect_fore + rect_back)
+            pseudo_label = prob_ulb_x_w.ge(0.5).float().detach()
+        return prob_ulb_x_w, pseudo_label
+
+    def state_dict(self):
+        # DisAvg attributes only, the checkpoint must not depend on this class
+        return {'ref': dict(self.ref.__dict__), 'disulb': dict(self.disulb.__dict__)}
+
+    def load_state_dict(self, state):
+        self.ref.__dict__.update(state['ref'])
+        self.disulb.__dict__.update(state['disulb'])
+
+
+class SimpleSampleQueue(object):
+    """Unlabeled samples on which student and teacher agree (hardness = 1 - dice
+    between their predictions below choice_th), with their pseudo-labels and
+    confidence masks. Newest first, at most max_len samples."""
+
+    def __init__(self, n_part, domain_num, dice, max_len=10, increase=1.0005, choice_th=0.1):
+        self.n_part = n_part
+        self.domain_num = domain_num
+        self.dice = dice
+        self.max_len = max_len
+        self.increase = increase
+        self.choice_th = choice_th
+        self.images = None
+        self.pl = None
+        self.gt = None
+        self.hardness = []
+        self.dc = None
+        self.mask = None
+        self.reset_stats()
+
+    def __len__(self):
+        return 0 if self.images is None else len(self.images)
+
+    def reset_stats(self):
+        self.avg_hardness = util.AverageMeter()
+        self.avg_dice = [util.AverageMeter() for i in range(self.n_part)]
+        self.other_ulb_avg_dice = [util.AverageMeter() for i in range(self.n_part)]
+        self.all_ulb_avg_dice = [util.AverageMeter() for i in range(self.n_part)]
+        self.dc_record = [0] * self.domain_num
+        self.simple_ulb_name = {}
+
+    def hardness_of(self, stu_pseudo_label, pseudo_label, first_epoch):
+        stu_tea_dice = self.dice(np.asarray(stu_pseudo_label.cpu()), pseudo_label, ret_arr=True)
+        hardness = 1 - sum(stu_tea_dice[:self.n_part]) / self.n_part
+        if first_epoch:
+            hardness[:] = 1
+        return hardness
+
+    def update(self, hardness, ulb_x_w, pseudo_label, ulb_mask, ulb_dc, conf_mask):
+        simple_ulb_idx = hardness < self.choice_th
+        cur_simple_num = simple_ulb_idx.astype(int).sum()
+        if len(self) == 0:
+            self.images = ulb_x_w[simple_ulb_idx].clone()
+            self.pl = pseudo_label[simple_ulb_idx].clone()
+            self.gt = ulb_mask[simple_ulb_idx].clone()
+            self.hardness = hardness[simple_ulb_idx].copy()
+            self.dc = ulb_dc[simple_ulb_idx]
+            self.mask = conf_mask[simple_ulb_idx].clone()
+            if len(self) > 0:
+                self.choice_th = min(self.choice_th, self.hardness.max())
+        elif cur_simple_num > 0:
+            if len(self) + cur_simple_num > self.max_len:
+                newlen = self.max_len - cur_simple_num
+            else:
+                newlen = len(self)
+            self.images = torch.cat((ulb_x_w[simple_ulb_idx].clone(), self.images[:newlen]), dim=0)
+            self.pl = torch.cat((pseudo_label[simple_ulb_idx].clone(), self.pl[:newlen]), dim=0)
+            self.gt = torch.cat((ulb_mask[simple_ulb_idx].clone(), self.gt[:newlen]), dim=0)
+            self.dc = torch.cat((ulb_dc[simple_ulb_idx].clone(), self.dc[:newlen]), dim=0)
+            self.hardness = np.concatenate((hardness[simple_ulb_idx].copy(), self.hardness[:newlen]))
+            self.mask = torch.cat((conf_mask[simple_ulb_idx].clone(), self.mask[:newlen]), dim=0)
+            self.choice_th = min(self.choice_th, self.hardness.max())
+        else:
+            self.choice_th = min(self.increase * self.choice_th, 0.1)
+        return simple_ulb_idx
+
+    def track(self, simple_ulb_idx, hardness, pseudo_label, ulb_mask, ulb_dc, ulb_name, ulb_dice):
+        """Per-epoch statistics of the selected samples."""
+        if simple_ulb_idx.any():
+            cur_simple_ulb_dice = self.dice(np.asarray(pseudo_label[simple_ulb_idx].cpu()), ulb_mask[simple_ulb_idx])
+            for i in range(self.n_part):
+                self.avg_dice[i].update(cur_simple_ulb_dice[i])
+            self.avg_hardness.update(hardness[simple_ulb_idx].mean())
+            for idx in np.nonzero(simple_ulb_idx)[0]:
+                self.dc_record[ulb_dc[idx].item() - 1] += 1
+                self.simple_ulb_name[ulb_name[idx]] = self.simple_ulb_name.get(ulb_name[idx], 0) + 1
+        other_ulb_idx = ~simple_ulb_idx
+        if other_ulb_idx.any():
+            other_ulb_dice = self.dice(np.asarray(pseudo_label[other_ulb_idx].cpu()), ulb_mask[other_ulb_idx])
+            for i in range(self.n_part):
+                self.other_ulb_avg_dice[i].update(other_ulb_dice[i])
+        for i in range(self.n_part):
+            self.all_ulb_avg_dice[i].update(ulb_dice[i])
+
+    def queue_dice(self):
+        """Dice of the queued pseudo-labels against the ground truth, for logging."""
+        if len(self) == 0:
+            return [-1] * self.n_part
+        return self.dice(np.asarray(self.pl.cpu()), self.gt)
+
+    def sample(self, num):
+        """num random queue entries (with replacement): images, pseudo-labels, masks."""
+        choice = np.random.randint(0, len(self), min(num, len(self)))
+        return self.images[choice], self.pl[choice], self.mask[choice]
+
+    def state_dict(self):
+        return {'images': self.images, 'pl': self.pl, 'gt': self.gt, 'hardness': self.hardness,
+                'dc': self.dc, 'mask': self.mask, 'choice_th': self.choice_th}
+
+    def load_state_dict(self, state):
+        self.images, self.pl, self.gt = state['images'], state['pl'], state['gt']
+        self.hardness, self.dc, self.mask = state['hardness'], state['dc'], state['mask']
+        self.choice_th = state['choice_th']
+
+
+class CutMix(object):
+    """Paste a random box of a labeled (or, with a queue, simple unlabeled) image
+    into every strong view, with its label and confidence mask."""
+
+    def __init__(self, patch_size, prob=1.0, queue=None):
+        self.patch_size = patch_size
+        self.prob = prob
+        self.queue = queue
+
+    def __call__(self, ulb_x_s, lb_x_w, lb_mask, mask_shape):
+        """Returns the mixed strong views and (box, labels, masks) to paste into
+        the pseudo-labels and confidence masks of the strong views later."""
+        num = len(ulb_x_s)
+        cut_mask = lb_mask.new_ones(mask_shape)
+        if self.queue is None or len(self.queue) == 0:
+            cut_img, cut_label = lb_x_w, lb_mask
+            choice = np.random.randint(0, len(lb_x_w), num)
+        else:
+            queue = self.queue
+            cut_img = torch.cat((lb_x_w, queue.images), dim=0)
+            cut_label = torch.cat((lb_mask, queue.pl), dim=0)
+            cut_mask = torch.cat((cut_mask, queue.mask), dim=0)
+            choice_in_simple_num = min(int(num * 0.5), len(queue))
+            choice_in_lb = np.random.randint(0, len(lb_x_w), num - choice_in_simple_num)
+            choice_in_simple = np.random.randint(len(lb_x_w), len(lb_x_w) + len(queue), choice_in_simple_num)
+            choice = np.random.permutation(np.concatenate((choice_in_lb, choice_in_simple)))
+        box = torch.stack([obtain_cutmix_box(img_size=self.patch_size, p=self.prob) for i in range(num)], dim=0)
+        # (B, 1, H, W) bool, broadcast over channels; torch.where needs no host sync
+        box = box.to(ulb_x_s.device, non_blocking=True).unsqueeze(1).bool()
+        ulb_x_s = torch.where(box, cut_img[choice], ulb_x_s)
+        return ulb_x_s, (box, cut_label[choice], cut_mask[choice])
+
+    @staticmethod
+    def paste(mix, pseudo_label, mask):
+        box, cut_label, cut_mask = mix
+        return torch.where(box, cut_label, pseudo_label), torch.where(box, cut_mask, mask)
+
+
+def extract_ampl_phase(fft_im):
+    # fft_im: size should be bx3xhxwx2
+    fft_amp = fft_im[:,:,:,:,0]**2 + fft_im[:,:,:,:,1]**2
+    fft_amp = torch.sqrt(fft_amp)
+    fft_pha = torch.atan2( fft_im[:,:,:,:,1], fft_im[:,:,:,:,0] )
+    return fft_amp, fft_pha
+
+
+def low_freq_mutate( amp_src, amp_trg, L=0.1 ):
+    _, _, h, w = amp_src.size()
+    b = (  np.floor(np.amin((h,w))*L)  ).astype(int)     # get b
+    amp_src[:,:,0:b,0:b]     = amp_trg[:,:,0:b,0:b]      # top left
+    amp_src[:,:,0:b,w-b:w]   = amp_trg[:,:,0:b,w-b:w]    # top right
+    amp_src[:,:,h-b:h,0:b]   = amp_trg[:,:,h-b:h,0:b]    # bottom left
+    amp_src[:,:,h-b:h,w-b:w] = amp_trg[:,:,h-b:h,w-b:w]  # bottom right
+    return amp_src
+
+
+def FDA_source_to_target(src_img, trg_img, L=0.1):
+    # exchange magnitude
+    # input: src_img, trg_img
+
+    # get fft of both source and target (torch.rfft(x, 2, onesided=False) layout)
+    fft_src = torch.view_as_real( torch.fft.fft2( src_img.clone().float() ) )
+    fft_trg = torch.view_as_real( torch.fft.fft2( trg_img.clone().float() ) )
+
+    # extract amplitude and phase of both ffts
+    amp_src, pha_src = extract_ampl_phase( fft_src.clone())
+    amp_trg, pha_trg = extract_ampl_phase( fft_trg.clone())
+
+    # replace the low frequency amplitude part of source with that from target
+    amp_src_ = low_freq_mutate( amp_src.clone(), amp_trg.clone(), L=L )
+
+    # recompose fft of source
+    fft_src_ = torch.zeros( fft_src.size(), dtype=torch.float, device=fft_src.device )
+    fft_src_[:,:,:,:,0] = torch.cos(pha_src.clone()) * amp_src_.clone()
+    fft_src_[:,:,:,:,1] = torch.sin(pha_src.clone()) * amp_src_.clone()
+
+    # get the recomposed image: source content, target style
+    src_in_trg = torch.fft.ifft2( torch.view_as_complex( fft_src_ ) ).real
+
+    return src_in_trg
+
+
+class FDA(object):
+    """Give every labeled image the low-frequency amplitude of a random unlabeled image."""
+
+    def __init__(self, L=0.01):
+        self.L = L
+
+    def __call__(self, lb_x_w, ulb_x_w):
+        choice_fda = np.random.randint(0, len(ulb_x_w), len(lb_x_w))
+        lb_x_w = FDA_source_to_target((lb_x_w + 1) * 127.5, (ulb_x_w[choice_fda] + 1) * 127.5, L=self.L)
+        return lb_x_w / 127.5 - 1
+
+
+class TeacherCache(object):
+    """Teacher probabilities of the un-augmented unlabeled images, warped onto every augmented view.
+
+    The weak view of an unlabeled image is its un-augmented image under a
+    scale-crop, rotation, flip and elastic warp; the dataset records where
+    every pixel of the view comes from (custom_transforms.TrackGeometry), so
+    the teacher prediction of the view is approximated by sampling the cached
+    prediction of the un-augmented image at those positions. The teacher only
+    runs on the images of a batch without an entry or with one older than
+    max_age iterations; it runs in the mode the trainer set (train mode: BN
+    statistics of those images only). Regions filled by the augmentation take
+    the nearest border prediction. Entries are kept in dtype on the device of
+    the predictions, one (C, H, W) map per unlabeled image.
+    """
+
+    def __init__(self, max_age, dtype=torch.float16):
+        self.max_age = max_age
+        self.dtype = dtype
+        self.entries = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits, self.misses = 0, 0
+
+    @property
+    def hit_rate(self):
+        return self.hits / max(1, self.hits + self.misses)
+
+    def __call__(self, teacher, keys, orig, grid, step):
+        """Probabilities of the augmented views of the images keys.
+
+        Args:
+            teacher: callable, probabilities of a batch of un-augmented images
+            keys (list): one hashable key per image of the batch
+            orig (Tensor): (B, C, H0, W0) un-augmented images
+            grid (Tensor): (B, H, W, 2) sampling grid of every view in orig, in [-1, 1]
+            step (int): current iteration
+        """
+        stale = [i for i, k in enumerate(keys) if k not in self.entries or step - self.entries[k][0] >= self.max_age]
+        if stale:
+            prob = teacher(orig[torch.as_tensor(stale, device=orig.device)]).detach().to(self.dtype)
+            for i, p in zip(stale, prob):
+                self.entries[keys[i]] = (step, p)
+        self.misses += len(stale)
+        self.hits += len(keys) - len(stale)
+        cached = torch.stack([self.entries[k][1] for k in keys]).float()
+        return F.grid_sample(cached, grid.float(), mode='bilinear', padding_mode='border', align_corners=False)
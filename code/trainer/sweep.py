@@ -0,0 +1,353 @@
+""" Local sweep of training runs over a grid of flags, on a bounded pool of pinned processes """
+
+import csv
+import hashlib
+import itertools
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from Fundus_dataloaders.cache import build_cache
+from .config import parse_args
+from .data import DATASETS
+from .engine import RESULT_FILE, PROGRESS_FILE, CONTROL_FILE
+
+# flags without a value (store_true)
+SWITCHES = ['overwrite', 'load', 'eval', 'save_image', 'test_stu']
+
+
+def expand_grid(spec):
+    """Cells of spec['grid'], a dict of flag -> values or a list of such dicts, in order."""
+    grids = spec['grid'] if isinstance(spec['grid'], list) else [spec['grid']]
+    cells = []
+    for grid in grids:
+        keys = list(grid)
+        for values in itertools.product(*[v if isinstance(v, list) else [v] for v in grid.values()]):
+            cells.append(dict(zip(keys, values)))
+    return cells
+
+
+def to_argv(flags):
+    argv = []
+    for k, v in flags.items():
+        if k in SWITCHES:
+            argv += ['--' + k] if v else []
+        else:
+            argv += ['--' + k, str(v)]
+    return argv
+
+
+def cell_name(cell):
+    return '_'.join('{}{}'.format(k, v) for k, v in cell.items() if k != 'dataset')
+
+
+def mean_dice(dice):
+    return sum(dice.values()) / len(dice)
+
+
+def set_affinity(pid, cores):
+    """Pin every thread of process pid, not only its main thread, to cores."""
+    try:
+        tids = os.listdir('/proc/{}/task'.format(pid))
+    except OSError:
+        # the process has exited
+        return
+    for tid in tids:
+        try:
+            os.sched_setaffinity(int(tid), cores)
+        except OSError:
+            pass
+
+
+class ASHA(object):
+    """Asynchronous successive halving: stop runs in the bottom of every rung.
+
+    Rung k is reached at min_iter * eta ** k iterations, where a run is scored
+    by the mean over structures of the best validation dice it has tracked so
+    far. Once eta runs have reached a rung, a run reaching it is stopped
+    unless its score is within the top 1 / eta of the scores recorded there;
+    the first ones always continue. Runs are compared as they arrive, so no
+    run waits for a rung to fill. State is kept in path, so a restarted sweep
+    keeps its rungs and does not restart stopped runs.
+    """
+
+    def __init__(self, min_iter, eta=3, path=None):
+        self.min_iter = min_iter
+        self.eta = eta
+        self.path = path
+        self.rungs = []
+        self.stopped = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.rungs, self.stopped = state['rungs'], state['stopped']
+
+    def rung_iter(self, k):
+        return self.min_iter * self.eta ** k
+
+    def decide(self, name, progress):
+        """Rung at which run name is stopped given its progress lines, or None to let it continue."""
+        k = 0
+        while True:
+            entry = next((e for e in progress if e['iter_num'] >= self.rung_iter(k)), None)
+            if entry is None:
+                return None
+            if len(self.rungs) <= k:
+                self.rungs.append({})
+            rung = self.rungs[k]
+            if name not in rung:
+                rung[name] = mean_dice(entry['best_dice'])
+                cutoff = np.percentile(list(rung.values()), 100 * (1 - 1 / self.eta)) if len(rung) >= self.eta else None
+                self.save()
+                if cutoff is not None and rung[name] < cutoff:
+                    self.stopped[name] = k
+                    self.save()
+                    logging.info('{}: dice {:.4f} below {:.4f} at rung {} ({} iterations), stopping'.format(
+                        name, rung[name], cutoff, k, self.rung_iter(k)))
+                    return k
+            k += 1
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'rungs': self.rungs, 'stopped': self.stopped}, f)
+        os.replace(tmp, self.path)
+
+
+class Run(object):
+    """One cell of the sweep: its flags, resolved args and process."""
+
+    def __init__(self, cell, flags, save_name):
+        self.cell = cell
+        self.flags = dict(flags, save_name=save_name)
+        self.args = parse_args(flags.get('method', 'work'), to_argv(self.flags))
+        self.snapshot_path = os.path.join('..', 'model', self.args.dataset, save_name)
+        self.proc = None
+        self.cores = None
+        self.log = None
+        self.start = None
+        self.minutes = None
+        self.status = 'pending'
+
+    @property
+    def result_path(self):
+        return os.path.join(self.snapshot_path, RESULT_FILE)
+
+    def result(self):
+        if not os.path.exists(self.result_path):
+            return None
+        with open(self.result_path) as f:
+            return json.load(f)
+
+    def progress(self):
+        """Validation lines written so far."""
+        path = os.path.join(self.snapshot_path, PROGRESS_FILE)
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            # the last line may be half written
+            lines = [line for line in f if line.endswith('\n')]
+        return [json.loads(line) for line in lines]
+
+    def set_cores(self, cores):
+        """Move the running process to cores and have it train with that many threads."""
+        self.cores = cores
+        set_affinity(self.proc.pid, cores)
+        path = os.path.join(self.snapshot_path, CONTROL_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'threads': max(1, len(cores) // self.args.world_size)}, f)
+        os.replace(path + '.tmp', path)
+
+
+class Sweep(object):
+    """Runs the cells of a grid spec as `python train.py` processes, at most procs at a time.
+
+    Every process is pinned to its own slice of the cores of this process and
+    trains with that many threads. The images of every dataset root are
+    decoded once into a memory-mapped cache under out_dir/cache that all runs
+    read (--data_cache), and the code tree is copied once to out_dir/code
+    instead of into every snapshot. Cells with a result.json are not rerun;
+    a cell whose snapshot path exists without one resumes with --load.
+    Results are collected in out_dir/summary.csv, rewritten as runs finish.
+
+    With asha (an ASHA instance) losing runs are stopped at its rungs; their
+    slots go to pending runs, and once none are left the cores of all free
+    slots are spread over the runs still going.
+
+    Spec (json):
+        grid: dict of flag -> list of values, or a list of them (one grid per dataset)
+        args: flags of every run
+        save_name: template of the run names, formatted with the cell flags
+    """
+
+    def __init__(self, spec, out_dir, procs=1, gpus=None, rerun=False, asha=None):
+        self.spec = spec
+        self.out_dir = out_dir
+        self.procs = max(1, procs)
+        self.gpus = gpus or []
+        self.rerun = rerun
+        self.asha = asha
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+        self.cores = cores
+        per_slot = max(1, len(cores) // self.procs)
+        self.slot_cores = [cores[(i * per_slot) % len(cores):][:per_slot] for i in range(self.procs)]
+        sweep_name = os.path.basename(os.path.normpath(out_dir))
+        template = spec.get('save_name')
+        self.runs = []
+        for cell in expand_grid(spec):
+            flags = dict(spec.get('args', {}), **cell)
+            save_name = template.format(**flags) if template else cell_name(cell)
+            self.runs.append(Run(cell, flags, os.path.join(sweep_name, save_name)))
+
+    def prepare(self):
+        """Decode the datasets of the sweep into the shared cache and copy the code tree once."""
+        os.makedirs(self.out_dir, exist_ok=True)
+        caches = {}
+        for run in self.runs:
+            root = os.path.join(run.args.data_root, DATASETS[run.args.dataset]['folder'])
+            if root not in caches:
+                digest = hashlib.md5(os.path.abspath(root).encode()).hexdigest()[:8]
+                cache_dir = os.path.join(self.out_dir, 'cache', '{}_{}'.format(os.path.basename(os.path.normpath(root)), digest))
+                os.makedirs(os.path.dirname(cache_dir), exist_ok=True)
+                logging.info('decoding {} into {}'.format(root, cache_dir))
+                caches[root] = os.path.abspath(build_cache(root, cache_dir))
+            run.flags['data_cache'] = caches[root]
+        code_dir = os.path.join(self.out_dir, 'code')
+        if os.path.exists(code_dir):
+            shutil.rmtree(code_dir)
+        shutil.copytree('.', code_dir, ignore=shutil.ignore_patterns('.git', '__pycache__'))
+
+    def launch(self, run, slot):
+        cores = self.slot_cores[slot]
+        flags = dict(run.flags, copy_code=0, threads=len(cores))
+        if self.gpus:
+            flags['gpu'] = self.gpus[slot % len(self.gpus)]
+        if os.path.exists(run.snapshot_path):
+            flags['load'] = True
+            # thread count of an earlier sweep
+            if os.path.exists(os.path.join(run.snapshot_path, CONTROL_FILE)):
+                os.remove(os.path.join(run.snapshot_path, CONTROL_FILE))
+        cmd = [sys.executable, 'train.py'] + to_argv(flags)
+        os.makedirs(os.path.join(self.out_dir, 'logs'), exist_ok=True)
+        run.log = open(os.path.join(self.out_dir, 'logs', os.path.basename(run.flags['save_name']) + '.log'), 'w')
+        preexec = (lambda: os.sched_setaffinity(0, cores)) if hasattr(os, 'sched_setaffinity') else None
+        run.proc = subprocess.Popen(cmd, stdout=run.log, stderr=subprocess.STDOUT, preexec_fn=preexec)
+        run.start = time.time()
+        run.cores = cores
+        run.status = 'running'
+        logging.info('[slot {}, cores {}-{}] {}'.format(slot, cores[0], cores[-1], ' '.join(cmd)))
+
+    def finish(self, run):
+        run.log.close()
+        run.minutes = (time.time() - run.start) / 60
+        code = run.proc.returncode
+        if not run.status.startswith('stopped'):
+            run.status = 'done' if code == 0 else 'failed ({})'.format(code)
+        logging.info('{} {} after {:.1f} min'.format(run.flags['save_name'], run.status, run.minutes))
+
+    def run(self):
+        self.prepare()
+        pending = []
+        for run in self.runs:
+            name = run.flags['save_name']
+            if not self.rerun and run.result() is not None:
+                run.status = 'cached'
+            elif not self.rerun and self.asha is not None and name in self.asha.stopped:
+                run.status = 'stopped (rung {})'.format(self.asha.stopped[name])
+            else:
+                pending.append(run)
+        slots = [None] * self.procs
+        try:
+            while pending or any(slots):
+                freed = False
+                for slot, run in enumerate(slots):
+                    if run is None:
+                        continue
+                    if self.asha is not None and run.proc.poll() is None:
+                        rung = self.asha.decide(run.flags['save_name'], run.progress())
+                        if rung is not None:
+                            run.status = 'stopped (rung {})'.format(rung)
+                            run.proc.terminate()
+                            run.proc.wait()
+                    if run.proc.poll() is not None:
+                        self.finish(run)
+                        slots[slot] = None
+                        freed = True
+                        self.write_summary()
+                for slot in range(self.procs):
+                    if slots[slot] is None and pending:
+                        slots[slot] = pending.pop(0)
+                        self.launch(slots[slot], slot)
+                if freed and not pending:
+                    self.rebalance([run for run in slots if run is not None])
+                time.sleep(1)
+        finally:
+            for run in slots:
+                if run is not None and run.proc.poll() is None:
+                    run.proc.terminate()
+                    run.proc.wait()
+                    self.finish(run)
+            self.write_summary()
+        return self.summary()
+
+    def rebalance(self, running):
+        """Spread all cores evenly over the running processes."""
+        if not running or not hasattr(os, 'sched_setaffinity'):
+            return
+        per_run = max(1, len(self.cores) // len(running))
+        for i, run in enumerate(running):
+            cores = self.cores[i * per_run:] if i == len(running) - 1 else self.cores[i * per_run:(i + 1) * per_run]
+            if cores and cores != run.cores:
+                logging.info('{}: cores {}-{}'.format(run.flags['save_name'], cores[0], cores[-1]))
+                run.set_cores(cores)
+
+    def summary(self):
+        """One row per cell: its flags, status, minutes and best dice of teacher and student."""
+        keys = []
+        for run in self.runs:
+            keys += [k for k in run.cell if k not in keys]
+        rows = []
+        for run in self.runs:
+            row = dict(run.cell)
+            row.update(save_name=run.flags['save_name'], status=run.status,
+                       minutes='' if run.minutes is None else round(run.minutes, 1))
+            result = run.result()
+            if result is None and run.status.startswith('stopped'):
+                # best dice tracked until the run was stopped
+                progress = run.progress()
+                result = progress[-1] if progress else None
+            if result is not None:
+                for p, d in result['best_dice'].items():
+                    row['{}_dice'.format(p)] = round(d, 4)
+                for p, d in result['stu_best_dice'].items():
+                    row['stu_{}_dice'.format(p)] = round(d, 4)
+                if 'replica_best_dice' in result:
+                    # spread of the best teacher dice over the seeds of a --replicas run
+                    for p in result['best_dice']:
+                        row['{}_dice_std'.format(p)] = round(float(np.std([r[p] for r in result['replica_best_dice']])), 4)
+            rows.append(row)
+        columns = keys + ['save_name', 'status', 'minutes']
+        for row in rows:
+            columns += [k for k in row if k not in columns]
+        return columns, rows
+
+    def write_summary(self):
+        columns, rows = self.summary()
+        with open(os.path.join(self.out_dir, 'summary.csv'), 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=columns, restval='')
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+def format_table(columns, rows):
+    cells = [[str(c) for c in columns]] + [[str(row.get(c, '')) for c in columns] for row in rows]
+    widths = [max(len(r[i]) for r in cells) for i in range(len(columns))]
+    return '\n'.join('  '.join(v.ljust(w) for v, w in zip(r, widths)) for r in cells)
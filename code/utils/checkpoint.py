@@ -0,0 +1,196 @@
+import atexit
+import glob
+import logging
+import os
+import queue
+import random
+import re
+import shutil
+import threading
+
+import numpy as np
+import torch
+
+TRAIN_STATE = 'train_state_iter_{}.pth'
+
+
+def rng_state():
+    """RNG states of python, numpy, torch and every visible cuda device."""
+    return {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    }
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def atomic_save(obj, path):
+    """torch.save to a temporary file in the same directory, then rename over path."""
+    tmp = '{}.tmp.{}'.format(path, os.getpid())
+    try:
+        torch.save(obj, tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def train_states(snapshot_path):
+    """Full training-state checkpoints in snapshot_path as [(iter_num, path)], oldest first."""
+    found = []
+    for path in glob.glob(os.path.join(snapshot_path, TRAIN_STATE.format('*'))):
+        match = re.search(r'train_state_iter_(\d+)\.pth$', path)
+        if match:
+            found.append((int(match.group(1)), path))
+    return sorted(found)
+
+
+def latest_train_state(snapshot_path):
+    states = train_states(snapshot_path)
+    return states[-1][1] if states else None
+
+
+def load_train_state(path, map_location=None):
+    # the state holds numpy arrays and python RNG tuples, not only tensors
+    return torch.load(path, map_location=map_location, weights_only=False)
+
+
+def to_host(obj):
+    """Copy the tensors of a (nested) state dict to host memory.
+
+    CUDA tensors go to pinned memory with non_blocking=True; returns the copy and
+    a CUDA event to wait on (None if nothing was on the device).
+    """
+    on_device = []
+
+    def copy(x):
+        if torch.is_tensor(x):
+            x = x.detach()
+            if x.is_cuda:
+                on_device.append(x)
+                return torch.empty(x.shape, dtype=x.dtype, pin_memory=True).copy_(x, non_blocking=True)
+            return x.clone()
+        if isinstance(x, np.ndarray):
+            return x.copy()
+        if isinstance(x, dict):
+            return type(x)((k, copy(v)) for k, v in x.items())
+        if isinstance(x, (list, tuple)):
+            return type(x)(copy(v) for v in x)
+        return x
+
+    host = copy(obj)
+    event = None
+    if on_device:
+        event = torch.cuda.Event()
+        event.record()
+    return host, event
+
+
+class CheckpointManager(object):
+    """Write checkpoints from a background thread.
+
+    save() copies the state to host memory on the calling thread and returns;
+    serialization and the atomic temp-file + rename happen on the worker.
+    Saves with the same key as the previous save (e.g. the EMA weights of one
+    iteration that are best for several structures) are not copied or
+    serialized again, the file already written is hard-linked instead.
+
+    Retention: save_state() keeps the keep_last newest train_state checkpoints;
+    save_best() always (over)writes the best file and, if keep_best > 0, also
+    keeps the keep_best highest-scoring of its *_iter_<n>.pth copies.
+    """
+
+    def __init__(self, snapshot_path, keep_last=1, keep_best=0, max_queue=4):
+        self.snapshot_path = snapshot_path
+        self.keep_last = max(1, int(keep_last))
+        self.keep_best = int(keep_best)
+        self._best = {}
+        self._last_key = None
+        self._last_path = None
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._closed = False
+        self._thread = threading.Thread(target=self._worker, name='CheckpointManager', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def save(self, obj, path, key=None):
+        if key is not None and key == self._last_key:
+            self._queue.put(('link', (self._last_path, path)))
+            return
+        host, event = to_host(obj)
+        self._last_key, self._last_path = key, path
+        self._queue.put(('write', (host, path, event)))
+
+    def save_state(self, state):
+        """Full training state, written as train_state_iter_<state['iter_num']>.pth."""
+        self.save(state, os.path.join(self.snapshot_path, TRAIN_STATE.format(state['iter_num'])))
+        self._queue.put(('prune_states', None))
+
+    def save_best(self, obj, name, score, iter_num, key=None):
+        path = os.path.join(self.snapshot_path, name)
+        self.save(obj, path, key)
+        if self.keep_best <= 0:
+            return
+        root, ext = os.path.splitext(path)
+        copy = '{}_iter_{}{}'.format(root, iter_num, ext)
+        self._queue.put(('link', (path, copy)))
+        ranked = sorted(self._best.get(name, []) + [(score, iter_num, copy)], reverse=True)
+        self._best[name] = ranked[:self.keep_best]
+        for _, _, old in ranked[self.keep_best:]:
+            self._queue.put(('remove', old))
+
+    @staticmethod
+    def _link(src, dst):
+        tmp = '{}.tmp.{}'.format(dst, os.getpid())
+        try:
+            os.link(src, tmp)
+        except OSError:
+            shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+
+    def _prune_states(self):
+        for _, old in train_states(self.snapshot_path)[:-self.keep_last]:
+            os.remove(old)
+
+    def _worker(self):
+        while True:
+            kind, payload = self._queue.get()
+            try:
+                if kind == 'write':
+                    host, path, event = payload
+                    if event is not None:
+                        event.synchronize()
+                    atomic_save(host, path)
+                elif kind == 'link':
+                    self._link(*payload)
+                elif kind == 'remove':
+                    if os.path.exists(payload):
+                        os.remove(payload)
+                elif kind == 'prune_states':
+                    self._prune_states()
+                elif kind == 'close':
+                    return
+            except Exception as e:
+                logging.warning('CheckpointManager failed to {}: {}'.format(kind, e))
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """Wait until every queued checkpoint is on disk."""
+        if not self._closed:
+            self._queue.join()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(('close', None))
+        self._thread.join()
@@ -0,0 +1,73 @@
+import torch
+from torch import nn
+
+DTYPES = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+class ModelEMA(object):
+    """Mean-teacher EMA of a student model, updated with multi-tensor (foreach) kernels.
+
+    Args:
+        model (nn.Module): student network
+        ema_model (nn.Module): teacher network, updated in place
+        decay (float): EMA decay, warmed up as min(1 - 1 / (step + 1), decay)
+        interval (int): update every `interval` steps with decay ** interval
+        buffers (str): 'none' leaves teacher buffers alone (the teacher refreshes its own BN
+            statistics in its train-mode forwards), 'copy' copies the student buffers and
+            'ema' averages float buffers like the parameters
+        shadow_dtype (torch.dtype or str, optional): keep the teacher's non-norm parameters in a
+            lower precision (e.g. torch.bfloat16); inputs are cast on the way in and
+            outputs back to float32 on the way out
+    """
+
+    def __init__(self, model, ema_model, decay, interval=1, buffers='none', shadow_dtype=None):
+        assert buffers in ('none', 'copy', 'ema'), 'unknown buffer mode {}'.format(buffers)
+        self.decay = decay
+        self.interval = max(1, int(interval))
+        self.buffers = buffers
+        if isinstance(shadow_dtype, str):
+            shadow_dtype = DTYPES[shadow_dtype]
+        self.shadow_dtype = shadow_dtype
+        if shadow_dtype is not None:
+            self._cast_shadow(ema_model, shadow_dtype)
+        self.ema_params = [p for p in ema_model.parameters()]
+        self.params = [p for p in model.parameters()]
+        ema_buffers = [b for b in ema_model.buffers()]
+        model_buffers = [b for b in model.buffers()]
+        self.ema_float_buffers = [b for b in ema_buffers if b.is_floating_point()]
+        self.float_buffers = [b for b in model_buffers if b.is_floating_point()]
+        self.ema_int_buffers = [b for b in ema_buffers if not b.is_floating_point()]
+        self.int_buffers = [b for b in model_buffers if not b.is_floating_point()]
+        for p in self.ema_params:
+            p.requires_grad_(False)
+
+    @staticmethod
+    def _cast_shadow(ema_model, dtype):
+        for m in ema_model.modules():
+            if isinstance(m, (nn.modules.batchnorm._BatchNorm, nn.GroupNorm, nn.InstanceNorm2d)):
+                continue
+            for p in m.parameters(recurse=False):
+                p.data = p.data.to(dtype)
+        ema_model.register_forward_pre_hook(
+            lambda m, inputs: tuple(x.to(dtype) if torch.is_tensor(x) and x.is_floating_point() else x for x in inputs))
+        ema_model.register_forward_hook(
+            lambda m, inputs, out: out.float() if torch.is_tensor(out) else tuple(o.float() for o in out))
+
+    def alpha(self, global_step):
+        # Use the true average until the exponential average is more correct
+        return min(1 - 1 / (global_step + 1), self.decay) ** self.interval
+
+    @torch.no_grad()
+    def update(self, global_step):
+        if global_step % self.interval != 0:
+            return
+        alpha = self.alpha(global_step)
+        torch._foreach_mul_(self.ema_params, alpha)
+        torch._foreach_add_(self.ema_params, self.params, alpha=1 - alpha)
+        if self.buffers == 'ema':
+            torch._foreach_mul_(self.ema_float_buffers, alpha)
+            torch._foreach_add_(self.ema_float_buffers, self.float_buffers, alpha=1 - alpha)
+        elif self.buffers == 'copy':
+            torch._foreach_copy_(self.ema_float_buffers, self.float_buffers)
+        if self.buffers != 'none':
+            torch._foreach_copy_(self.ema_int_buffers, self.int_buffers)
@@ -30,7 +30,7 @@ def dice_loss1(score, target):
 def entropy_loss(p, C=2):
     # p N*C*W*H*D
     y1 = -1*torch.sum(p*torch.log(p+1e-6), dim=1) / \
-        torch.tensor(np.log(C)).cuda()
+        torch.tensor(np.log(C), device=p.device)
     ent = torch.mean(y1)
 
     return ent
@@ -58,7 +58,7 @@ def softmax_dice_loss(input_logits, target_logits):
 
 def entropy_loss_map(p, C=2):
     ent = -1*torch.sum(p * torch.log(p + 1e-6), dim=1,
-                       keepdim=True)/torch.tensor(np.log(C)).cuda()
+                       keepdim=True)/torch.tensor(np.log(C), device=p.device)
     return ent
 
 
@@ -154,42 +154,56 @@ class FocalLoss(nn.Module):
 
 
 class DiceLoss(nn.Module):
-    def __init__(self, n_classes):
+    """Soft Dice loss per class, 1 - (2|X.Y| + s) / (|X|^2 + |Y|^2 + s) over the whole batch, averaged over the classes.
+
+    One batched reduction for all classes, no host syncs. inputs are
+    (B, C, ...) scores, or logits with softmax=True (multi-class) or
+    sigmoid=True (one binary map per channel). target is either a class
+    index map, (B, ...) or (B, 1, ...), whose ignore_index pixels are left
+    out, or already one map per channel, the shape of inputs.
+    """
+
+    def __init__(self, n_classes, sigmoid=False, ignore_index=None, smooth=1e-5):
         super(DiceLoss, self).__init__()
         self.n_classes = n_classes
+        self.sigmoid = sigmoid
+        self.ignore_index = ignore_index
+        self.smooth = smooth
 
     def _one_hot_encoder(self, input_tensor):
-        tensor_list = []
-        for i in range(self.n_classes):
-            temp_prob = input_tensor == i * torch.ones_like(input_tensor)
-            tensor_list.append(temp_prob)
-        output_tensor = torch.cat(tensor_list, dim=1)
-        return output_tensor.float()
-
-    def _dice_loss(self, score, target):
-        target = target.float()
-        smooth = 1e-5
-        intersect = torch.sum(score * target)
-        y_sum = torch.sum(target * target)
-        z_sum = torch.sum(score * score)
-        loss = (2 * intersect + smooth) / (z_sum + y_sum + smooth)
-        loss = 1 - loss
-        return loss
+        """Class index map -> (B, C, ...) one-hot and the (B, 1, ...) map of pixels that are not ignored."""
+        target = input_tensor.long()
+        if target.dim() > 1 and target.shape[1] == 1:
+            target = target.squeeze(1)
+        if self.ignore_index is None:
+            valid = None
+        else:
+            valid = target.ne(self.ignore_index)
+            target = target.masked_fill(~valid, 0)
+            valid = valid.unsqueeze(1)
+        return F.one_hot(target, self.n_classes).movedim(-1, 1), valid
 
     def forward(self, inputs, target, weight=None, softmax=False):
         if softmax:
             inputs = torch.softmax(inputs, dim=1)
-        target = self._one_hot_encoder(target)
-        if weight is None:
-            weight = [1] * self.n_classes
+        elif self.sigmoid:
+            inputs = torch.sigmoid(inputs)
+        inputs = inputs.float()
+        valid = None
+        if target.shape != inputs.shape:
+            target, valid = self._one_hot_encoder(target)
+        target = target.float()
         assert inputs.size() == target.size(), 'predict & target shape do not match'
-        class_wise_dice = []
-        loss = 0.0
-        for i in range(0, self.n_classes):
-            dice = self._dice_loss(inputs[:, i], target[:, i])
-            class_wise_dice.append(1.0 - dice.item())
-            loss += dice * weight[i]
-        return loss / self.n_classes
+        if valid is not None:
+            inputs, target = inputs * valid, target * valid
+        dims = [0] + list(range(2, inputs.dim()))
+        intersect = torch.sum(inputs * target, dims)
+        y_sum = torch.sum(target * target, dims)
+        z_sum = torch.sum(inputs * inputs, dims)
+        dice = 1 - (2 * intersect + self.smooth) / (z_sum + y_sum + self.smooth)
+        if weight is not None:
+            dice = dice * torch.as_tensor(weight, dtype=dice.dtype).to(dice.device, non_blocking=True)
+        return dice.sum() / self.n_classes
 
 
 def entropy_minmization(p):
@@ -217,3 +231,113 @@ def compute_kl_loss(p, q):
 
     loss = (p_loss + q_loss) / 2
     return loss
+
+
+# elements of the fp32 temporaries of masked_bce, per chunk of samples
+MASKED_BCE_CHUNK = 2 ** 20
+
+
+def _sample_chunks(x):
+    # whole samples per chunk: slices along dim 0 keep the memory format of x
+    per_sample = max(1, x[0].numel()) if len(x) else 1
+    step = max(1, MASKED_BCE_CHUNK // per_sample)
+    return [slice(s, s + step) for s in range(0, len(x), step)]
+
+
+class MaskedBCEWithLogits(torch.autograd.Function):
+    """mean(bce_with_logits(logits, target) * mask) over all elements, the BCE in fp32.
+
+    target and mask are binary and kept as bool for backward; loss and
+    gradient are computed a chunk of samples at a time, so neither the BCE
+    map, the float mask nor their product are ever full size, and nothing
+    but the bool maps (and logits, which the graph keeps anyway) is saved.
+    """
+
+    @staticmethod
+    def forward(ctx, logits, target, mask):
+        target = target if target.dtype == torch.bool else target.bool()
+        mask = mask if mask.dtype == torch.bool else mask.bool()
+        total = torch.zeros((), dtype=torch.float32, device=logits.device)
+        for s in _sample_chunks(logits):
+            x = logits[s].float()
+            # max(x, 0) - x * t + log(1 + exp(-|x|)), stable for any x
+            loss = x.clamp(min=0) - torch.where(target[s], x, 0.0) + torch.log1p(torch.exp(-x.abs()))
+            total += torch.where(mask[s], loss, 0.0).sum()
+        ctx.save_for_backward(logits, target, mask)
+        return total / logits.numel()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        logits, target, mask = ctx.saved_tensors
+        scale = grad_output.float() / logits.numel()
+        grad = torch.empty_like(logits)
+        for s in _sample_chunks(logits):
+            x = logits[s].float()
+            grad[s] = torch.where(mask[s], torch.sigmoid(x) - target[s].float(), 0.0) * scale
+        return grad, None, None
+
+
+def masked_bce(logits, target, mask):
+    """(F.binary_cross_entropy_with_logits(logits.float(), target, reduction='none') * mask).mean() for
+    binary target and mask (bool, uint8 or 0/1 float), without its full-size temporaries."""
+    return MaskedBCEWithLogits.apply(logits, target, mask)
+
+
+if __name__ == '__main__':
+    # masked_bce against the reference expression: value, gradient, time and memory; run from code/:
+    # python -m utils.losses [size ...]
+    import sys
+    import time
+
+    def reference(logits, target, mask):
+        return (F.binary_cross_entropy_with_logits(logits.float(), target, reduction='none') * mask).mean()
+
+    def saved_bytes(fn, *inputs):
+        # size of what autograd keeps for backward, on any device
+        saved = []
+        with torch.autograd.graph.saved_tensors_hooks(lambda t: saved.append(t.numel() * t.element_size()) or t, lambda t: t):
+            fn(*inputs)
+        return sum(saved)
+
+    def run(fn, logits, target, mask, steps=5):
+        cuda = logits.device.type == 'cuda'
+        if cuda:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated() if cuda else 0
+        for i in range(steps + 1):
+            if i == 1:
+                if cuda:
+                    torch.cuda.synchronize()
+                start = time.perf_counter()
+            logits.grad = None
+            loss = fn(logits, target, mask)
+            loss.backward()
+        if cuda:
+            torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated() - base if cuda else None
+        return (time.perf_counter() - start) / steps * 1000, peak, loss.detach(), logits.grad.clone()
+
+    sizes = [int(s) for s in sys.argv[1:]] or [256, 384]
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    batch, channels = 8, 2
+    print('device: {}, batch {}, {} channels'.format(device, batch, channels))
+    torch.manual_seed(0)
+    for size in sizes:
+        for dtype in [torch.float32, torch.float16 if device == 'cuda' else torch.bfloat16]:
+            logits = (4 * torch.randn(batch, channels, size, size, device=device)).to(dtype).requires_grad_()
+            prob = torch.rand(batch, channels, size, size, device=device)
+            target = prob.ge(0.5).float()
+            # confidence mask as Trainer.confidence_mask builds it
+            mask = prob.ge(0.9).float() + prob.le(0.1).float()
+            results = {}
+            for name, fn, args in [('reference', reference, (target, mask)),
+                                   ('masked_bce', masked_bce, (target.bool(), mask.bool()))]:
+                ms, peak, value, grad = run(fn, logits, *args)
+                results[name] = (value, grad)
+                memory = '' if peak is None else ', peak {:.1f} MB'.format(peak / 2 ** 20)
+                print('{}x{} {} {}: {:.2f} ms/step, saved for backward {:.1f} MB{}'.format(
+                    size, size, str(dtype).split('.')[-1], name, ms, saved_bytes(fn, logits, *args) / 2 ** 20, memory), flush=True)
+            (ref_value, ref_grad), (value, grad) = results['reference'], results['masked_bce']
+            print('    |loss diff| {:.2e}, max |grad diff| {:.2e}'.format(
+                (value - ref_value).abs().item(), (grad.float() - ref_grad.float()).abs().max().item()), flush=True)
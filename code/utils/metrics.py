@@ -9,6 +9,10 @@
 import numpy as np
 from medpy import metric
 import torch
+from scipy.ndimage import distance_transform_edt
+
+# hidden parabolas popped per position by euclidean_distance_transform on a GPU before it checks on the host
+EDT_DEVICE_POPS = 4
 
 def cal_dice(prediction, label, num=2):
     total_dice = np.zeros(num-1)
@@ -49,47 +53,130 @@ def dice(input, target, ignore_index=None):
 
 bce = torch.nn.BCEWithLogitsLoss(reduction='none')
 
-def _upscan(f):
-    for i, fi in enumerate(f):
-        if fi == np.inf: continue
-        for j in range(1,i+1):
-            x = fi+j*j
-            if f[i-j] < x: break
-            f[i-j] = x
+def _nearest_seed_sq(seeds):
+    """Squared distance along the last dim to the nearest True of seeds, inf on a line without any."""
+    pos = torch.arange(seeds.shape[-1], device=seeds.device, dtype=torch.float64).expand(seeds.shape)
+    inf = float('inf')
+    left = torch.where(seeds, pos, -inf).cummax(-1).values
+    right = torch.where(seeds, pos, inf).flip(-1).cummin(-1).values.flip(-1)
+    d = torch.minimum(pos - left, right - pos)
+    return d * d
+
+
+def _lower_envelope_sq(f, max_pops=None):
+    """min over k of f[..., k] + (q - k)^2 for every q along the last dim of f (float64, inf allowed).
+
+    The lower envelope of the parabolas (Felzenszwalb & Huttenlocher,
+    Distance Transforms of Sampled Functions, 2012) is built for all lines at
+    once, one position at a time, and read back with one repeat_interleave.
+    With max_pops, every position pops at most that many hidden parabolas
+    without asking the host; if a line needed more, the axis is redone with
+    the exact loop, so the result is exact either way.
+    """
+    shape = f.shape
+    n = shape[-1]
+    # position-major: step q reads one contiguous row of all lines
+    fq = f.reshape(-1, n).t().contiguous()
+    lines = fq.shape[1]
+    device, dtype, inf = f.device, f.dtype, float('inf')
+    base = torch.arange(lines, device=device) * n
+    # the envelope of every line, a stack of (v, f[v] + v^2, left bound) records, and its top
+    stack = torch.empty((lines * n, 3), dtype=dtype, device=device)
+    k = torch.full((lines,), -1, dtype=torch.long, device=device)
+    # on an empty stack the first parabola gets the bound -inf and is never hidden
+    top = torch.tensor([-1.0, inf, float('nan')], dtype=dtype, device=device).repeat(lines, 1)
+    finite = torch.isfinite(fq)
+    dense = finite.all(1).tolist()
+    unresolved = torch.zeros((), dtype=torch.bool, device=device)
+    for q in range(n):
+        g = fq[q] + q * q
+        # where the parabola of q overtakes the one on top
+        s = (g - top[:, 1]) / (2 * (q - top[:, 0]))
+        pops = 0
+        while True:
+            hidden = s <= top[:, 2]
+            if max_pops is None:
+                if not bool(hidden.any()):
+                    break
+            elif pops == max_pops:
+                unresolved |= hidden.any()
+                break
+            k = k - hidden.long()
+            top = torch.where(hidden[:, None], stack.index_select(0, base + k.clamp(min=0)), top)
+            s = torch.where(hidden, (g - top[:, 1]) / (2 * (q - top[:, 0])), s)
+            pops += 1
+        new = torch.stack([torch.full_like(g, q), g, s], 1)
+        if dense[q]:
+            k = k + 1
+            stack.index_copy_(0, base + k, new)
+            top = new
+        else:
+            active = finite[q]
+            k = k + active.long()
+            pos = base + k.clamp(min=0)
+            top = torch.where(active[:, None], new, top)
+            stack.index_copy_(0, pos, torch.where(active[:, None], new, stack.index_select(0, pos)))
+    if max_pops is not None and bool(unresolved):
+        return _lower_envelope_sq(f)
+    # parabola j serves the positions from its bound up to the next one
+    stack = stack.view(lines, n, 3)
+    empty = k < 0
+    k = k.clamp(min=0)
+    start = (stack[:, :, 2].floor() + 1).clamp(0, n)
+    start[:, 0] = 0
+    start = torch.where(torch.arange(n, device=device) <= k[:, None], start, n)
+    end = torch.cat([start[:, 1:], start.new_full((lines, 1), n)], 1)
+    serving = torch.repeat_interleave(stack[:, :, :2].reshape(-1, 2), (end - start).long().view(-1), dim=0, output_size=lines * n)
+    v, h = serving.view(lines, n, 2).unbind(-1)
+    qs = torch.arange(n, device=device, dtype=dtype)
+    d = torch.where(empty[:, None], inf, (qs - v) ** 2 + (h - v * v))
+    return d.reshape(shape)
+
+
+def euclidean_distance_transform(seeds, ndim=2):
+    """Exact Euclidean distance of every pixel to the nearest True pixel of seeds, over its last ndim dims.
+
+    Leading dims are a batch. Returns a float64 tensor on the device of
+    seeds, 0 on the seeds and inf in an image without any. The first axis
+    comes from the nearest seed on each side, every further one from a
+    lower-envelope pass over all lines at once. On a GPU the passes wait on
+    the host once per axis; numpy arrays go through distance_transform.
+    """
+    seeds = torch.as_tensor(seeds).bool()
+    d = _nearest_seed_sq(seeds)
+    max_pops = EDT_DEVICE_POPS if seeds.is_cuda else None
+    for axis in range(2, ndim + 1):
+        d = _lower_envelope_sq(d.transpose(-1, -axis), max_pops).transpose(-1, -axis)
+    return d.sqrt()
+
 
 def distance_transform(bitmap):
-    f = np.where(bitmap, 0.0, np.inf)
-    for ibatch in range(f.shape[0]):
-        for i in range(f.shape[1]):
-            _upscan(f[ibatch, i, :])
-            _upscan(f[ibatch, i,::-1])
-        for i in range(f.shape[2]):
-            _upscan(f[ibatch, :,i])
-            _upscan(f[ibatch, ::-1,i])
-            np.sqrt(f[ibatch], f[ibatch])
-    return f
+    """Euclidean distance of every pixel of a (B, H, W) bitmap to its nearest nonzero pixel, inf for an empty image."""
+    bitmap = np.asarray(bitmap).astype(bool)
+    return np.stack([distance_transform_edt(~b) if b.any() else np.full(b.shape, np.inf) for b in bitmap])
+
 
 def WatershedCrossEntropy(input, target):
 
-    # Distance Transform
-    discmap = target.data.cpu()[:, 0, :, :]
-    cupmap = target.data.cpu()[:, 1, :, :]
-    disc_DT = distance_transform(discmap)
-    cup_DT = distance_transform(cupmap)
-    disc_DT = torch.from_numpy(disc_DT).float()
-    cup_DT = torch.from_numpy(cup_DT).float()
+    # Distance Transform, on the device when the input already lives on a GPU
+    discmap = target.detach()[:, 0, :, :].to(input.device)
+    cupmap = target.detach()[:, 1, :, :].to(input.device)
+    if input.is_cuda:
+        disc_DT = euclidean_distance_transform(discmap).float()
+        cup_DT = euclidean_distance_transform(cupmap).float()
+    else:
+        disc_DT = torch.from_numpy(distance_transform(discmap.numpy())).float()
+        cup_DT = torch.from_numpy(distance_transform(cupmap.numpy())).float()
 
     disc_DT = discmap * (1.0 - disc_DT/torch.max(disc_DT)) + 1.0
     cup_DT = cupmap * (1.0 - cup_DT/torch.max(cup_DT)) + 1.0
 
-    disc_DT = disc_DT.cuda()
-    cup_DT = cup_DT.cuda()
-
     CEloss = bce(input, target)
 
     return torch.mean(disc_DT* CEloss[:, 0 , :, :]+
                       cup_DT*CEloss[:, 1 , :, :])
 
+
 def cross_entropy2d(input, target, weight=None, size_average=False):
     # input: (n, c, h, w), target: (n, h, w)
     n, c, h, w = input.size()
@@ -262,4 +349,35 @@ def Balanced_DiceLoss(input, target):
     '''
     input = torch.sigmoid(input)
 
-    return 0.5 * (DiceLoss(input[:, 0, ...], target[:, 0, ...]) + DiceLoss(input[:, 1, ...], target[:, 1, ...]))
\ No newline at end of file
+    return 0.5 * (DiceLoss(input[:, 0, ...], target[:, 0, ...]) + DiceLoss(input[:, 1, ...], target[:, 1, ...]))
+
+
+if __name__ == '__main__':
+    # euclidean_distance_transform against scipy, image by image; run from code/:
+    # python -m utils.metrics [size ...]
+    import sys
+    import time
+
+    sizes = [int(s) for s in sys.argv[1:]] or [256, 384]
+    devices = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+    batch = 8
+    rng = np.random.RandomState(0)
+    for size in sizes:
+        # blobs like segmentation masks, and sparse seeds
+        for name, bitmap in [('blobs', rng.rand(batch, size // 16, size // 16).repeat(16, 1).repeat(16, 2) > 0.7),
+                             ('sparse', rng.rand(batch, size, size) > 0.999)]:
+            start = time.perf_counter()
+            reference = np.stack([distance_transform_edt(~b) for b in bitmap])
+            scipy_ms = (time.perf_counter() - start) * 1000
+            for device in devices:
+                seeds = torch.from_numpy(bitmap).to(device)
+                euclidean_distance_transform(seeds)
+                if device == 'cuda':
+                    torch.cuda.synchronize()
+                start = time.perf_counter()
+                out = euclidean_distance_transform(seeds)
+                if device == 'cuda':
+                    torch.cuda.synchronize()
+                ms = (time.perf_counter() - start) * 1000
+                print('{} x {}x{} {} on {}: {:.1f} ms (scipy {:.1f} ms), max |diff| {:.2e}'.format(
+                    batch, size, size, name, device, ms, scipy_ms, np.abs(out.cpu().numpy() - reference).max()), flush=True)
@@ -0,0 +1,141 @@
+import math
+import time
+
+import numpy as np
+import torch
+from torch import nn
+from torch.optim.lr_scheduler import LambdaLR
+
+_NORMS = (nn.modules.batchnorm._BatchNorm, nn.GroupNorm, nn.modules.instancenorm._InstanceNorm, nn.LayerNorm)
+
+
+def param_groups(net, weight_decay, bn_wd_skip=True):
+    '''
+    split the parameters of net into a decay and a no_decay group.
+    no_decay holds normalization parameters and biases (1-d tensors, not
+    counting the leading replica dimension of networks.stacked.Stacked);
+    if not bn_wd_skip both groups use weight_decay.
+    '''
+    decay = []
+    no_decay = []
+    stacked_dims = getattr(net, 'stacked_dims', 0)
+    for module in net.modules():
+        for param in module.parameters(recurse=False):
+            if not param.requires_grad:
+                continue
+            if isinstance(module, _NORMS) or param.ndim - stacked_dims <= 1:
+                no_decay.append(param)
+            else:
+                decay.append(param)
+    return [{'params': decay, 'weight_decay': weight_decay},
+            {'params': no_decay, 'weight_decay': 0.0 if bn_wd_skip else weight_decay}]
+
+
+def get_SGD(net, lr=0.1, momentum=0.9, weight_decay=5e-4, nesterov=False, bn_wd_skip=True, impl='foreach'):
+    '''
+    return torch.optim.SGD over the param_groups of net.
+    impl: 'foreach' (multi-tensor kernels), 'fused' (single fused kernel,
+    falls back to foreach where unsupported) or 'for' (per-parameter loop).
+    '''
+    kwargs = {}
+    if impl == 'fused':
+        kwargs['fused'] = True
+    elif impl == 'foreach':
+        kwargs['foreach'] = True
+    else:
+        kwargs['foreach'] = False
+    groups = param_groups(net, weight_decay, bn_wd_skip)
+    try:
+        return torch.optim.SGD(groups, lr=lr, momentum=momentum, weight_decay=weight_decay,
+                               nesterov=nesterov, **kwargs)
+    except RuntimeError:
+        # fused SGD is not available for every device / dtype
+        return torch.optim.SGD(groups, lr=lr, momentum=momentum, weight_decay=weight_decay,
+                               nesterov=nesterov, foreach=True)
+
+
+def _cosine_lambda(num_training_steps, num_cycles=7./16., num_warmup_steps=0):
+    def _lr_lambda(current_step):
+        '''
+        _lr_lambda returns a multiplicative factor given an interger parameter epochs.
+        Decaying criteria: last_epoch
+        '''
+
+        if current_step < num_warmup_steps:
+            _lr = float(current_step) / float(max(1, num_warmup_steps))
+        else:
+            num_cos_steps = float(current_step - num_warmup_steps)
+            num_cos_steps = num_cos_steps / float(max(1, num_training_steps - num_warmup_steps))
+            _lr = max(0.0, math.cos(math.pi * num_cycles * num_cos_steps))
+        return _lr
+
+    return _lr_lambda
+
+
+def get_cosine_schedule_with_warmup(optimizer,
+                                    num_training_steps,
+                                    num_cycles=7./16.,
+                                    num_warmup_steps=0,
+                                    last_epoch=-1):
+    '''
+    Get cosine scheduler (LambdaLR).
+    if warmup is needed, set num_warmup_steps (int) > 0.
+    '''
+    return LambdaLR(optimizer, _cosine_lambda(num_training_steps, num_cycles, num_warmup_steps), last_epoch)
+
+
+def get_lr_table(base_lr, max_iterations, schedule='poly', power=0.9, num_warmup_steps=0):
+    '''
+    precompute the learning rate for every iteration in [0, max_iterations].
+    poly: base_lr * (1 - i / max_iterations) ** power, as in the training scripts.
+    cosine: base_lr * the factor of get_cosine_schedule_with_warmup.
+    '''
+    steps = np.arange(max_iterations + 1, dtype=np.float64)
+    if schedule == 'poly':
+        table = base_lr * (1.0 - steps / max_iterations) ** power
+    elif schedule == 'cosine':
+        factor = _cosine_lambda(max_iterations, num_warmup_steps=num_warmup_steps)
+        table = base_lr * np.array([factor(i) for i in range(max_iterations + 1)])
+    else:
+        raise ValueError('Learning rate schedule {} is not supported'.format(schedule))
+    return table.tolist()
+
+
+def set_lr(optimizer, lr):
+    for param_group in optimizer.param_groups:
+        param_group['lr'] = lr
+
+
+def benchmark_step(optimizer, steps=50, warmup=5):
+    '''time optimizer.step() in ms per step, with fixed random gradients.'''
+    params = [p for group in optimizer.param_groups for p in group['params']]
+    grads = [torch.randn_like(p) for p in params]
+    cuda = params[0].is_cuda
+    total = 0.0
+    for i in range(warmup + steps):
+        optimizer.zero_grad(set_to_none=True)
+        for p, g in zip(params, grads):
+            p.grad = g.clone()
+        if cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        optimizer.step()
+        if cuda:
+            torch.cuda.synchronize()
+        if i >= warmup:
+            total += time.perf_counter() - start
+    return total / steps * 1000
+
+
+if __name__ == '__main__':
+    # optimizer-step benchmark, run from code/: python -m utils.optimizer
+    from networks.unet_model import UNet
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    net = UNet(n_channels=3, n_classes=2).to(device)
+    print('device: {}'.format(device))
+    baseline = torch.optim.SGD(net.parameters(), lr=0.01, momentum=0.9, weight_decay=1e-4, foreach=False)
+    print('optim.SGD(model.parameters()) per-parameter loop: {:.3f} ms/step'.format(benchmark_step(baseline)))
+    for impl in ['foreach', 'fused']:
+        optimizer = get_SGD(net, lr=0.01, momentum=0.9, weight_decay=1e-4, impl=impl)
+        print('get_SGD(impl={}): {:.3f} ms/step'.format(impl, benchmark_step(optimizer)))
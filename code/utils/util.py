@@ -217,7 +217,7 @@ def compute_sdf(img_gt, out_shape):
     normalized_sdf = np.zeros(out_shape)
 
     for b in range(out_shape[0]):  # batch size
-        posmask = img_gt[b].astype(np.bool)
+        posmask = img_gt[b].astype(bool)
         if posmask.any():
             negmask = ~posmask
             posdis = distance(posmask)
@@ -237,19 +237,152 @@ def compute_sdf(img_gt, out_shape):
 
 
 # set up process group for distributed computing
-def distributed_setup(rank, world_size):
-    os.environ["MASTER_ADDR"] = "localhost"
-    os.environ["MASTER_PORT"] = "12355"
-    print("setting up dist process group now")
-    dist.init_process_group("nccl", rank=rank, world_size=world_size)
+def distributed_setup(rank, world_size, backend='gloo', port=12355):
+    """Join the process group of world_size local processes (gloo for CPU, nccl for GPUs)."""
+    os.environ.setdefault("MASTER_ADDR", "localhost")
+    os.environ.setdefault("MASTER_PORT", str(port))
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+
+
+def distributed_cleanup():
+    if dist.is_available() and dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def broadcast_module(module, src=0, buffers_only=False):
+    """Copy the parameters and buffers of rank src into module on every rank."""
+    tensors = [] if buffers_only else [p.data for p in module.parameters()]
+    tensors += [b for b in module.buffers()]
+    for t in tensors:
+        dist.broadcast(t, src)
+
+
+def all_reduce_grads(params, world_size):
+    """Average the gradients of params over all processes with a single flat all_reduce."""
+    grads = [p.grad for p in params if p.grad is not None]
+    if world_size <= 1 or not grads:
+        return
+    flat = torch._utils._flatten_dense_tensors(grads)
+    dist.all_reduce(flat)
+    flat.div_(world_size)
+    for grad, synced in zip(grads, torch._utils._unflatten_dense_tensors(flat, grads)):
+        grad.copy_(synced)
 
 
 def load_ddp_to_nddp(state_dict):
-    pattern = re.compile("module")
-    for k, v in state_dict.items():
-        if re.search("module", k):
-            model_dict[re.sub(pattern, "", k)] = v
-        else:
-            model_dict = state_dict
-    return model_dict
+    """Strip the 'module.' prefix DistributedDataParallel adds to state dict keys."""
+    return {re.sub(r'^module\.', '', k): v for k, v in state_dict.items()}
+
+
+class ResumableSampler(Sampler):
+    """Shuffles like RandomSampler, but the permutation of every pass is a
+    function of (seed, epoch) and a pass can start at an offset, so the sample
+    order can be restored after a restart. With num_replicas > 1 every rank
+    takes its own strided shard of the same permutation, padded (like
+    DistributedSampler) so that all shards have the same length.
+    Args:
+        data_source (Dataset): dataset to sample from
+        seed (int): base seed of the permutations, the same on every rank
+        num_replicas (int): number of processes sharing the dataset
+        rank (int): shard of this process
+    """
+
+    def __init__(self, data_source, seed=0, num_replicas=1, rank=0):
+        self.total_size = len(data_source)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_samples = -(-self.total_size // num_replicas)
+        self.seed = seed
+        self.epoch = 0
+        self.offset = 0
+
+    def set_position(self, epoch, offset):
+        self.epoch = epoch
+        self.offset = offset
+
+    def _shard(self, seed):
+        g = torch.Generator()
+        g.manual_seed(seed * 100003 + self.epoch)
+        perm = torch.randperm(self.total_size, generator=g).tolist()
+        if self.num_replicas > 1:
+            perm += perm[:self.num_samples * self.num_replicas - self.total_size]
+            perm = perm[self.rank::self.num_replicas]
+        return perm
+
+    def __iter__(self):
+        return iter(self._shard(self.seed)[self.offset:])
+
+    def __len__(self):
+        return self.num_samples - self.offset
 
+
+class StackedSampler(ResumableSampler):
+    """ResumableSampler for `stack` models trained side by side (networks.stacked).
+
+    Every batch of stack * batch_size indices holds batch_size samples of each
+    model's own permutation, model k seeded with seed + k (model 0 sees the
+    order of a ResumableSampler with the same seed). A pass ends when every
+    model has seen its shard once; the last batch of each is topped up from
+    the start of its permutation, so that all batches are full.
+    """
+
+    def __init__(self, data_source, batch_size, stack, seed=0, num_replicas=1, rank=0):
+        super().__init__(data_source, seed=seed, num_replicas=num_replicas, rank=rank)
+        self.batch_size = batch_size
+        self.stack = stack
+        self.steps = -(-self.num_samples // batch_size)
+
+    def __iter__(self):
+        size = self.steps * self.batch_size
+        shards = []
+        for k in range(self.stack):
+            shard = self._shard(self.seed + k)
+            shards.append((shard * -(-size // len(shard)))[:size])
+        order = [i for step in range(self.steps) for shard in shards
+                 for i in shard[step * self.batch_size:(step + 1) * self.batch_size]]
+        return iter(order[self.offset:])
+
+    def __len__(self):
+        return self.steps * self.batch_size * self.stack - self.offset
+
+
+class ResumableCycle(object):
+    """Endless iterator over a DataLoader built on a ResumableSampler.
+
+    Like `cycle`, but counts the samples the training loop has actually consumed
+    (not what the workers prefetched), so state_dict() / load_state_dict() can
+    resume at the same position of the same permutation.
+    """
+
+    def __init__(self, dataloader):
+        assert isinstance(dataloader.sampler, ResumableSampler)
+        self.dataloader = dataloader
+        self.epoch = 0
+        self.consumed = 0
+        self._iter = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._iter is None:
+            self.dataloader.sampler.set_position(self.epoch, self.consumed)
+            self._iter = iter(self.dataloader)
+        try:
+            batch = next(self._iter)
+        except StopIteration:
+            self.epoch += 1
+            self.consumed = 0
+            self.dataloader.sampler.set_position(self.epoch, 0)
+            self._iter = iter(self.dataloader)
+            batch = next(self._iter)
+        self.consumed += len(batch['image'])
+        return batch
+
+    def state_dict(self):
+        return {'epoch': self.epoch, 'consumed': self.consumed}
+
+    def load_state_dict(self, state):
+        self.epoch = state['epoch']
+        self.consumed = state['consumed']
+        self._iter = None
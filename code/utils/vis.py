@@ -0,0 +1,182 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+
+import numpy as np
+import torch
+from numpy import ndarray
+from torchvision.utils import make_grid
+
+
+def draw_contour(
+    image: ndarray,
+    label: ndarray,
+    color: tuple[int, int, int],
+) -> ndarray:
+    """Draw contour of label on image with color.
+
+    Uses `cv2.dilate` to find contour.
+
+    Args:
+        image: ndarray of shape (h, w, 3)
+        label: ndarray of shape (h, w) where non-zero values are foreground
+        color: color of contour
+    """
+    import cv2
+
+    binary = (label > 0).astype('uint8') * 255
+    dilated = cv2.dilate(binary, np.ones((3, 3), dtype='uint8'), iterations=1)
+    contour_mask = (dilated - binary) > 0
+    image[contour_mask] = color
+    return image
+
+
+def make_prediction(
+    image: ndarray,
+    *predictions: tuple[ndarray, tuple[int, int, int]],
+) -> ndarray:
+    """Draw contour of predictions on image.
+
+    Args:
+        image: ndarray of shape (h, w) or (h, w, 3)
+            if image is (h, w), it will be repeated to (h, w, 3)
+        predictions: each prediction is a tuple of (label, color)
+            label: ndarray of shape (c, h, w) or (h, w)
+                where c is number of classes or 1
+            color: color of contour
+    """
+    if image.ndim == 2:
+        # expand to (h, w, 3)
+        image = np.repeat(image[..., np.newaxis], 3, axis=-1)
+
+    for prediction, color in predictions:
+        if prediction.ndim == 2:
+            # expand to (1, h, w)
+            prediction = prediction[np.newaxis, ...]
+        for class_map in prediction:
+            image = draw_contour(image, class_map, color)
+    return image
+
+
+def image_u8(x):
+    """(C, H, W) image normalized to [-1, 1] -> uint8 on the same device."""
+    return ((x.detach().float() + 1) * 127.5).round_().clamp_(0, 255).to(torch.uint8)
+
+
+def mask_u8(x, logits=False):
+    """(H, W) or (C, H, W) mask -> uint8 {0, 1}; logits are thresholded at 0 (sigmoid >= 0.5)."""
+    x = x.detach()
+    return (x.ge(0) if logits else x.ge(0.5)).to(torch.uint8)
+
+
+class Visualizer(object):
+    """Render make_grid panels and contour overlays on a worker thread.
+
+    Callers hand over small uint8 snapshots (see image_u8 / mask_u8) of only the
+    sample they want to show; the copy to host is non-blocking and the grid
+    building, normalization and contour drawing happen off the training thread.
+    When neither a writer nor a save_dir is given the visualizer is disabled:
+    check `enabled` before preparing snapshots to skip the work entirely.
+    """
+
+    def __init__(self, writer=None, save_dir=None, max_queue=64):
+        self.writer = writer
+        self.save_dir = save_dir
+        self.enabled = writer is not None or save_dir is not None
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        if self.enabled:
+            if save_dir is not None and not os.path.exists(save_dir):
+                os.makedirs(save_dir)
+            self._thread = threading.Thread(target=self._worker, name='Visualizer', daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    @staticmethod
+    def _to_host(tensors):
+        host = [t.to('cpu', non_blocking=True) for t in tensors]
+        event = None
+        if any(t.is_cuda for t in tensors):
+            event = torch.cuda.Event()
+            event.record()
+        return host, event
+
+    def add_grid(self, tag, panels, nrow, global_step, padding=2, pad_value=1):
+        """panels: list of ('image', uint8 (C, H, W)) or ('mask', uint8 (H, W)), laid out by make_grid."""
+        if not self.enabled:
+            return
+        kinds = [kind for kind, _ in panels]
+        host, event = self._to_host([t for _, t in panels])
+        self._queue.put(('grid', (tag, list(zip(kinds, host)), nrow, global_step, padding, pad_value, event)))
+
+    def add_overlay(self, name, image, predictions, global_step=None):
+        """Draw contours of predictions [(uint8 (C, H, W) or (H, W) mask, (b, g, r)), ...] on uint8 image."""
+        if not self.enabled:
+            return
+        host, event = self._to_host([image] + [p for p, _ in predictions])
+        colors = [c for _, c in predictions]
+        self._queue.put(('overlay', (name, host[0], list(zip(host[1:], colors)), global_step, event)))
+
+    @staticmethod
+    def _panel(kind, x):
+        x = x.float()
+        if kind == 'image':
+            # same as make_grid(x, 1, normalize=True)
+            low, high = x.min(), x.max()
+            x = (x - low) / max(high - low, 1e-5)
+            if x.shape[0] == 1:
+                x = x.repeat(3, 1, 1)
+            return x
+        if x.dim() == 3:
+            x = x[0]
+        return x.unsqueeze(0).repeat(3, 1, 1)
+
+    def _render_grid(self, tag, panels, nrow, step, padding, pad_value, event):
+        if event is not None:
+            event.synchronize()
+        grid = make_grid([self._panel(kind, x) for kind, x in panels], nrow, padding=padding, pad_value=pad_value)
+        if self.writer is not None:
+            self.writer.add_image(tag, grid, step)
+        if self.save_dir is not None:
+            import cv2
+            img = (grid.permute(1, 2, 0).numpy() * 255).astype(np.uint8)
+            cv2.imwrite(self._path(tag, step), cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
+
+    def _render_overlay(self, name, image, predictions, step, event):
+        if event is not None:
+            event.synchronize()
+        image = image.numpy()
+        image = image[0] if image.shape[0] == 1 else np.ascontiguousarray(image.transpose(1, 2, 0))
+        res = make_prediction(image.copy(), *[(p.numpy(), c) for p, c in predictions])
+        if self.writer is not None:
+            self.writer.add_image(name, res, step, dataformats='HWC')
+        if self.save_dir is not None:
+            import cv2
+            cv2.imwrite(self._path(name, step), res)
+
+    def _path(self, tag, step):
+        name = tag.replace('/', '_') + ('' if step is None else '_{}'.format(step)) + '.png'
+        return os.path.join(self.save_dir, name)
+
+    def _worker(self):
+        while True:
+            kind, payload = self._queue.get()
+            try:
+                if kind == 'grid':
+                    self._render_grid(*payload)
+                elif kind == 'overlay':
+                    self._render_overlay(*payload)
+                elif kind == 'close':
+                    return
+            except Exception as e:
+                logging.warning('Visualizer failed to render {}: {}'.format(kind, e))
+            finally:
+                self._queue.task_done()
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(('close', None))
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,129 @@
+import atexit
+import logging
+import queue
+import threading
+
+import torch
+from tensorboardX import SummaryWriter
+
+
+class AsyncSummaryWriter(object):
+    """Drop-in for tensorboardX.SummaryWriter that writes from a background thread.
+
+    Calls are queued and replayed in order on a worker thread, so event
+    serialization never runs on the training thread. add_scalar accepts device
+    tensors: they are copied to pinned host memory with non_blocking=True and the
+    worker waits on a CUDA event, so the training thread never synchronizes.
+
+    Scalars whose tag starts with one of prefixes are reduced per interval steps:
+    reduce='mean' writes the window average at the last step of each window,
+    reduce='last' keeps only steps divisible by interval (others are dropped
+    before any copy). Other tags (e.g. per-epoch validation) are written as is.
+    """
+
+    def __init__(self, logdir, interval=1, reduce='mean', prefixes=('train/',), max_queue=10000):
+        assert reduce in ('mean', 'last'), 'unknown reduce mode {}'.format(reduce)
+        self.writer = SummaryWriter(logdir)
+        self.interval = max(1, int(interval))
+        self.reduce = reduce
+        self.prefixes = tuple(prefixes)
+        self._windows = {}
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._closed = False
+        self._thread = threading.Thread(target=self._worker, name='AsyncSummaryWriter', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _reduced(self, tag):
+        return self.interval > 1 and tag.startswith(self.prefixes)
+
+    def add_scalar(self, tag, scalar_value, global_step=None, walltime=None):
+        if self._reduced(tag) and self.reduce == 'last' and global_step % self.interval != 0:
+            return
+        event = None
+        if torch.is_tensor(scalar_value):
+            scalar_value = scalar_value.detach()
+            if scalar_value.is_cuda:
+                host = torch.empty(scalar_value.shape, dtype=scalar_value.dtype, pin_memory=True)
+                host.copy_(scalar_value, non_blocking=True)
+                event = torch.cuda.Event()
+                event.record()
+                scalar_value = host
+        self._queue.put(('scalar', (tag, scalar_value, global_step, walltime, event)))
+
+    def __getattr__(self, name):
+        # add_image, add_text, add_histogram, ... are replayed on the worker thread
+        if name.startswith('add_'):
+            def call(*args, **kwargs):
+                self._queue.put(('call', (name, args, kwargs)))
+            return call
+        raise AttributeError(name)
+
+    def _write_scalar(self, tag, value, step, walltime, event):
+        if event is not None:
+            event.synchronize()
+        if torch.is_tensor(value):
+            value = value.float().mean().item()
+        if not self._reduced(tag) or self.reduce == 'last':
+            self.writer.add_scalar(tag, value, step, walltime)
+            return
+        window = (step - 1) // self.interval
+        cur = self._windows.get(tag)
+        if cur is not None and cur[0] != window:
+            self.writer.add_scalar(tag, cur[1] / cur[2], cur[3])
+            cur = None
+        if cur is None:
+            cur = [window, 0.0, 0, step]
+        cur[1] += value
+        cur[2] += 1
+        cur[3] = step
+        self._windows[tag] = cur
+
+    def _flush_windows(self):
+        for tag, (window, total, count, step) in self._windows.items():
+            self.writer.add_scalar(tag, total / count, step)
+        self._windows = {}
+
+    def _worker(self):
+        while True:
+            kind, payload = self._queue.get()
+            try:
+                if kind == 'scalar':
+                    self._write_scalar(*payload)
+                elif kind == 'call':
+                    name, args, kwargs = payload
+                    getattr(self.writer, name)(*args, **kwargs)
+                elif kind == 'flush':
+                    self._flush_windows()
+                    self.writer.flush()
+                elif kind == 'close':
+                    self._flush_windows()
+                    self.writer.close()
+                    return
+            except Exception as e:
+                logging.warning('AsyncSummaryWriter failed to write {}: {}'.format(kind, e))
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """Write pending windows and events, and wait until the worker is idle."""
+        if self._closed:
+            return
+        self._queue.put(('flush', None))
+        self._queue.join()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(('close', None))
+        self._thread.join()
+
+
+class NullWriter(object):
+    """Stands in for AsyncSummaryWriter on processes that do not log (ranks > 0)."""
+
+    def __getattr__(self, name):
+        if name.startswith('add_') or name in ('flush', 'close'):
+            return lambda *args, **kwargs: None
+        raise AttributeError(name)
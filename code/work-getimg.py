@@ -27,7 +27,6 @@ from networks.wrn import build_WideResNet
 from Fundus_dataloaders.fundus_dataloader import FundusSegmentation, ProstateSegmentation, MNMSSegmentation
 import Fundus_dataloaders.custom_transforms as tr
 from utils import losses, metrics, ramps, util
-from torch.cuda.amp import autocast, GradScaler
 import contextlib
 import matplotlib.pyplot as plt 
 
@@ -48,6 +47,7 @@ parser.add_argument("--deterministic", type=int, default=1, help="whether use de
 parser.add_argument("--base_lr", type=float, default=0.03, help="segmentation network learning rate")
 parser.add_argument("--seed", type=int, default=1337, help="random seed")
 parser.add_argument("--gpu", type=str, default='0')
+parser.add_argument('--device', type=str, default='auto', choices=['auto', 'cuda', 'cpu'], help='auto: cuda if available, else cpu')
 parser.add_argument('--load',action='store_true')
 parser.add_argument('--eval',action='store_true')
 parser.add_argument('--load_path',type=str,default='../model/lb1_ratio0.2/iter_6000.pth')
@@ -74,6 +74,10 @@ parser.add_argument('--bn_momentum', type=float, default=0.1)
 parser.add_argument('--dropout', type=float, default=0.0)
 parser.add_argument("--test_stu", default=True, action='store_true')
 args = parser.parse_args()
+if args.device != 'cpu':
+    os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+if args.device == 'auto':
+    args.device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
 def create_model(ema=False):
         # Network definition
@@ -82,7 +86,7 @@ def create_model(ema=False):
         if ema:
             for param in model.parameters():
                 param.detach_()
-        return model.cuda()
+        return model.to(args.device)
 
 model = create_model()
 
@@ -149,10 +153,10 @@ def train(args, snapshot_path):
     if y.mode is 'RGB':
         y = y.convert('L')
     y = y.resize((256, 256), Image.NEAREST)
-    model.load_state_dict(torch.load('../model/'+args.dataset+'/20plmaskcutmix1.0005_lb1/unet_cup_dice_best_model.pth'))
+    model.load_state_dict(torch.load('../model/'+args.dataset+'/20plmaskcutmix1.0005_lb1/unet_cup_dice_best_model.pth', map_location=args.device))
     train_sample = {'image': np.array(x), 'label':np.array(y)}
     train_sample = normal_toTensor(train_sample)
-    train_x = train_sample['image'].unsqueeze(0).cuda()
+    train_x = train_sample['image'].unsqueeze(0).to(args.device)
     pred = model(train_x)[0].sigmoid().ge(0.5).float().cpu()
     pred_img = torch.zeros(plc.shape)
     pred_img[pred[1] == 1] = 128
@@ -242,11 +246,11 @@ def train(args, snapshot_path):
     cv2.imwrite(snapshot_path+'u_c.png', cv2.cvtColor(np.array(uc).astype(np.uint8), cv2.COLOR_RGB2BGR))
     cv2.imwrite(snapshot_path+'plc.png', np.array(plc).astype(np.uint8))
 
-    model.load_state_dict(torch.load('../model/'+args.dataset+'/20plmaskcutmix1.0005_lb1/unet_cup_dice_best_model.pth'))
+    model.load_state_dict(torch.load('../model/'+args.dataset+'/20plmaskcutmix1.0005_lb1/unet_cup_dice_best_model.pth', map_location=args.device))
     train_sample = {'image': np.array(uc), 'label':np.array(plc)}
     train_sample = normal_toTensor(train_sample)
-    train_x = train_sample['image'].unsqueeze(0)
-    pred = model(train_x)[0].sigmoid().ge(0.5).float()
+    train_x = train_sample['image'].unsqueeze(0).to(args.device)
+    pred = model(train_x)[0].sigmoid().ge(0.5).float().cpu()
     pred_img = torch.zeros(plc.shape)
     pred_img[pred[1] == 1] = 128
     pred_img[pred[0] == 1] = 0
@@ -268,7 +272,6 @@ if __name__ == "__main__":
     elif args.dataset == 'prostate':
         train_data_path="../../data/ProstateSlice"
         
-    os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
 
     if not os.path.exists(snapshot_path):
         os.makedirs(snapshot_path)